@@ -1,201 +1,2222 @@
 #!/usr/bin/env python3
 
+import io
 import json
+import codecs
 import shlex
+import shutil
+import asyncio
+import math
+import struct
+import socketserver
+import ssl
+import http.client
 import subprocess
 import yaml
 import os
+import sys
 import signal
+import resource
+import ctypes
 import tempfile
 import psutil
 import socket
 import re
 import requests
-import base64
+import requests.adapters
+import urllib3.exceptions
+import hashlib
+import hmac
+import random
+import bisect
+import gzip
+import brotli
+import time
 import dns.resolver
+import dns.rdatatype
+from werkzeug.utils import secure_filename
+from werkzeug.formparser import parse_form_data
+from urllib.parse import urlparse
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+from urllib.parse import quote
+from html import escape
+from urllib.error import URLError
+from mimetypes import guess_type
+from time import perf_counter, monotonic
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from flask import Flask, request, render_template, Response, send_from_directory, g, has_app_context
+from flask_compress import Compress
+from flask_socketio import SocketIO, emit
+
+from threading import Thread, Event, Lock
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from sqlalchemy import create_engine, text
+from pymongo import MongoClient
+from azure.cosmos import CosmosClient as cosmos_client
+from azure.cosmos import exceptions as cosmos_exceptions
+
+try:
+    from pyppeteer import launch as launch_browser
+    from web_screenshot import BROWSER_LAUNCH_OPTIONS, take_screenshot
+except ImportError:
+    # web_screenshot.py needs pyppeteer as well, screenshot requests fail
+    launch_browser = None
+
+from command_allowlist import AllowlistMatcher
+from metrics import MetricsRegistry
+from profiling import ProfileRing, traced
+
+CONFIG_FILE = os.getenv('CONFIG_FILE', './config.yaml')
+CONFIG_MAP_DIR = os.getenv('CONFIG_MAP_DIR', '/etc/container-demo-runner')
+NAMESPACE_FILE = '/var/run/secrets/kubernetes.io/serviceaccount/namespace'
+PUPPETEER_HOME = os.getenv('PYPPETEER_HOME', '/tmp/webscreenshots')
+
+UPLOAD_FOLDER = "%s/uploads" % (tempfile.gettempdir())
+
+if not os.path.exists(UPLOAD_FOLDER):
+    os.makedirs(UPLOAD_FOLDER, mode=0o777)
+
+HOST_ENTRIES_BEGIN = '#### entries added by container-demo-runner ####'
+HOST_ENTRIES_END = '#### end entries added by container-demo-runner ####'
+
+with open(CONFIG_FILE, 'r') as config_yaml:
+    config_file_values = yaml.safe_load(config_yaml)
+
+
+def config_map_version():
+    """changes whenever the mounted ConfigMap is updated
+
+    Kubernetes updates ConfigMap volumes by swapping the ..data symlink
+    to a new timestamped directory. For a plain directory the file names
+    and mtimes are used instead.
+    """
+    try:
+        return os.readlink(os.path.join(CONFIG_MAP_DIR, '..data'))
+    except OSError:
+        pass
+    try:
+        return tuple(sorted(
+            (e.name, e.stat().st_mtime_ns) for e in os.scandir(CONFIG_MAP_DIR)
+            if not e.name.startswith('.')))
+    except OSError:
+        return None
+
+
+def read_config_map(raw, version):
+    """returns the ConfigMap settings whose text differs from raw
+
+    raw maps each setting to the text it was last parsed from and is
+    updated in place. Files are read from the ..data target directory
+    so one pass never mixes two ConfigMap versions. Settings removed
+    from the ConfigMap fall back to their CONFIG_FILE value.
+    """
+    directory = CONFIG_MAP_DIR
+    if isinstance(version, str):
+        directory = os.path.join(CONFIG_MAP_DIR, version)
+    names = set(config_file_values.keys()) | set(raw.keys())
+    if os.path.isdir(directory):
+        names.update(n for n in os.listdir(directory) if not n.startswith('.'))
+    changed = {}
+    removed = []
+    for ck in names:
+        cv = None
+        if os.path.isfile(os.path.join(directory, ck)):
+            with open(os.path.join(directory, ck), 'r') as cmv:
+                cv = cmv.read()
+        if cv == raw.get(ck):
+            continue
+        if cv is None:
+            del raw[ck]
+            if ck in config_file_values:
+                print('restoring config setting: %s from %s' % (ck, CONFIG_FILE))
+                changed[ck] = config_file_values[ck]
+            else:
+                print('removing config setting: %s' % ck)
+                removed.append(ck)
+            continue
+        raw[ck] = cv
+        if isinstance(config_file_values.get(ck), (list, dict)):
+            try:
+                cv = json.loads(cv)
+            except json.JSONDecodeError as jde:
+                print('error reading %s from ConfigMap: %s' % (ck, jde))
+                continue
+        print('loading config setting: %s from ConfigMap value: %s' % (ck, cv))
+        changed[ck] = cv
+    return changed, removed
+
+
+def write_host_entries(entries):
+    """replaces the host_entries block in /etc/hosts
+
+    /etc/hosts is usually bind mounted into the container, so it is
+    rewritten in place rather than replaced.
+    """
+    try:
+        with open('/etc/hosts', 'r+') as eh:
+            kept = []
+            inside = False
+            for line in eh.read().split('\n'):
+                if line == HOST_ENTRIES_BEGIN:
+                    inside = True
+                elif line == HOST_ENTRIES_END:
+                    inside = False
+                elif not inside:
+                    kept.append(line)
+            hosts = '\n'.join(kept).rstrip('\n') + '\n'
+            if entries:
+                hosts = '%s\n%s\n%s\n%s\n' % (
+                    hosts, HOST_ENTRIES_BEGIN, entries.strip('\n'), HOST_ENTRIES_END)
+            eh.seek(0)
+            eh.write(hosts)
+            eh.truncate()
+    except OSError as oe:
+        print('error writing host_entries to /etc/hosts: %s' % oe)
+
+
+config_map_raw = {}
+config_map_loaded = config_map_version()
+config = dict(config_file_values)
+config.update(read_config_map(config_map_raw, config_map_loaded)[0])
+
+
+def current_config():
+    """the settings in use when the current request or message started
+
+    reload_config swaps in a new dict rather than changing this one, so
+    a request reads one version of the settings from start to end.
+    Outside of a request the latest settings are returned.
+    """
+    if has_app_context():
+        snapshot = g.get('config')
+        if snapshot is not None:
+            return snapshot
+    return config
+
+
+def per_worker(limit):
+    """the share of a limit for the whole pod that each worker enforces
+
+    workers do not share state, so the process and DNS cache limits are
+    split evenly between them rather than enforced over the control bus.
+    """
+    return max(1, int(limit) // max(1, int(current_config().get('workers', 1))))
+
+
+if 'host_entries' in config:
+    write_host_entries(config['host_entries'])
+
+# static files are served from the in memory asset cache by get_resource
+app = Flask(__name__, static_folder=None)
+# streamed bodies (uploads, payloads, proxied content) are sent byte for byte
+app.config['COMPRESS_STREAMS'] = False
+Compress(app)
+# identifies this worker process on the control bus, across pods as well
+WORKER_ID = "%s-%d" % (socket.gethostname(), os.getpid())
+
+
+class ControlBus(object):
+    """delivers control messages to every worker process
+
+    halt, disconnect and resume requests have to reach the worker that
+    owns a command's processes and scrollback, which is not always the
+    worker holding the client's connection. This in-process bus is used
+    when there is a single worker; handlers see their own messages.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self.handlers = {}
+
+    def on(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def publish(self, kind, **message):
+        message['kind'] = kind
+        message['worker'] = WORKER_ID
+        self.deliver(message)
+
+    def deliver(self, message):
+        handler = self.handlers.get(message.get('kind'))
+        if handler is None:
+            return
+        try:
+            handler(message)
+        except Exception as ex:
+            print('error handling control message %s: %s' % (message, ex))
+
+    def start(self):
+        pass
+
+
+class RedisControlBus(ControlBus):
+    """control messages published on a Redis channel shared by all workers
+
+    the listener resubscribes with a growing delay when the connection to
+    Redis is lost, messages published while it is away are not received.
+    client replaces the Redis client, for an in-process stand-in.
+    """
+
+    shared = True
+    RETRY_MIN_SECONDS = 0.5
+    RETRY_MAX_SECONDS = 30
+
+    def __init__(self, url, channel='container-demo-runner-control', client=None):
+        super().__init__()
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.redis = client
+        self.channel = channel
+        self.subscribed = Event()
+
+    def publish(self, kind, **message):
+        message['kind'] = kind
+        message['worker'] = WORKER_ID
+        self.redis.publish(self.channel, json.dumps(message))
+
+    def start(self):
+        Thread(target=self.listen, name='control-bus', daemon=True).start()
+
+    def listen(self):
+        delay = self.RETRY_MIN_SECONDS
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                self.subscribed.set()
+                delay = self.RETRY_MIN_SECONDS
+                for item in pubsub.listen():
+                    self.receive(item)
+                print('control bus subscription to %s ended' % self.channel)
+            except Exception as ex:
+                print('control bus subscription to %s failed: %s, retrying in %.1f seconds' %
+                      (self.channel, ex, delay))
+            finally:
+                self.subscribed.clear()
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+            time.sleep(delay)
+            delay = min(delay * 2, self.RETRY_MAX_SECONDS)
+
+    def receive(self, item):
+        try:
+            self.deliver(json.loads(item['data']))
+        except ValueError as ve:
+            print('invalid control message on %s: %s' % (self.channel, ve))
+
+
+message_queue = config.get('message_queue') or None
+if message_queue:
+    print('sharing Socket.IO and control messages through %s' % message_queue)
+    control_bus = RedisControlBus(message_queue)
+else:
+    control_bus = ControlBus()
+websocket = SocketIO(app, cors_allowed_origins='*', async_mode='threading',
+                     message_queue=message_queue)
+
+# recorded into per thread cells and merged when /metrics is scraped, a
+# scrape reaches one worker so each worker labels the series it reports
+metrics = MetricsRegistry(
+    {'worker': WORKER_ID} if int(config.get('workers', 1)) > 1 else None)
+LATENCY_SECONDS_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                           0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.25, 1.0)
+THROUGHPUT_BYTES_BUCKETS = tuple(mbits * 125000 for mbits in (
+    1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000))
+http_request_seconds = metrics.histogram(
+    'demo_runner_http_request_duration_seconds',
+    'time until the response to an HTTP request starts, by route',
+    ('route', 'method', 'status'))
+socketio_messages = metrics.counter(
+    'demo_runner_socketio_messages_total',
+    'Socket.IO messages received, by request type', ('type',))
+emitted_frames = metrics.counter(
+    'demo_runner_emitted_frames_total',
+    'commandResponse frames sent to clients, by stream', ('stream',))
+emitted_bytes = metrics.counter(
+    'demo_runner_emitted_bytes_total',
+    'bytes of command output sent to clients, by stream', ('stream',))
+dns_query_seconds = metrics.histogram(
+    'demo_runner_dns_query_duration_seconds',
+    'DNS query latency, by record type and whether it came from cache',
+    ('type', 'cached'))
+webproxy_request_seconds = metrics.histogram(
+    'demo_runner_webproxy_request_duration_seconds',
+    'time until the proxied response headers arrived, by endpoint',
+    ('endpoint',))
+dbconnect_checkout_seconds = metrics.histogram(
+    'demo_runner_dbconnect_checkout_duration_seconds',
+    'time to check out a cached database connection and complete a first '
+    'round trip, by database', ('database',))
+dbconnect_roundtrip_seconds = metrics.histogram(
+    'demo_runner_dbconnect_roundtrip_duration_seconds',
+    'database round trip latency, by database', ('database',))
+performance_latency_seconds = metrics.histogram(
+    'demo_runner_performance_latency_seconds',
+    'mean ping-pong latency of each performance run, by backend',
+    ('backend',), LATENCY_SECONDS_BUCKETS)
+performance_throughput_bytes = metrics.histogram(
+    'demo_runner_performance_throughput_bytes_per_second',
+    'throughput of each performance run, by backend and message size',
+    ('backend', 'msg_size'), THROUGHPUT_BYTES_BUCKETS)
+
+
+SOCKETIO_MESSAGE_TYPES = ['variable', 'performance', 'resume', 'halt', 'webscreenshot', 'profile']
+
+
+def socketio_message_type(data):
+    # any other type runs as a command, this also keeps the label set bounded
+    message_type = data.get('type')
+    return message_type if message_type in SOCKETIO_MESSAGE_TYPES else 'command'
+
+
+def count_emitted(response):
+    emitted_frames.inc(response['stream'])
+    if isinstance(response['data'], str):
+        emitted_bytes.inc(response['stream'], amount=len(response['data']))
+
+
+@app.before_request
+def snapshot_config():
+    g.config = config
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = perf_counter()
+
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_request_seconds.observe(
+            perf_counter() - started, route, request.method, response.status_code)
+    return response
+
+
+# captures are kept in memory, the oldest is dropped when the ring is full
+profile_ring = ProfileRing(int(config.get('profile_ring_size', 32)))
+PROFILE_MODES = ['cprofile', 'trace']
+# set by profile messages, selected routes and handler types are sampled until it expires
+profile_sampling = {
+    'mode': None,
+    'handlers': [],
+    'routes': [],
+    'sample_rate': 1.0,
+    'until': 0
+}
+engine_loop_capture = None
+
+
+def profile_token_valid(token):
+    """profiling stays off until a profile_token is configured"""
+    required = str(current_config().get('profile_token', '') or '')
+    return bool(required) and hmac.compare_digest(str(token or ''), required)
+
+
+def profile_access_denied():
+    """the response refusing a /profiles request, None when it is allowed"""
+    if not current_config().get('profile_token'):
+        return Response(
+            json.dumps({"error": 404, "message": "profiling is off, profile_token is not set"}),
+            status=404, mimetype='application/json')
+    if not profile_token_valid(
+            request.headers.get('X-Profile-Token', request.args.get('profile_token'))):
+        return Response(
+            json.dumps({"error": 403, "message": "invalid profile token"}),
+            status=403, mimetype='application/json')
+    return None
+
+
+def requested_profile_mode(value, token):
+    """the mode asked for by a header, query argument or message flag"""
+    if not value or str(value).lower() in ['0', 'false', 'no', 'off']:
+        return None
+    if not profile_token_valid(token):
+        return None
+    return 'trace' if str(value).lower() == 'trace' else 'cprofile'
+
+
+def sampled_profile_mode(kind, name):
+    """the mode for a route or handler type selected by a profile message"""
+    sampling = profile_sampling
+    if not sampling['mode'] or name not in sampling[kind] or monotonic() > sampling['until']:
+        return None
+    if not current_config().get('profile_token'):
+        # the token was removed by a config reload
+        return None
+    if random.random() >= sampling['sample_rate']:
+        return None
+    return sampling['mode']
+
+
+@app.before_request
+def start_request_profile():
+    mode = requested_profile_mode(
+        request.headers.get('X-Profile', request.args.get('profile')),
+        request.headers.get('X-Profile-Token', request.args.get('profile_token')))
+    if not mode and request.url_rule:
+        mode = sampled_profile_mode('routes', request.url_rule.rule)
+    if mode:
+        g.profile_capture = profile_ring.start(
+            '%s %s' % (request.method, request.path), mode)
+
+
+@app.after_request
+def add_profile_id(response):
+    capture = g.get('profile_capture')
+    if capture:
+        response.headers['X-Profile-Id'] = str(capture.id)
+    return response
+
+
+@app.teardown_request
+def finish_request_profile(exception=None):
+    capture = g.pop('profile_capture', None)
+    if capture:
+        profile_ring.finish(capture)
+
+
+performance_cancel_events = {}
+
+
+def cancel_performance_test(sid):
+    # a halt and a disconnect can race, only one of them gets the event
+    cancel_event = performance_cancel_events.pop(sid, None)
+    if cancel_event:
+        cancel_event.set()
+
+
+def root_dir():  # pragma: no cover
+    return os.path.abspath(os.path.dirname(__file__))
+
+
+def get_file(filename):  # pragma: no cover
+    try:
+        src = os.path.join(root_dir(), filename)
+        return open(src, mode='rb').read()
+    except IOError as exc:
+        return str(exc)
+
+
+class AssetCache(object):
+    """in memory copies of static assets with precompressed variants
+
+    each asset keeps its identity body plus gzip and brotli encodings
+    (when they are smaller) and a strong ETag per representation so
+    repeat requests can be answered with 304 Not Modified.
+    """
+
+    COMPRESSIBLE_MIMETYPES = [
+        'application/javascript',
+        'application/json',
+        'application/xml',
+        'image/svg+xml',
+        'image/x-icon',
+        'image/vnd.microsoft.icon'
+    ]
+
+    def __init__(self, max_file_bytes=2097152, max_age=86400):
+        self.max_file_bytes = max_file_bytes
+        self.max_age = max_age
+        self.assets = {}
+        self.rendered = {}
+        self.lock = Lock()
+
+    def compressible(self, mimetype):
+        return mimetype.startswith('text/') or \
+            mimetype in self.COMPRESSIBLE_MIMETYPES
+
+    def build(self, body, mimetype, cache_control):
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        variants = {'identity': (body, '"%s"' % etag)}
+        if self.compressible(mimetype):
+            gz = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gz) < len(body):
+                variants['gzip'] = (gz, '"%s-gz"' % etag)
+            br = brotli.compress(body)
+            if len(br) < len(body):
+                variants['br'] = (br, '"%s-br"' % etag)
+        return {
+            'mimetype': mimetype,
+            'cache_control': cache_control,
+            'variants': variants
+        }
+
+    def index(self, root, paths):
+        for path in paths:
+            src = os.path.join(root, path)
+            if os.path.isdir(src):
+                for dirpath, _, filenames in os.walk(src):
+                    for filename in filenames:
+                        self.add(root, os.path.join(dirpath, filename))
+            elif os.path.isfile(src):
+                self.add(root, src)
+        print('indexed %d static assets' % len(self.assets))
+
+    def add(self, root, src):
+        if os.path.getsize(src) > self.max_file_bytes:
+            return
+        name = os.path.relpath(src, root).replace(os.sep, '/')
+        mimetype = guess_type(name)[0] or 'application/octet-stream'
+        with open(src, 'rb') as asset_file:
+            self.assets[name] = self.build(
+                asset_file.read(), mimetype,
+                'public, max-age=%d' % self.max_age)
+
+    def get(self, name):
+        return self.assets.get(name)
+
+    @traced
+    def render(self, template, **context):
+        key = (template, tuple(sorted(context.items())))
+        with self.lock:
+            asset = self.rendered.get(key)
+        if not asset:
+            asset = self.build(
+                render_template(template, **context).encode('utf-8'),
+                'text/html', 'no-cache')
+            with self.lock:
+                self.rendered[key] = asset
+        return self.response(asset)
+
+    def response(self, asset):
+        encoding = negotiate_encoding(
+            request.headers.get('Accept-Encoding', ''), asset['variants'])
+        body, etag = asset['variants'][encoding]
+        headers = {
+            'ETag': etag,
+            'Cache-Control': asset['cache_control'],
+            'Vary': 'Accept-Encoding'
+        }
+        if encoding != 'identity':
+            # flask_compress leaves responses with a Content-Encoding alone
+            headers['Content-Encoding'] = encoding
+        if etag_matches(request.headers.get('If-None-Match', ''), etag):
+            return Response(status=304, headers=headers)
+        return Response(body, mimetype=asset['mimetype'], headers=headers)
+
+
+def negotiate_encoding(accept_encoding, variants):
+    accepted = {}
+    for part in accept_encoding.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    for coding in ['br', 'gzip']:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if coding in variants and q > 0:
+            return coding
+    return 'identity'
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+asset_cache = AssetCache(int(config.get('asset_cache_max_file_bytes', 2097152)),
+                         int(config.get('asset_cache_max_age', 86400)))
+asset_cache.index(root_dir(), ['static', 'favicon.ico', 'robots.txt'])
+
+
+def get_hostname():
+    hostname = socket.gethostname()
+    print('found hostname: %s' % hostname)
+    if os.path.exists(NAMESPACE_FILE):
+        print('running in K8s, adding namespace to hostname')
+        with open(NAMESPACE_FILE, 'r') as nsf:
+            hostname = "%s/%s" % (
+                re.sub(r"[\n\t\s]*", "", nsf.read()), hostname)
+    return hostname
+
+
+def get_nameserver():
+    nameserver = dns.resolver.Resolver().nameservers[0]
+    print('found nameserver: %s' % nameserver)
+    return nameserver
+
+
+class DNSCache(object):
+    """LRU cache of DNS answers keyed by (fqdn, record type)
+
+    positive answers expire with their record TTL, NXDOMAIN and NoAnswer
+    results are cached for the SOA negative TTL (or negative_ttl).
+    concurrent misses for the same key share one query.
+    """
+
+    def __init__(self, max_entries=1024, negative_ttl=30):
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['expires'] > monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                if not entry['answers']:
+                    self.negative_hits += 1
+                return entry
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, answers, ttl):
+        with self.lock:
+            self.entries[key] = {
+                'answers': answers,
+                'ttl': ttl,
+                'expires': monotonic() + ttl
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def resolve(self, key, query):
+        """returns the answers for a missed key, query returns (answers, ttl)
+
+        only the first caller runs query, callers arriving while it runs
+        wait for its answers or its exception.
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+        try:
+            answers, ttl = query()
+        except Exception as ex:
+            with self.lock:
+                del self.in_flight[key]
+            future.set_exception(ex)
+            raise
+        self.put(key, answers, ttl)
+        with self.lock:
+            del self.in_flight[key]
+        future.set_result(answers)
+        return answers
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'shared': self.shared,
+                'evictions': self.evictions
+            }
+
+
+dns_cache = DNSCache(per_worker(config.get('dns_cache_max_entries', 1024)),
+                     int(config.get('dns_cache_negative_ttl', 30)))
+dns_executor = ThreadPoolExecutor(
+    max_workers=int(config.get('dns_batch_workers', 16)), thread_name_prefix='dns')
+DNS_BATCH_RECORD_TYPES = ['A', 'AAAA', 'SRV', 'CNAME']
+
+
+def negative_ttl_from(exception):
+    responses = []
+    if exception.kwargs:
+        responses = list(exception.kwargs.get('responses', {}).values())
+        if exception.kwargs.get('response'):
+            responses.append(exception.kwargs['response'])
+    for response in responses:
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+    return dns_cache.negative_ttl
+
+
+@traced
+def resolve_fqdn(fqdn, record_type='A', use_cache=True):
+    """returns the answer list and if it came from cache, empty when the name or record does not exist"""
+    started = perf_counter()
+    key = (fqdn.lower().rstrip('.'), record_type.upper())
+    if use_cache:
+        entry = dns_cache.get(key)
+        if entry:
+            dns_query_seconds.observe(perf_counter() - started, key[1], 'true')
+            return entry['answers'], True
+
+    def query():
+        try:
+            result = dns.resolver.query(fqdn, record_type)
+            return [str(rdata) for rdata in result], result.rrset.ttl
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as ex:
+            return [], negative_ttl_from(ex)
+        finally:
+            dns_query_seconds.observe(perf_counter() - started, key[1], 'false')
+    if use_cache:
+        return dns_cache.resolve(key, query), False
+    answers, ttl = query()
+    dns_cache.put(key, answers, ttl)
+    return answers, False
+
+
+def resolve_query(fqdn, record_type, use_cache=True):
+    result = {
+        "fqdn": fqdn,
+        "type": record_type,
+        "answers": [],
+        "cached": False,
+        "error": None,
+        "time_ms": None
+    }
+    started = perf_counter()
+    try:
+        result["answers"], result["cached"] = resolve_fqdn(
+            fqdn, record_type, use_cache)
+        if not result["answers"]:
+            result["error"] = 404
+    except Exception as ex:
+        result["error"] = 500
+        result["message"] = str(ex)
+    result["time_ms"] = round((perf_counter() - started) * 1000.0, 3)
+    return result
+
+
+def dig_fqdn(fqdn, record_type='A', use_cache=True):
+    try:
+        answers, cached = resolve_fqdn(fqdn, record_type, use_cache)
+        if answers:
+            return answers[0]
+        return None
+    except Exception:
+        return None
+
+
+def get_output_batch_settings(cmd):
+    settings = {
+        'max_bytes': int(current_config().get('output_batch_max_bytes', 16384)),
+        'window_ms': float(current_config().get('output_batch_window_ms', 5)),
+        'buffer_max_bytes': int(current_config().get('output_buffer_max_bytes', 1048576)),
+        'client_max_pending': int(current_config().get('output_client_max_pending', 64)),
+        'overflow_policy': current_config().get('output_overflow_policy', 'pause')
+    }
+    overrides = current_config().get('output_batch_overrides', {}) or {}
+    for regex, override in overrides.items():
+        if re.match(r"%s" % regex, cmd):
+            settings.update(override)
+            break
+    return settings
+
+
+OUTPUT_OVERFLOW_POLICIES = ['pause', 'drop_middle', 'truncate']
+output_buffer_metrics = {
+    'buffers': 0,
+    'buffered_bytes': 0,
+    'lines_dropped': 0,
+    'frames_dropped': 0,
+    'pauses': 0
+}
+
+
+def client_backlog(sid):
+    """packets engine.io has queued for the client of sid but not sent"""
+    try:
+        eio_sid = websocket.server.manager.eio_sid_from_sid(sid, '/')
+        return websocket.server.eio.sockets[eio_sid].queue.qsize()
+    except (AttributeError, KeyError, TypeError):
+        return 0
+
+
+class OutputBuffer(object):
+    """bounded queue of output frames between one command and its client
+
+    frames are sent while the client's engine.io queue holds fewer than
+    max_pending packets. Once max_bytes are waiting the policy applies:
+    'pause' stops reading the command's pipes so it blocks on write,
+    'drop_middle' drops the oldest waiting frames behind an elided line
+    count, and 'truncate' drops new output until the command ends.
+    """
+
+    def __init__(self, engine, runner, max_bytes=1048576, max_pending=64, policy='pause'):
+        self.engine = engine
+        self.runner = runner
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+        self.policy = policy if policy in OUTPUT_OVERFLOW_POLICIES else 'pause'
+        self.frames = deque()
+        self.bytes = 0
+        self.paused = False
+        self.truncated_lines = 0
+        self.drain_timer = None
+        self.on_drained = None
+        output_buffer_metrics['buffers'] += 1
+
+    def _append(self, frame):
+        self.frames.append(frame)
+        self.bytes += len(frame['data'])
+        output_buffer_metrics['buffered_bytes'] += len(frame['data'])
+
+    def _popleft(self):
+        frame = self.frames.popleft()
+        self.bytes -= len(frame['data'])
+        output_buffer_metrics['buffered_bytes'] -= len(frame['data'])
+        return frame
+
+    def _dropped(self, data):
+        lines = data.count('\n') or 1
+        output_buffer_metrics['lines_dropped'] += lines
+        output_buffer_metrics['frames_dropped'] += 1
+        return lines
+
+    def put(self, stream_type, data):
+        if self.runner['killed']:
+            return
+        frame = {'stream': stream_type, 'data': data, 'elided': 0}
+        if self.frames and self.bytes + len(data) > self.max_bytes:
+            if self.policy == 'truncate':
+                self.truncated_lines += self._dropped(data)
+                return
+            self._append(frame)
+            if self.policy == 'drop_middle':
+                self._drop_oldest()
+            elif not self.paused:
+                self.paused = True
+                output_buffer_metrics['pauses'] += 1
+                self.engine.pause_reading(self.runner)
+        else:
+            self._append(frame)
+        self.drain()
+
+    def _drop_oldest(self):
+        marker = None
+        if self.frames[0]['elided']:
+            marker = self._popleft()
+        while self.bytes > self.max_bytes and len(self.frames) > 1:
+            frame = self._popleft()
+            if marker is None:
+                marker = {'stream': frame['stream'], 'data': '', 'elided': 0}
+            marker['elided'] += self._dropped(frame['data'])
+        if marker:
+            self.frames.appendleft(marker)
+
+    def finish(self, on_drained):
+        """calls on_drained once every waiting frame has been sent"""
+        if self.truncated_lines:
+            self._append({'stream': 'stderr', 'data': '', 'elided': 0,
+                          'truncated': self.truncated_lines})
+            self.truncated_lines = 0
+        self.on_drained = on_drained
+        self.drain()
+
+    def drain(self):
+        if self.drain_timer:
+            return
+        if self.runner['killed']:
+            while self.frames:
+                self._popleft()
+        while self.frames:
+            sid = scrollback.current_sid(self.runner['sid'], self.runner['id'])
+            if client_backlog(sid) >= self.max_pending:
+                self.drain_timer = self.engine.loop.call_later(0.05, self._drain_later)
+                break
+            frame = self._popleft()
+            data = frame['data']
+            if frame['elided']:
+                data = "\n[... %d lines elided ...]\n" % frame['elided']
+            elif frame.get('truncated'):
+                data = "\n[output truncated, %d lines dropped]\n" % frame['truncated']
+            scrollback.emit(self.runner['sid'], self.runner['id'], {
+                'id': self.runner['id'],
+                'stream': frame['stream'],
+                'data': data
+            })
+        if self.paused and self.bytes <= self.max_bytes // 2:
+            self.paused = False
+            self.engine.resume_reading(self.runner)
+        if not self.frames and self.on_drained:
+            on_drained = self.on_drained
+            self.on_drained = None
+            output_buffer_metrics['buffers'] -= 1
+            on_drained()
+
+    def _drain_later(self):
+        self.drain_timer = None
+        self.drain()
+
+
+OUTPUT_PARTIAL_MAX_BYTES = 65536
+
+
+class OutputStream(object):
+    """splits the output of one pipe into lines and batches them into frames
+
+    the text after the last newline is kept as pieces of a partial line,
+    so output without newlines is not rescanned with every chunk. once the
+    partial line reaches max_bytes it is sent as it is.
+    """
+
+    def __init__(self, loop, runner, stream_type, pipe, max_bytes=0, window_ms=0):
+        self.loop = loop
+        self.runner = runner
+        self.stream_type = stream_type
+        self.pipe = pipe
+        self.max_bytes = max_bytes
+        self.window_ms = window_ms
+        self.partial_max_bytes = max_bytes if max_bytes > 0 else OUTPUT_PARTIAL_MAX_BYTES
+        self.decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder('utf-8')(errors='replace'), True)
+        self.partial = []
+        self.partial_bytes = 0
+        self.pending = []
+        self.pending_bytes = 0
+        self.flush_timer = None
+
+    def feed(self, chunk):
+        text = self.decoder.decode(chunk)
+        end_of_lines = text.rfind('\n') + 1
+        if not end_of_lines:
+            if text:
+                self.partial.append(text)
+                self.partial_bytes += len(text)
+                if self.partial_bytes >= self.partial_max_bytes:
+                    # a line too long to wait for its end
+                    self._add_line(self._take_partial())
+                    self._flush_full()
+            return
+        self.partial.append(text[:end_of_lines])
+        lines = self._take_partial().splitlines(keepends=True)
+        if end_of_lines < len(text):
+            self.partial.append(text[end_of_lines:])
+            self.partial_bytes = len(text) - end_of_lines
+        for line in lines:
+            self._add_line(line)
+        self._flush_full()
+
+    def _take_partial(self):
+        partial = ''.join(self.partial)
+        self.partial = []
+        self.partial_bytes = 0
+        return partial
+
+    def _add_line(self, line):
+        if self.window_ms <= 0:
+            # unbatched, one frame per line
+            self.pending.append(line)
+            self.flush()
+            return
+        if self.pending and self.pending_bytes + len(line) > self.max_bytes:
+            self.flush()
+        self.pending.append(line)
+        self.pending_bytes += len(line)
+        if not self.flush_timer:
+            self.flush_timer = self.loop.call_later(
+                self.window_ms / 1000.0, self.flush)
+
+    def _flush_full(self):
+        if self.pending and self.pending_bytes >= self.max_bytes:
+            self.flush()
+
+    def close(self):
+        self.partial.append(self.decoder.decode(b'', final=True))
+        partial = self._take_partial()
+        if partial:
+            self.pending.append(partial)
+        self.flush()
+        self.pipe.close()
+
+    def flush(self):
+        if self.flush_timer:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if self.pending and not self.runner['killed']:
+            self.runner['buffer'].put(self.stream_type, ''.join(self.pending))
+        self.pending = []
+        self.pending_bytes = 0
+
+
+class CommandEngine(object):
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(
+            target=self.loop.run_forever, name='command-engine', daemon=True)
+        self.thread.start()
+
+    def start(self, sid, id, process, batch, on_complete=None):
+        runner = {
+            'id': id,
+            'sid': sid,
+            'process': process,
+            'killed': False,
+            'exited': False,
+            'completed': False,
+            'open_pipes': 2,
+            'on_complete': on_complete,
+            'future': Future()
+        }
+        runner['streams'] = [
+            OutputStream(self.loop, runner, 'stdout', process.stdout,
+                         batch['max_bytes'], batch['window_ms']),
+            OutputStream(self.loop, runner, 'stderr', process.stderr,
+                         batch['max_bytes'], batch['window_ms'])
+        ]
+        runner['buffer'] = OutputBuffer(
+            self, runner, batch['buffer_max_bytes'], batch['client_max_pending'],
+            batch['overflow_policy'])
+        process_supervisor.set_runner(process.pid, runner)
+        self.loop.call_soon_threadsafe(self._attach, runner)
+        return runner['future']
+
+    def _attach(self, runner):
+        for stream in runner['streams']:
+            fd = stream.pipe.fileno()
+            os.set_blocking(fd, False)
+            self.loop.add_reader(fd, self._read, runner, stream)
+        pid = runner['process'].pid
+        if hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(pid)
+                self.loop.add_reader(pidfd, self._exited, runner, pidfd)
+                return
+            except OSError:
+                pass
+        self._poll_exit(runner)
+
+    def pause_reading(self, runner):
+        # the child blocks once the pipe buffer fills up
+        for stream in runner['streams']:
+            if not stream.pipe.closed:
+                self.loop.remove_reader(stream.pipe.fileno())
+
+    def resume_reading(self, runner):
+        for stream in runner['streams']:
+            if not stream.pipe.closed:
+                self.loop.add_reader(stream.pipe.fileno(), self._read, runner, stream)
+
+    def _read(self, runner, stream):
+        fd = stream.pipe.fileno()
+        try:
+            chunk = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b''
+        if chunk:
+            stream.feed(chunk)
+            return
+        self._close_stream(runner, stream)
+
+    def _close_stream(self, runner, stream):
+        if stream.pipe.closed:
+            return
+        self.loop.remove_reader(stream.pipe.fileno())
+        stream.close()
+        runner['open_pipes'] -= 1
+        self._check_complete(runner)
+
+    def _poll_exit(self, runner):
+        if runner['process'].poll() is None:
+            self.loop.call_later(0.05, self._poll_exit, runner)
+        else:
+            self._exited(runner)
+
+    def _exited(self, runner, pidfd=None):
+        if pidfd is not None:
+            self.loop.remove_reader(pidfd)
+            os.close(pidfd)
+        runner['process'].wait()
+        runner['exited'] = True
+        if runner['open_pipes']:
+            # background children can hold the pipes open after the shell exits
+            self.loop.call_later(1.0, self._drain_timeout, runner)
+        self._check_complete(runner)
+
+    def _drain_timeout(self, runner):
+        if runner['buffer'].paused and not runner['killed']:
+            # still reading output the client has not taken yet
+            self.loop.call_later(1.0, self._drain_timeout, runner)
+            return
+        for stream in runner['streams']:
+            self._close_stream(runner, stream)
+
+    def _check_complete(self, runner):
+        if runner['completed'] or not runner['exited'] or runner['open_pipes']:
+            return
+        runner['completed'] = True
+        process_supervisor.release(runner['sid'], runner['process'].pid)
+        # completed is reported after the output still waiting for the client
+        runner['buffer'].finish(lambda: self._report_complete(runner))
+
+    def run_later(self, delay, callback):
+        """runs callback on an executor thread after delay seconds
+
+        safe to call from any thread, the timer is added on the loop
+        thread so the loop wakes up for it.
+        """
+        self.loop.call_soon_threadsafe(
+            self.loop.call_later, delay, self.loop.run_in_executor, None, callback)
+
+    def _report_complete(self, runner):
+        returncode = runner['process'].returncode
+        if runner['on_complete']:
+            try:
+                runner['on_complete'](returncode)
+            except Exception as ex:
+                print('error completing command %s: %s' % (runner['id'], ex))
+        runner['future'].set_result(returncode)
+
+
+command_engine = CommandEngine()
+
+
+class ProcessSupervisor(object):
+    """launches, limits and reaps every command child process
+
+    at most process_max_running children run at once across all sessions
+    and at most process_max_per_session for one Socket.IO session. Other
+    requests wait in a FIFO queue of up to process_max_queued entries and
+    are sent 'queued' frames with their position. Each child leads its
+    own session and process group, so it is killed along with everything
+    it started, and runs with the configured nice level and rlimits.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.children = {}
+        self.by_sid = {}
+        self.running = 0
+        self.running_by_sid = {}
+        self.queue = deque()
+        # session ids of children, orphans still carry them after a kill
+        self.sessions = deque(maxlen=4096)
+        self.started = 0
+        self.queued = 0
+        self.rejected = 0
+        self.reaped = 0
+
+    def limits(self):
+        # a session lives on one worker, its limit is not split
+        return (per_worker(current_config().get('process_max_running', 16)),
+                int(current_config().get('process_max_per_session', 4)),
+                per_worker(current_config().get('process_max_queued', 64)))
+
+    def _has_slot(self, sid):
+        max_running, max_per_session, _ = self.limits()
+        return self.running < max_running and \
+            self.running_by_sid.get(sid, 0) < max_per_session
+
+    def _reserve(self, sid):
+        self.running += 1
+        self.running_by_sid[sid] = self.running_by_sid.get(sid, 0) + 1
+
+    def admit(self, sid, id, on_admit, on_cancel=None):
+        """calls on_admit once sid may start another child
+
+        returns False when the queue is full. on_cancel is called if the
+        request is dropped from the queue before it starts.
+        """
+        ticket = {'sid': sid, 'id': id,
+                  'on_admit': on_admit, 'on_cancel': on_cancel}
+        with self.lock:
+            if self._has_slot(sid):
+                self._reserve(sid)
+                queued = False
+            elif len(self.queue) >= self.limits()[2]:
+                self.rejected += 1
+                return False
+            else:
+                self.queue.append(ticket)
+                self.queued += 1
+                queued = True
+        if queued:
+            self._report_positions()
+        else:
+            self._start(ticket)
+        return True
+
+    def wait_for_slot(self, sid, id, cancel_event=None):
+        """blocks until sid may start another child, False if it may not"""
+        admitted = Event()
+        cancelled = Event()
+
+        def on_cancel():
+            cancelled.set()
+            admitted.set()
+        if not self.admit(sid, id, admitted.set, on_cancel):
+            return False
+        while not admitted.wait(0.5):
+            if cancel_event and cancel_event.is_set():
+                self.cancel(sid, id)
+        return not cancelled.is_set()
+
+    def _start(self, ticket):
+        try:
+            ticket['on_admit']()
+        except Exception as ex:
+            print('error starting command %s: %s' % (ticket['id'], ex))
+            self.release(ticket['sid'])
+            if ticket['on_cancel']:
+                ticket['on_cancel']()
+
+    def _report_positions(self):
+        with self.lock:
+            positions = [(t['sid'], t['id'], i + 1)
+                         for i, t in enumerate(self.queue)]
+        for sid, id, position in positions:
+            if id is None:
+                continue
+            websocket.emit('commandResponse', {
+                'id': id,
+                'stream': 'queued',
+                'data': position
+            }, to=sid, namespace='/')
+
+    def child_limits(self):
+        """the nice level and (prlimit option, resource, value) limits for a new child"""
+        nice = int(current_config().get('process_nice', 0))
+        rlimits = []
+        for limit, option, key in [(resource.RLIMIT_CPU, 'cpu', 'process_cpu_seconds'),
+                                   (resource.RLIMIT_AS, 'as', 'process_memory_bytes')]:
+            value = int(current_config().get(key, 0))
+            if value > 0:
+                hard = resource.getrlimit(limit)[1]
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+                rlimits.append((option, limit, value))
+        return nice, rlimits
+
+    def launch(self, sid, cmd, env=None, universal_newlines=False):
+        """starts cmd in a slot already granted to sid by admit
+
+        a preexec_fn could deadlock the forked child of this multithreaded
+        process, so the nice level and rlimits are applied by running the
+        shell under nice and prlimit instead.
+        """
+        nice, rlimits = self.child_limits()
+        argv = ['/bin/sh', '-c', cmd]
+        if rlimits and PRLIMIT:
+            argv = [PRLIMIT] + ['--%s=%d' % (option, value)
+                                for option, _, value in rlimits] + ['--'] + argv
+        if nice:
+            argv = ['nice', '-n', str(nice)] + argv
+        process = subprocess.Popen(
+            argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            bufsize=0 if not universal_newlines else -1, env=env,
+            universal_newlines=universal_newlines, start_new_session=True)
+        if rlimits and not PRLIMIT:
+            # without prlimit, applied as soon as the child is running
+            try:
+                child = psutil.Process(process.pid)
+                for _, limit, value in rlimits:
+                    child.rlimit(limit, (value, value))
+            except psutil.Error as pe:
+                print('could not limit process id: %d - %s' % (process.pid, pe))
+        with self.lock:
+            self.children[process.pid] = {'sid': sid, 'process': process, 'runner': None}
+            self.by_sid.setdefault(sid, set()).add(process.pid)
+            self.sessions.append(process.pid)
+            self.started += 1
+        return process
+
+    def set_runner(self, pid, runner):
+        with self.lock:
+            if pid in self.children:
+                self.children[pid]['runner'] = runner
+
+    def release(self, sid, pid=None):
+        """frees the slot held by sid and admits queued requests"""
+        admitted = []
+        with self.lock:
+            if pid is not None:
+                self.children.pop(pid, None)
+                pids = self.by_sid.get(sid)
+                if pids is not None:
+                    pids.discard(pid)
+                    if not pids:
+                        del self.by_sid[sid]
+            self.running -= 1
+            self.running_by_sid[sid] -= 1
+            if not self.running_by_sid[sid]:
+                del self.running_by_sid[sid]
+            for ticket in list(self.queue):
+                if self._has_slot(ticket['sid']):
+                    self.queue.remove(ticket)
+                    self._reserve(ticket['sid'])
+                    admitted.append(ticket)
+        for ticket in admitted:
+            self._start(ticket)
+        if admitted:
+            self._report_positions()
+
+    def cancel(self, sid, id=None):
+        """drops queued requests of sid, or only the one with id"""
+        with self.lock:
+            cancelled = [t for t in self.queue if t['sid'] == sid and
+                         (id is None or t['id'] == id)]
+            for ticket in cancelled:
+                self.queue.remove(ticket)
+        for ticket in cancelled:
+            if ticket['on_cancel']:
+                ticket['on_cancel']()
+        if cancelled:
+            self._report_positions()
+
+    def kill(self, pid):
+        print('destroying process id: %d' % pid)
+        with self.lock:
+            entry = self.children.get(pid)
+            if entry is None:
+                return
+            if entry['runner']:
+                # stop sending output, the engine completes the runner once it exits
+                entry['runner']['killed'] = True
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def kill_session(self, sid):
+        self.cancel(sid)
+        with self.lock:
+            pids = list(self.by_sid.get(sid, ()))
+        for pid in pids:
+            self.kill(pid)
+
+    def become_subreaper(self):
+        """reparent orphaned grandchildren to this process so they are reaped here"""
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+                print('could not become child subreaper: %s' %
+                      os.strerror(ctypes.get_errno()))
+        except (OSError, AttributeError) as ex:
+            print('could not become child subreaper: %s' % ex)
+
+    def reap(self):
+        """waits on zombie orphans left behind by commands"""
+        with self.lock:
+            tracked = set(self.children)
+            sessions = set(self.sessions)
+        try:
+            children = psutil.Process().children()
+        except psutil.Error:
+            return
+        for child in children:
+            if child.pid in tracked:
+                continue
+            try:
+                if child.status() != psutil.STATUS_ZOMBIE or \
+                        os.getsid(child.pid) not in sessions:
+                    continue
+                if os.waitpid(child.pid, os.WNOHANG)[0]:
+                    self.reaped += 1
+            except (psutil.Error, OSError):
+                pass
+
+    def stats(self):
+        max_running, max_per_session, max_queued = self.limits()
+        with self.lock:
+            return {
+                'running': self.running,
+                'max_running': max_running,
+                'max_per_session': max_per_session,
+                'sessions': len(self.running_by_sid),
+                'queued': len(self.queue),
+                'max_queued': max_queued,
+                'started': self.started,
+                'queued_total': self.queued,
+                'rejected': self.rejected,
+                'reaped': self.reaped
+            }
+
+
+PRLIMIT = shutil.which('prlimit')
+process_supervisor = ProcessSupervisor()
+metrics.callback(
+    'demo_runner_child_processes',
+    'command processes running or waiting for a slot, by state',
+    lambda: dict(((state,), process_supervisor.stats()[state])
+                 for state in ['running', 'queued']),
+    ('state',))
+metrics.callback(
+    'demo_runner_child_processes_started_total',
+    'command processes started', lambda: process_supervisor.stats()['started'],
+    kind='counter')
+metrics.callback(
+    'demo_runner_child_processes_rejected_total',
+    'command requests rejected because the queue was full',
+    lambda: process_supervisor.stats()['rejected'], kind='counter')
+metrics.callback(
+    'demo_runner_output_buffered_bytes',
+    'command output waiting for slow clients',
+    lambda: output_buffer_metrics['buffered_bytes'])
+PR_SET_CHILD_SUBREAPER = 36
+
+
+def reap_orphaned_children():
+    process_supervisor.reap()
+    command_engine.run_later(10, reap_orphaned_children)
+
+
+class Scrollback(object):
+    """sequence numbered output log of each command, kept for reconnects
+
+    every frame sent for a command is numbered and logged. While the
+    client is connected only the last attached_bytes are kept, enough to
+    cover frames lost in the moments before a disconnect is noticed. When
+    a client disconnects its running commands are detached, keep running
+    for grace_seconds and log up to max_bytes of output each; a client
+    sending a 'resume' request with the command id and the last seq it
+    received is attached to the command and sent the frames it missed.
+    """
+
+    def __init__(self, max_bytes=1048576, grace_seconds=120, max_commands=64,
+                 attached_bytes=65536):
+        self.max_bytes = max_bytes
+        self.attached_bytes = min(attached_bytes, max_bytes)
+        self.grace_seconds = grace_seconds
+        self.max_commands = max_commands
+        self.lock = Lock()
+        self.logs = OrderedDict()
+        self.resumed = 0
+        self.expired = 0
+
+    def open(self, sid, id):
+        log = {
+            'origin': sid,
+            'sid': sid,
+            'id': id,
+            'seq': 0,
+            'frames': deque(),
+            'bytes': 0,
+            'completed': None,
+            'detached': None
+        }
+        with self.lock:
+            self.logs.pop((sid, str(id)), None)
+            self.logs[(sid, str(id))] = log
+            while len(self.logs) > self.max_commands:
+                self.logs.popitem(last=False)
+        return log
+
+    def current_sid(self, origin, id):
+        log = self.logs.get((origin, str(id)))
+        return log['sid'] if log else origin
+
+    def origins(self, sid):
+        """the sessions that started commands now attached to sid"""
+        with self.lock:
+            return set([sid] + [log['origin'] for log in self.logs.values()
+                                if log['sid'] == sid])
+
+    def emit(self, origin, id, response):
+        with self.lock:
+            log = self.logs.get((origin, str(id)))
+            if log is None:
+                sid = origin
+                detached = None
+            else:
+                log['seq'] += 1
+                response = dict(response, seq=log['seq'])
+                size = len(response['data']) if isinstance(response['data'], str) else 0
+                log['frames'].append((response, size))
+                log['bytes'] += size
+                sid = log['sid']
+                detached = log['detached']
+                max_bytes = self.max_bytes if detached else self.attached_bytes
+                while log['bytes'] > max_bytes and len(log['frames']) > 1:
+                    log['bytes'] -= log['frames'].popleft()[1]
+                if response['stream'] == 'completed':
+                    log['completed'] = monotonic()
+        if not detached:
+            websocket.emit('commandResponse', response, to=sid, namespace='/')
+            count_emitted(response)
+
+    def detach(self, sid):
+        """detaches the running commands of sid, True if there were any"""
+        detached = False
+        with self.lock:
+            for log in self.logs.values():
+                if log['sid'] == sid and not log['completed']:
+                    log['detached'] = monotonic()
+                    detached = True
+        return detached
+
+    def resume(self, sid, id, last_seq):
+        """attaches the detached command id to sid and replays missed frames"""
+        with self.lock:
+            candidates = [log for log in self.logs.values()
+                          if str(log['id']) == str(id) and log['detached']]
+            if not candidates:
+                return None
+            log = max(candidates, key=lambda lg: lg['detached'])
+            log['sid'] = sid
+            log['detached'] = None
+            missed = [frame for frame, _ in log['frames'] if frame['seq'] > last_seq]
+            first_seq = log['frames'][0][0]['seq'] if log['frames'] else log['seq'] + 1
+            self.resumed += 1
+        if first_seq > last_seq + 1:
+            websocket.emit('commandResponse', {
+                'id': id,
+                'stream': 'stderr',
+                'data': "\n[... output before seq %d is no longer available ...]\n" % first_seq
+            }, to=sid, namespace='/')
+        for frame in missed:
+            websocket.emit('commandResponse', frame, to=sid, namespace='/')
+            count_emitted(frame)
+        return log
+
+    def sweep(self):
+        """kills commands detached past the grace period, drops old logs"""
+        now = monotonic()
+        expired = []
+        with self.lock:
+            for key, log in list(self.logs.items()):
+                if log['detached'] and not log['completed'] and \
+                        now - log['detached'] > self.grace_seconds:
+                    expired.append(log['origin'])
+                    log['detached'] = now
+                elif log['completed'] and now - log['completed'] > self.grace_seconds:
+                    del self.logs[key]
+        for origin in expired:
+            print('resume grace period over, destroying commands for sid: %s' % origin)
+            self.expired += 1
+            process_supervisor.kill_session(origin)
+        command_engine.loop.call_later(1.0, self.sweep)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'commands': len(self.logs),
+                'detached': len([log for log in self.logs.values() if log['detached']]),
+                'bytes': sum(log['bytes'] for log in self.logs.values()),
+                'resumed': self.resumed,
+                'expired': self.expired
+            }
+
+
+scrollback = Scrollback(int(config.get('scrollback_max_bytes', 1048576)),
+                        float(config.get('resume_grace_seconds', 120)),
+                        int(config.get('scrollback_max_commands', 64)),
+                        int(config.get('scrollback_attached_bytes', 65536)))
+
+
+CACHE_SID = 'command-cache'
+# words a shell reads the same whether or not they are quoted
+PLAIN_WORD = re.compile(r'^[\w@%+=:,./-]+$')
+
+
+class CommandResultCache(object):
+    """captured output of read-only commands, shared across sessions
+
+    commands matching a cacheable_commands regular expression are run
+    once per ttl seconds. Concurrent requests for the same command share
+    one execution, and the captured output is replayed to every session
+    as ordinary commandResponse frames. Commands made of plain words are
+    keyed with their spacing and quoting normalized.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = {}
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.executor = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix='command-cache')
+
+    def key_for(self, cmd):
+        """the command as the cache sees it, the same command a shell would run"""
+        try:
+            words = shlex.split(cmd)
+        except ValueError:
+            return cmd.strip()
+        if words and all(PLAIN_WORD.match(word) for word in words):
+            return ' '.join(words)
+        return cmd.strip()
+
+    def ttl_for(self, cmd):
+        cmd = self.key_for(cmd)
+        for regex, ttl in (current_config().get('cacheable_commands', {}) or {}).items():
+            if re.match(r"%s" % regex, cmd):
+                return float(ttl)
+        return None
+
+    def get(self, cmd, ttl):
+        cmd = self.key_for(cmd)
+        now = monotonic()
+        with self.lock:
+            entry = self.entries.get(cmd)
+            if entry and entry['expires'] > now:
+                self.hits += 1
+                future = Future()
+                future.set_result(entry)
+                return future
+            if cmd in self.in_flight:
+                self.shared += 1
+                return self.in_flight[cmd]
+            self.misses += 1
+            for key in [k for k, e in self.entries.items() if e['expires'] <= now]:
+                del self.entries[key]
+            future = Future()
+            self.in_flight[cmd] = future
+        self.executor.submit(self.execute, cmd, ttl, future)
+        return future
+
+    def execute(self, cmd, ttl, future):
+        try:
+            if not process_supervisor.wait_for_slot(CACHE_SID, None):
+                raise RuntimeError('too many commands queued on server')
+            try:
+                process = process_supervisor.launch(CACHE_SID, cmd)
+            except Exception:
+                process_supervisor.release(CACHE_SID)
+                raise
+            try:
+                stdout, stderr = process.communicate()
+            finally:
+                process_supervisor.release(CACHE_SID, process.pid)
+            frames = []
+            for stream, output in [('stdout', stdout), ('stderr', stderr)]:
+                if output:
+                    frames.append((stream, output.decode('utf-8', errors='replace')))
+            result = {
+                'frames': frames,
+                'returncode': process.returncode,
+                'expires': monotonic() + ttl
+            }
+            with self.lock:
+                # failures are not cached, the next request runs the command again
+                if process.returncode == 0:
+                    self.entries[cmd] = result
+                del self.in_flight[cmd]
+            future.set_result(result)
+        except Exception as ex:
+            with self.lock:
+                del self.in_flight[cmd]
+            future.set_exception(ex)
+
+    def run(self, sid, id, cmd, ttl, on_complete=None):
+        """replays cmd's cached or shared output to sid like run_cmd would"""
+        future = Future()
+
+        def replay(done):
+            try:
+                result = done.result()
+                for stream, data in result['frames']:
+                    scrollback.emit(sid, id, {
+                        'id': id,
+                        'stream': stream,
+                        'data': data
+                    })
+                returncode = result['returncode']
+            except Exception as ex:
+                scrollback.emit(sid, id, {
+                    'id': id,
+                    'stream': 'stderr',
+                    'data': "command: %s failed - %s\n" % (cmd, ex)
+                })
+                returncode = -1
+            if on_complete:
+                on_complete(returncode)
+            future.set_result(returncode)
+        self.get(cmd, ttl).add_done_callback(replay)
+        return future
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'in_flight': len(self.in_flight),
+                'hits': self.hits,
+                'shared': self.shared,
+                'misses': self.misses
+            }
+
+
+command_cache = CommandResultCache()
+
+
+class BrowserPool(object):
+    """long lived headless Chromium serving screenshots from warm pages
+
+    runs on the command engine loop, at most max_pages captures run at once,
+    stuck pages are closed after page_timeout seconds and the browser is
+    relaunched once it has served recycle_after captures and the captures
+    in flight have finished.
+    """
+
+    def __init__(self, loop, max_pages=2, page_timeout=30, recycle_after=50):
+        self.loop = loop
+        self.max_pages = max_pages
+        self.page_timeout = page_timeout
+        self.recycle_after = recycle_after
+        self.browser = None
+        self.pages = []
+        self.uses = 0
+        self.active = 0
+        self.slots = None
+        self.launching = None
+        self.idle = None
+
+    async def get_browser(self):
+        if self.launching is None:
+            self.launching = asyncio.Lock()
+            self.idle = asyncio.Event()
+        async with self.launching:
+            if self.browser and self.uses >= self.recycle_after:
+                # hold new captures until the ones in flight are done
+                while self.active:
+                    self.idle.clear()
+                    await self.idle.wait()
+                print('recycling headless browser after %d screenshots' %
+                      self.uses)
+                await self.close()
+            if self.browser is None:
+                # signal handlers can only be installed from the main thread
+                self.browser = await launch_browser(
+                    handleSIGINT=False, handleSIGTERM=False, handleSIGHUP=False,
+                    **BROWSER_LAUNCH_OPTIONS)
+                self.uses = 0
+            return self.browser
+
+    async def close(self):
+        browser = self.browser
+        self.browser = None
+        self.pages = []
+        if browser:
+            try:
+                await browser.close()
+            except Exception as ex:
+                print('error closing headless browser: %s' % ex)
+
+    async def capture(self, url, screen_shot_file_path):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_pages)
+        async with self.slots:
+            browser = await self.get_browser()
+            page = None
+            if self.pages:
+                page = self.pages.pop()
+            else:
+                page = await browser.newPage()
+            self.active += 1
+            try:
+                await asyncio.wait_for(
+                    take_screenshot(page, url, screen_shot_file_path), self.page_timeout)
+                await page.goto('about:blank')
+                if browser is self.browser:
+                    self.pages.append(page)
+                else:
+                    await page.close()
+            except BaseException:
+                # also when the capture is cancelled, the page may be mid load
+                try:
+                    await page.close()
+                except Exception:
+                    pass
+                raise
+            finally:
+                self.active -= 1
+                self.uses += 1
+                if not self.active:
+                    self.idle.set()
+
+
+class ScreenshotCache(object):
+    """screenshot files reused for ttl seconds, capped at max_bytes on disk
+
+    concurrent requests for the same URL share a single capture, which is
+    cancelled once every request waiting for it has been cancelled. files
+    are evicted least recently used first once the cap is reached and
+    deleted after retention seconds.
+    """
+
+    def __init__(self, loop, directory, ttl=60, max_bytes=268435456, retention=600):
+        self.loop = loop
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.files = OrderedDict()
+        self.in_flight = {}
+        # futures of the screenshot requests of each session, for halts
+        self.requests = {}
+        self.requests_lock = Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+        if os.path.exists(directory):
+            existing = []
+            for entry in os.scandir(directory):
+                if entry.is_file() and entry.name.endswith('.jpg'):
+                    stat = entry.stat()
+                    existing.append((stat.st_mtime, entry.name, stat.st_size))
+            for captured, name, size in sorted(existing):
+                self.files[name] = {'size': size, 'captured': captured}
+                self.total_bytes += size
+
+    def file_name(self, url):
+        return "%s.jpg" % hashlib.sha256(url.encode()).hexdigest()
+
+    def screenshot(self, sid, url, capture):
+        future = asyncio.run_coroutine_threadsafe(self.get(url, capture), self.loop)
+        with self.requests_lock:
+            self.requests.setdefault(sid, set()).add(future)
+        future.add_done_callback(lambda done: self._request_done(sid, done))
+        return future
+
+    def _request_done(self, sid, future):
+        with self.requests_lock:
+            futures = self.requests.get(sid)
+            if futures is not None:
+                futures.discard(future)
+                if not futures:
+                    del self.requests[sid]
+
+    def cancel(self, sid):
+        """cancels the screenshot requests of sid"""
+        with self.requests_lock:
+            futures = list(self.requests.get(sid, ()))
+        for future in futures:
+            future.cancel()
+
+    def touch(self, name):
+        self.loop.call_soon_threadsafe(self._touch, name)
 
-from werkzeug.utils import secure_filename
-from urllib.parse import urlparse
-from urllib.parse import parse_qs
-from urllib.error import URLError
+    def _touch(self, name):
+        if name in self.files:
+            self.files.move_to_end(name)
 
-from flask import Flask, request, render_template, Response, send_from_directory
-from flask_compress import Compress
-from flask_socketio import SocketIO, emit
+    async def get(self, url, capture):
+        name = self.file_name(url)
+        entry = self.files.get(name)
+        if entry and time.time() - entry['captured'] < self.ttl:
+            self.files.move_to_end(name)
+            self.hits += 1
+            return name
+        flight = self.in_flight.get(name)
+        if flight:
+            self.shared += 1
+        else:
+            self.misses += 1
+            flight = {
+                'task': self.loop.create_task(self.capture(name, url, capture)),
+                'waiters': 0
+            }
+            self.in_flight[name] = flight
+        flight['waiters'] += 1
+        try:
+            return await asyncio.shield(flight['task'])
+        finally:
+            flight['waiters'] -= 1
+            if not flight['waiters'] and not flight['task'].done():
+                # every request for it was cancelled
+                flight['task'].cancel()
 
-from threading import Thread, Event
+    async def capture(self, name, url, capture):
+        path = os.path.join(self.directory, name)
+        # capture aside so nobody is served a half written file
+        capture_path = "%s.capture.jpg" % path[:-len('.jpg')]
+        try:
+            await capture(url, capture_path)
+            os.replace(capture_path, path)
+            self._remove_entry(name)
+            size = os.path.getsize(path)
+            self.files[name] = {'size': size, 'captured': time.time()}
+            self.total_bytes += size
+            self.enforce_limits()
+            return name
+        except BaseException:
+            try:
+                os.unlink(capture_path)
+            except OSError:
+                pass
+            raise
+        finally:
+            del self.in_flight[name]
 
-from psycopg2 import connect
-from sqlalchemy import create_engine
-from pymongo import MongoClient
-from azure.cosmos import CosmosClient as cosmos_client
-from azure.cosmos import exceptions as cosmos_exceptions
+    def _remove_entry(self, name):
+        entry = self.files.pop(name, None)
+        if entry:
+            self.total_bytes -= entry['size']
 
-CONFIG_FILE = os.getenv('CONFIG_FILE', './config.yaml')
-CONFIG_MAP_DIR = '/etc/container-demo-runner'
-NAMESPACE_FILE = '/var/run/secrets/kubernetes.io/serviceaccount/namespace'
-PUPPETEER_HOME = os.getenv('PYPPETEER_HOME', '/tmp/webscreenshots')
+    def _delete(self, name):
+        self._remove_entry(name)
+        self.evictions += 1
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except OSError:
+            pass
 
-UPLOAD_FOLDER = "%s/uploads" % (tempfile.gettempdir())
+    def enforce_limits(self):
+        expired_before = time.time() - self.retention
+        for name in list(self.files.keys()):
+            if self.files[name]['captured'] < expired_before:
+                self._delete(name)
+        while self.total_bytes > self.max_bytes and len(self.files) > 1:
+            self._delete(next(iter(self.files)))
 
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER, mode=0o777)
+    def sweep(self):
+        self.enforce_limits()
+        self.loop.call_later(60, self.sweep)
 
-config = {}
 
-with open(CONFIG_FILE, 'r') as config_yaml:
-    config = yaml.safe_load(config_yaml)
+browser_pool = None
+if launch_browser:
+    browser_pool = BrowserPool(
+        command_engine.loop,
+        int(config.get('screenshot_max_concurrency', 2)),
+        float(config.get('screenshot_page_timeout', 30)),
+        int(config.get('screenshot_recycle_after', 50)))
 
-if os.path.exists(CONFIG_MAP_DIR):
-    for ck in config.keys():
-        if os.path.exists("%s/%s" % (CONFIG_MAP_DIR, ck)):
-            with open("%s/%s" % (CONFIG_MAP_DIR, ck), 'r') as cmv:
-                cv = cmv.read()
-                if isinstance(config[ck], list):
-                    try:
-                        cv = json.loads(cv)
-                        print(
-                            'loading config setting: %s from ConfigMap value: %s' % (ck, cv))
-                        config[ck] = cv
-                    except json.JSONDecodeError as jde:
-                        print('error reading %s from ConfigMap: ' % (ck, jde))
-                else:
-                    print(
-                        'loading config setting: %s from ConfigMap value: %s' % (ck, cv))
-                    config[ck] = cv
+if not os.path.exists(PUPPETEER_HOME):
+    os.makedirs(PUPPETEER_HOME)
+screenshot_cache = ScreenshotCache(
+    command_engine.loop, PUPPETEER_HOME,
+    float(config.get('screenshot_cache_ttl', 60)),
+    int(config.get('screenshot_cache_max_bytes', 268435456)),
+    float(config.get('screenshot_retention_seconds', 600)))
 
-if 'host_entries' in config:
-    with open('/etc/hosts', 'a+') as eh:
-        eh.write('\n#### entries added by container-demo-runner ####\n')
-        eh.write(config['host_entries'])
-        eh.write('\n#### end entries added by container-demo-runner ####\n')
 
-app = Flask(__name__)
-Compress(app)
-websocket = SocketIO(app, cors_allowed_origins='*', async_mode='threading')
+def destroy_all_processes_for_sid(sid, broadcast=True):
+    cancel_performance_test(sid)
+    screenshot_cache.cancel(sid)
+    # includes commands resumed into sid from an earlier connection
+    for origin in scrollback.origins(sid):
+        process_supervisor.kill_session(origin)
+    if broadcast and control_bus.shared:
+        # commands resumed into sid may be owned by another worker
+        control_bus.publish('halt', sid=sid)
 
-pids_by_sid = {}
-runners = {}
 
+def detach_or_destroy_sid(sid, broadcast=True):
+    if scrollback.grace_seconds > 0 and scrollback.detach(sid):
+        # running commands stay up so a reconnecting client can resume them
+        print('keeping commands for sid: %s for %d seconds' %
+              (sid, scrollback.grace_seconds))
+        cancel_performance_test(sid)
+        screenshot_cache.cancel(sid)
+    else:
+        destroy_all_processes_for_sid(sid, broadcast=False)
+    if broadcast and control_bus.shared:
+        control_bus.publish('disconnect', sid=sid)
 
-def root_dir():  # pragma: no cover
-    return os.path.abspath(os.path.dirname(__file__))
 
+# resume requests waiting for the owning worker, only used on the engine loop
+pending_resumes = {}
 
-def get_file(filename):  # pragma: no cover
-    try:
-        src = os.path.join(root_dir(), filename)
-        return open(src, mode='rb').read()
-    except IOError as exc:
-        return str(exc)
 
+def resume_failed(sid, id):
+    websocket.emit('commandResponse', {
+        'id': id,
+        'stream': 'stderr',
+        'data': "command: %s can not be resumed, it is gone or was never started." % id
+    }, to=sid, namespace='/')
+    websocket.emit('commandResponse', {
+        'id': id,
+        'stream': 'completed',
+        'data': -1
+    }, to=sid, namespace='/')
 
-def get_hostname():
-    hostname = socket.gethostname()
-    print('found hostname: %s' % hostname)
-    if os.path.exists(NAMESPACE_FILE):
-        print('running in K8s, adding namespace to hostname')
-        with open(NAMESPACE_FILE, 'r') as nsf:
-            hostname = "%s/%s" % (
-                re.sub(r"[\n\t\s]*", "", nsf.read()), hostname)
-    return hostname
 
+def resume_command(sid, id, seq):
+    if scrollback.resume(sid, id, seq):
+        return
+    if not control_bus.shared:
+        resume_failed(sid, id)
+        return
+    # ask the other workers, fail if none of them owns the command
+    key = (sid, str(id))
+    timeout = float(current_config().get('resume_owner_timeout', 2))
 
-def get_nameserver():
-    nameserver = dns.resolver.Resolver().nameservers[0]
-    print('found nameserver: %s' % nameserver)
-    return nameserver
+    def wait_for_owner():
+        pending_resumes[key] = command_engine.loop.call_later(
+            timeout, resume_timeout, sid, id)
+    command_engine.loop.call_soon_threadsafe(wait_for_owner)
+    control_bus.publish('resume', sid=sid, id=id, seq=seq)
 
 
-def dig_fqdn(fqdn, record_type='A'):
-    try:
-        result = dns.resolver.query(fqdn, record_type)
-        return str(result[0])
-    except dns.resolver.NoAnswer:
-        return None
-    except Exception:
-        return None
+def resume_timeout(sid, id):
+    if pending_resumes.pop((sid, str(id)), None):
+        resume_failed(sid, id)
 
 
-def stream_emitter(id, event, stream_type, stream):
-    print("started background thread to stream %s" % stream_type)
-    while not event.is_set():
-        line = stream.readline()
-        if not line or event.is_set():
-            break
-        response = {
-            'id': id,
-            'stream': stream_type,
-            'data': line
-        }
-        websocket.emit('commandResponse', response, namespace='/')
-    event.set()
-
-
-def destroy_pid(pid):
-    print('destroying process id: %d' % pid)
-    if pid in runners.keys():
-        process_runner = runners[pid]
-        if process_runner['stdout_thread'].is_alive():
-            process_runner['stdout_kill_event'].set()
-        if process_runner['stderr_thread'].is_alive():
-            process_runner['stderr_kill_event'].set()
-        del process_runner['stdout_thread']
-        del process_runner['stdout_kill_event']
-        del process_runner['stderr_thread']
-        del process_runner['stderr_kill_event']
-        parent = psutil.Process(pid)
-        for child in parent.children(recursive=True):
-            child.kill()
-        parent.kill()
-        del runners[pid]
-    else:
-        parent = psutil.Process(pid)
-        for child in parent.children(recursive=True):
-            child.kill()
-        parent.kill()
+def control_halt(message):
+    if message['worker'] != WORKER_ID:
+        destroy_all_processes_for_sid(message['sid'], broadcast=False)
+
+
+def control_disconnect(message):
+    if message['worker'] != WORKER_ID:
+        detach_or_destroy_sid(message['sid'], broadcast=False)
+
+
+def control_resume(message):
+    if message['worker'] != WORKER_ID and \
+            scrollback.resume(message['sid'], message['id'], message['seq']):
+        control_bus.publish('resumed', sid=message['sid'], id=message['id'])
+
+
+def control_resumed(message):
+    def cancel():
+        timer = pending_resumes.pop((message['sid'], str(message['id'])), None)
+        if timer:
+            timer.cancel()
+    command_engine.loop.call_soon_threadsafe(cancel)
 
 
-def destroy_all_processes_for_sid(sid):
-    if sid in pids_by_sid.keys():
-        for pid in pids_by_sid[sid]:
-            if psutil.pid_exists(pid):
-                destroy_pid(pid)
-        del pids_by_sid[sid]
+control_bus.on('halt', control_halt)
+control_bus.on('disconnect', control_disconnect)
+control_bus.on('resume', control_resume)
+control_bus.on('resumed', control_resumed)
 
 
+command_matcher = AllowlistMatcher(config.get('allowed_commands'))
+command_matcher_lock = Lock()
+
+
+def get_command_matcher():
+    """the compiled allowlist of current_config(), rebuilt when allowed_commands is replaced"""
+    global command_matcher
+    rules = current_config().get('allowed_commands')
+    matcher = command_matcher
+    if matcher.source is not rules:
+        with command_matcher_lock:
+            if rules is not config.get('allowed_commands'):
+                # a request that started before a reload keeps its own rules
+                return AllowlistMatcher(rules)
+            if command_matcher.source is not rules:
+                command_matcher = AllowlistMatcher(rules)
+            matcher = command_matcher
+    return matcher
+
+
+def reload_config():
+    """swaps in a new config holding the changed ConfigMap settings
+
+    the new config and the structures derived from it are built first and
+    swapped in together. Requests and messages read the config they
+    started with through current_config(), so each sees either the old
+    or the new settings and never a mix of both.
+    """
+    global config, command_matcher
+    changed, removed = read_config_map(config_map_raw, config_map_loaded)
+    if not changed and not removed:
+        return []
+    new_config = dict(config)
+    new_config.update(changed)
+    for ck in removed:
+        new_config.pop(ck, None)
+    matcher = command_matcher
+    if 'allowed_commands' in changed or 'allowed_commands' in removed:
+        matcher = AllowlistMatcher(new_config.get('allowed_commands'))
+    if 'host_entries' in changed or 'host_entries' in removed:
+        write_host_entries(new_config.get('host_entries'))
+    with command_matcher_lock:
+        config = new_config
+        command_matcher = matcher
+    keys = sorted(list(changed) + removed)
+    print('reloaded config settings: %s' % ', '.join(keys))
+    return keys
+
+
+def watch_config_map():
+    global config_map_loaded
+    interval = float(config.get('config_reload_interval', 5))
+    if interval <= 0:
+        return
+    version = config_map_version()
+    if version != config_map_loaded:
+        config_map_loaded = version
+        try:
+            reload_config()
+        except Exception as ex:
+            print('error reloading config from ConfigMap: %s' % ex)
+    command_engine.run_later(interval, watch_config_map)
+
+
+@traced
 def command_allowed(cmd):
+    """returns the allowed_commands rule matching cmd, or None"""
     if isinstance(cmd, list):
         cmd = shlex.join(cmd)
-    allowed = False
-    for regex in config['allowed_commands']:
-        if re.match(r"%s" % regex, cmd):
-            allowed = True
-            break
-    return allowed
+    return get_command_matcher().match(cmd)
 
 
-def run_cmd(sid, cmd, id, env=None):
-    destroy_all_processes_for_sid(sid)
+@traced
+def run_cmd(sid, cmd, id, env=None, on_complete=None):
     if isinstance(cmd, list):
         cmd = shlex.join(cmd)
     print('running cmd: %s with id: %s' % (cmd, id))
-    process = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, universal_newlines=True, env=env)
-    pids_by_sid[sid] = [process.pid]
-    stdout_kill_event = Event()
-    stderr_kill_event = Event()
-    process_runner = {
-        'stdout_kill_event': stdout_kill_event,
-        'stdout_thread': websocket.start_background_task(
-            stream_emitter, id, stdout_kill_event, 'stdout', process.stdout),
-        'stderr_kill_event': Event(),
-        'stderr_thread': websocket.start_background_task(
-            stream_emitter, id, stderr_kill_event, 'stderr', process.stderr)
-    }
-    runners[process.pid] = process_runner
-    process.wait()
-    return process.returncode
+    batch = get_output_batch_settings(cmd)
+    scrollback.open(sid, id)
+    ttl = command_cache.ttl_for(cmd) if env is None else None
+    if ttl:
+        print('serving cmd: %s from the command cache for up to %.1f seconds' % (cmd, ttl))
+        return command_cache.run(sid, id, cmd, ttl, on_complete)
+    future = Future()
+
+    def start():
+        process = process_supervisor.launch(sid, cmd, env)
+        command_engine.start(sid, id, process, batch, on_complete).add_done_callback(
+            lambda done: future.set_result(done.result()))
+
+    def cancel():
+        if on_complete:
+            on_complete(-1)
+        future.set_result(-1)
+
+    # starts right away when a slot is free, otherwise once one frees up
+    if not process_supervisor.admit(sid, id, start, cancel):
+        websocket.emit('commandResponse', {
+            'id': id,
+            'stream': 'stderr',
+            'data': "too many commands queued on server, try again later.\n"
+        }, to=sid, namespace='/')
+        cancel()
+    return future
 
 
 def get_latency_from_ping_pong_output(output):
@@ -214,91 +2235,460 @@ def get_bandwidth_from_throughput_output(output):
         return ''
 
 
-def performance_test(sid, id, sourcelabel, targetlabel, target, port, runcount, latency, bandwidth):
-    destroy_all_processes_for_sid(sid)
+def get_percentiles_from_ping_pong_output(output):
+    percentiles = {}
+    for name, value in re.findall(r'---> (?:percentile )?(\S+)(?: observation)? =\s*([0-9.]+)', output):
+        if name == '<MAX>':
+            percentiles['max'] = float(value)
+        elif name == '<MIN>':
+            percentiles['min'] = float(value)
+        else:
+            percentiles['p%s' % ('%f' % float(name)).rstrip('0').rstrip('.')] = float(value)
+    return percentiles
+
+
+class LatencyHistogram(object):
+    """log-linear (HDR style) histogram of usec values, recorded as integer ns
+
+    counts are kept sparse by bucket index so histograms from many runs or
+    many hosts can be merged by adding their counts together.
+    """
+
+    REPORT_PERCENTILES = [50.0, 90.0, 99.0, 99.9]
+
+    def __init__(self, significant_digits=3):
+        self.significant_digits = significant_digits
+        self.sub_bucket_bits = math.ceil(
+            math.log2(2 * 10 ** significant_digits))
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def index_for(self, value):
+        bucket = max(0, value.bit_length() - self.sub_bucket_bits)
+        return (bucket << self.sub_bucket_bits) | (value >> bucket)
+
+    def value_for(self, index):
+        """highest value recorded into index"""
+        bucket = index >> self.sub_bucket_bits
+        sub_bucket = index & ((1 << self.sub_bucket_bits) - 1)
+        return ((sub_bucket + 1) << bucket) - 1
+
+    def record(self, usec, count=1):
+        value = max(0, int(usec * 1000))
+        index = self.index_for(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.total += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        return self
+
+    def percentile(self, percentile):
+        if not self.total:
+            return None
+        wanted = max(1, math.ceil(self.total * percentile / 100.0))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= wanted:
+                return min(self.value_for(index), self.max) / 1000.0
+        return self.max / 1000.0
+
+    def summary(self):
+        if not self.total:
+            return {'samples': 0}
+        summary = {
+            'samples': self.total,
+            'min': self.min / 1000.0,
+            'mean': round(self.sum / self.total / 1000.0, 3)
+        }
+        for percentile in self.REPORT_PERCENTILES:
+            summary['p%s' % ('%f' % percentile).rstrip('0').rstrip('.')] = self.percentile(percentile)
+        summary['max'] = self.max / 1000.0
+        return summary
+
+    def to_dict(self):
+        return {
+            'significant_digits': self.significant_digits,
+            'unit': 'ns',
+            'min': self.min,
+            'max': self.max,
+            'sum': self.sum,
+            'counts': self.counts
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data.get('significant_digits', 3))
+        histogram.counts = {int(i): c for i, c in data['counts'].items()}
+        histogram.total = sum(histogram.counts.values())
+        histogram.sum = data.get('sum', 0)
+        histogram.min = data.get('min')
+        histogram.max = data.get('max')
+        return histogram
+
+
+# native probe protocol, every frame is a one byte op and a payload length:
+#   P - ping, the server echoes the frame back
+#   T - throughput data, the server counts and discards the payload
+#   R - report, the server answers with an R frame holding the
+#       8 byte count of T payload bytes received since the last report
+PROBE_MAGIC = b'CDRP'
+PROBE_FRAME = struct.Struct('!cI')
+PROBE_COUNT = struct.Struct('!Q')
+# the largest frame the prober sends, the server drops peers sending more
+PROBE_MAX_MSG_SIZE = 1048576
+PROBE_MSG_SIZES = ['32768', '65536', '131072', '1048575']
+PROBE_MSG_SIZE_LABELS = {
+    '32768': '32k',
+    '65536': '64k',
+    '131072': '128k',
+    '1048575': '1M'
+}
+
+
+def recv_exactly(sock, length, buffer=None):
+    if buffer is None:
+        buffer = bytearray(length)
+    view = memoryview(buffer)[:length]
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return buffer
+
+
+class ProbeRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if recv_exactly(sock, len(PROBE_MAGIC)) != PROBE_MAGIC:
+            return
+        sock.sendall(PROBE_MAGIC)
+        header = bytearray(PROBE_FRAME.size)
+        payload = bytearray(65536)
+        counted = 0
+        while recv_exactly(sock, PROBE_FRAME.size, header):
+            op, length = PROBE_FRAME.unpack(header)
+            if length > PROBE_MAX_MSG_SIZE:
+                return
+            if op == b'P':
+                if len(payload) < length:
+                    payload = bytearray(length)
+                if not recv_exactly(sock, length, payload):
+                    return
+                sock.sendall(header + payload[:length])
+            elif op == b'T':
+                remaining = length
+                view = memoryview(payload)
+                while remaining:
+                    count = sock.recv_into(
+                        view[:min(remaining, len(payload))])
+                    if not count:
+                        return
+                    remaining -= count
+                counted += length
+            elif op == b'R':
+                sock.sendall(PROBE_FRAME.pack(b'R', PROBE_COUNT.size) +
+                             PROBE_COUNT.pack(counted))
+                counted = 0
+            else:
+                return
+
+
+class ProbeServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def start_probe_server():
+    port = int(current_config().get('probe_listen_port', 0))
+    if not port:
+        return None
+    server = ProbeServer(
+        (current_config().get('probe_listen_address', '0.0.0.0'), port), ProbeRequestHandler)
+    print('native probe server listening on %s:%d' % server.server_address)
+    Thread(target=server.serve_forever,
+           name='probe-server', daemon=True).start()
+    return server
+
+
+class NativeProber(object):
+    """client side of the native probe protocol
+
+    every read waits at most read_timeout seconds, a server that stops
+    answering fails the measurement with a ConnectionError.
+    """
+
+    def __init__(self, target, port, timeout=None, read_timeout=None):
+        if timeout is None:
+            timeout = float(current_config().get('probe_handshake_timeout', 2))
+        if read_timeout is None:
+            read_timeout = float(current_config().get('probe_read_timeout', 10))
+        self.read_timeout = read_timeout
+        self.sock = socket.create_connection((target, port), timeout=timeout)
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock.sendall(PROBE_MAGIC)
+            if recv_exactly(self.sock, len(PROBE_MAGIC)) != PROBE_MAGIC:
+                raise ConnectionError(
+                    '%s:%d is not a native probe server' % (target, port))
+            self.sock.settimeout(read_timeout)
+        except Exception:
+            self.sock.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def timed_out(self):
+        return ConnectionError(
+            'probe server did not answer within %s seconds' % self.read_timeout)
+
+    def ping_pong(self, duration=1.0, msg_size=14, cancel_event=None):
+        """returns one way latency samples in usec, half of each round trip"""
+        frame = PROBE_FRAME.pack(b'P', msg_size) + bytes(msg_size)
+        reply = bytearray(len(frame))
+        samples = []
+        deadline = perf_counter() + duration
+        while True:
+            sent = perf_counter()
+            if sent >= deadline or (cancel_event and cancel_event.is_set()):
+                break
+            try:
+                self.sock.sendall(frame)
+                if not recv_exactly(self.sock, len(frame), reply):
+                    raise ConnectionError('probe server closed the connection')
+            except socket.timeout:
+                raise self.timed_out()
+            samples.append((perf_counter() - sent) * 500000.0)
+        return samples
+
+    def throughput(self, duration=1.0, msg_size=65536, cancel_event=None):
+        """returns the megabits per second the server received"""
+        frame = PROBE_FRAME.pack(b'T', msg_size) + bytes(msg_size)
+        report = bytearray(PROBE_FRAME.size + PROBE_COUNT.size)
+        started = perf_counter()
+        deadline = started + duration
+        try:
+            while perf_counter() < deadline:
+                if cancel_event and cancel_event.is_set():
+                    break
+                self.sock.sendall(frame)
+            self.sock.sendall(PROBE_FRAME.pack(b'R', 0))
+            if not recv_exactly(self.sock, len(report), report):
+                raise ConnectionError('probe server closed the connection')
+        except socket.timeout:
+            raise self.timed_out()
+        elapsed = perf_counter() - started
+        counted = PROBE_COUNT.unpack_from(report, PROBE_FRAME.size)[0]
+        return (counted * 8) / elapsed / 1000000.0
+
+
+def negotiate_performance_backend(target, port, backend):
+    if backend != 'native':
+        return 'sockperf'
+    try:
+        NativeProber(target, port).close()
+        return 'native'
+    except Exception as ex:
+        print('native probe unavailable on %s:%d (%s), using sockperf' %
+              (target, port, ex))
+        return 'sockperf'
+
+
+def run_sockperf(sid, id, cmd, parser, cancel_event):
+    print('    test : %s' % cmd)
+    output = ''
+    full_out = ''
+    while len(output) < 1 and not cancel_event.is_set():
+        if not process_supervisor.wait_for_slot(sid, id, cancel_event):
+            if not cancel_event.is_set():
+                websocket.emit('commandResponse', {
+                    'id': id,
+                    'stream': 'stderr',
+                    'data': "too many commands queued on server, try again later.\n"
+                }, to=sid)
+            break
+        try:
+            process = process_supervisor.launch(sid, cmd, universal_newlines=True)
+        except Exception:
+            process_supervisor.release(sid)
+            raise
+        try:
+            full_out = process.communicate()[0]
+        finally:
+            process_supervisor.release(sid, process.pid)
+        output = parser(full_out)
+        if process.returncode > 0 or len(output) == 0:
+            full_out = "%s\n%s\n\n" % (cmd, full_out)
+            error_response = {
+                'id': id,
+                'stream': 'stderr',
+                'data': full_out
+            }
+            websocket.emit('commandResponse', error_response, to=sid)
+        print('    output: %d: %s' % (process.returncode, output))
+    return output, full_out
+
+
+def performance_header(latency, bandwidth):
     header = "source_host, target_host"
     if latency:
         header = "%s, avg_latency_usec" % header
     if bandwidth:
         header = "%s, 32k_throughput_mbits, 64k_throughput_mbits, 128k_throughput_mbits, 1M_throughput_mbits" % header
-    header = "%s\n" % header
-    header_stdout_response = {
+    return "%s\n" % header
+
+
+def performance_result(sid, id, result):
+    if result['type'] == 'run':
+        mean = result.get('latency_usec', {}).get('mean')
+        if mean is not None:
+            performance_latency_seconds.observe(mean / 1000000.0, result['backend'])
+        for msg_size, mbits in result.get('throughput_mbits', {}).items():
+            performance_throughput_bytes.observe(mbits * 125000.0, result['backend'], msg_size)
+    result_response = {
         'id': id,
-        'stream': 'stdout',
-        'data': header
+        'stream': 'result',
+        'data': result
     }
-    websocket.emit('commandResponse', header_stdout_response)
-    try:
-        for i in range(runcount):
-            print('running performance test (%d/%d)' % ((i + 1), runcount))
-            labels_stdout_response = {
-                'id': id,
-                'stream': 'stdout',
-                'data': "%s, %s" % (sourcelabel, targetlabel)
-            }
-            websocket.emit('commandResponse', labels_stdout_response)
+    websocket.emit('commandResponse', result_response, to=sid)
+    count_emitted(result_response)
+
+
+def performance_target_runs(sid, id, sourcelabel, targetlabel, target, port, runcount, latency, bandwidth, cancel_event, backend='sockperf'):
+    backend = negotiate_performance_backend(target, port, backend)
+    duration = float(current_config().get('probe_duration_seconds', 1))
+    aggregate = LatencyHistogram()
+    runs = 0
+    for i in range(runcount):
+        if cancel_event.is_set():
+            break
+        print('running %s performance test on %s:%d (%d/%d)' %
+              (backend, target, port, (i + 1), runcount))
+        row = [sourcelabel, targetlabel]
+        result = {
+            'type': 'run',
+            'source': sourcelabel,
+            'target': targetlabel,
+            'address': target,
+            'port': port,
+            'backend': backend,
+            'run': i + 1
+        }
+        if backend == 'native':
+            with NativeProber(target, port) as prober:
+                if latency:
+                    samples = prober.ping_pong(
+                        duration, int(current_config().get('probe_message_size', 14)), cancel_event)
+                    histogram = LatencyHistogram()
+                    for sample in samples:
+                        histogram.record(sample)
+                    aggregate.merge(histogram)
+                    result['latency_usec'] = histogram.summary()
+                    if samples:
+                        row.append('%.3f' % (sum(samples) / len(samples)))
+                    else:
+                        row.append('')
+                if bandwidth:
+                    result['throughput_mbits'] = {}
+                    for msg_size in PROBE_MSG_SIZES:
+                        mbits = prober.throughput(
+                            duration, int(msg_size), cancel_event)
+                        result['throughput_mbits'][PROBE_MSG_SIZE_LABELS[msg_size]] = round(
+                            mbits, 3)
+                        row.append('%.3f' % mbits)
+        else:
             if latency:
                 cmd = "sockperf ping-pong --tcp -i %s -p %d" % (target, port)
-                print('    test : %s' % cmd)
-                output = ''
-                while len(output) < 1:
-                    process = subprocess.Popen(
-                        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, universal_newlines=True
-                    )
-                    pids_by_sid[sid] = [process.pid]
-                    full_out = process.communicate()[0]
-                    output = get_latency_from_ping_pong_output(full_out)
-                    if process.returncode > 0 or len(output) == 0:
-                        full_out = "%s\n%s\n\n" % (cmd, full_out)
-                        error_response = {
-                            'id': id,
-                            'stream': 'stderr',
-                            'data': full_out
-                        }
-                        websocket.emit('commandResponse', error_response)
-                    print('    output: %d: %s' % (process.returncode, output))
-                latency_stdout_response = {
-                    'id': id,
-                    'stream': 'stdout',
-                    'data': ", %s" % output
-                }
-                websocket.emit('commandResponse', latency_stdout_response)
+                output, full_out = run_sockperf(
+                    sid, id, cmd, get_latency_from_ping_pong_output, cancel_event)
+                # sockperf only reports its own percentiles, not samples
+                result['latency_usec'] = get_percentiles_from_ping_pong_output(
+                    full_out)
+                if output:
+                    result['latency_usec']['mean'] = float(output)
+                row.append(output)
             if bandwidth:
-                for msg_size in ['32768', '65536', '131072', '1048575']:
+                result['throughput_mbits'] = {}
+                for msg_size in PROBE_MSG_SIZES:
                     cmd = "sockperf throughput --tcp -i %s -p %s -m %s" % (
                         target, port, msg_size)
-                    print('    test : %s' % cmd)
-                    output = ''
-                    while len(output) < 1:
-                        process = subprocess.Popen(
-                            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, universal_newlines=True
-                        )
-                        pids_by_sid[sid] = [process.pid]
-                        full_out = process.communicate()[0]
-                        output = get_bandwidth_from_throughput_output(full_out)
-                        if process.returncode > 0 or len(output) == 0:
-                            full_out = "%s\n%s\n\n" % (cmd, full_out)
-                            error_response = {
-                                'id': id,
-                                'stream': 'stderr',
-                                'data': full_out
-                            }
-                            websocket.emit('commandResponse', error_response)
-                        print('    output: %d: %s' %
-                              (process.returncode, output))
-                    bandwidth_stdout_response = {
-                        'id': id,
-                        'stream': 'stdout',
-                        'data': ", %s" % output
-                    }
-                    websocket.emit('commandResponse',
-                                   bandwidth_stdout_response)
-            eor_stdout_response = {
-                'id': id,
-                'stream': 'stdout',
-                'data': "\n"
-            }
-            websocket.emit('commandResponse', eor_stdout_response)
+                    output, full_out = run_sockperf(
+                        sid, id, cmd, get_bandwidth_from_throughput_output, cancel_event)
+                    if output:
+                        result['throughput_mbits'][PROBE_MSG_SIZE_LABELS[msg_size]] = float(
+                            output)
+                    row.append(output)
+        if cancel_event.is_set():
+            break
+        runs += 1
+        row_stdout_response = {
+            'id': id,
+            'stream': 'stdout',
+            'data': "%s\n" % ", ".join(row)
+        }
+        websocket.emit('commandResponse', row_stdout_response, to=sid)
+        count_emitted(row_stdout_response)
+        performance_result(sid, id, result)
+    summary = {
+        'type': 'summary',
+        'source': sourcelabel,
+        'target': targetlabel,
+        'address': target,
+        'port': port,
+        'backend': backend,
+        'runs': runs
+    }
+    if latency and aggregate.total:
+        summary['latency_usec'] = aggregate.summary()
+        summary['histogram'] = aggregate.to_dict()
+    performance_result(sid, id, summary)
+
+
+def start_performance_test(sid):
+    destroy_all_processes_for_sid(sid)
+    cancel_event = Event()
+    performance_cancel_events[sid] = cancel_event
+    return cancel_event
+
+
+def performance_test(sid, id, sourcelabel, targetlabel, target, port, runcount, latency, bandwidth, backend='sockperf'):
+    cancel_event = start_performance_test(sid)
+    header_stdout_response = {
+        'id': id,
+        'stream': 'stdout',
+        'data': performance_header(latency, bandwidth)
+    }
+    websocket.emit('commandResponse', header_stdout_response, to=sid)
+    try:
+        performance_target_runs(
+            sid, id, sourcelabel, targetlabel, target, port, runcount, latency, bandwidth, cancel_event, backend)
         return 0
     except Exception as e:
         error_response = {
@@ -308,17 +2698,228 @@ def performance_test(sid, id, sourcelabel, targetlabel, target, port, runcount,
         }
         print("commandResponse to %s: %s" %
               (error_response['stream'], error_response['data']))
-        websocket.emit('commandResponse', error_response)
+        websocket.emit('commandResponse', error_response, to=sid)
+        return -1
+
+
+def performance_matrix_targets(targets, port):
+    matrix_targets = []
+    for target in targets:
+        if isinstance(target, dict):
+            matrix_targets.append({
+                'target': target['target'],
+                'port': int(target.get('port', port)),
+                'targetlabel': target.get('targetlabel', target['target'])
+            })
+        else:
+            target_label = target
+            target_port = port
+            if ':' in target:
+                target, target_port = target.rsplit(':', 1)
+            matrix_targets.append({
+                'target': target,
+                'port': int(target_port),
+                'targetlabel': target_label
+            })
+    return matrix_targets
+
+
+def performance_matrix(sid, id, sourcelabel, targets, runcount, latency, bandwidth, backend='sockperf'):
+    cancel_event = start_performance_test(sid)
+    header_stdout_response = {
+        'id': id,
+        'stream': 'stdout',
+        'data': performance_header(latency, bandwidth)
+    }
+    websocket.emit('commandResponse', header_stdout_response, to=sid)
+
+    # every target is measured by a single worker so runs against
+    # the same listener never overlap and skew each other
+    exit_code = 0
+    targets_by_address = {}
+    for target in targets:
+        try:
+            address = socket.gethostbyname(target['target'])
+        except Exception as e:
+            error_response = {
+                'id': id,
+                'stream': 'stderr',
+                'data': "target: %s is not valid. %s - %s\n\n" % (target['target'], e.__class__.__name__, e)
+            }
+            websocket.emit('commandResponse', error_response, to=sid)
+            exit_code = -1
+            continue
+        targets_by_address.setdefault(
+            (address, target['port']), []).append(target)
+
+    settings = current_config()
+
+    def run_target(address, port, labels):
+        # workers keep reading the settings the request started with
+        with app.app_context():
+            g.config = settings
+            return run_target_labels(address, port, labels)
+
+    def run_target_labels(address, port, labels):
+        try:
+            for target in labels:
+                performance_target_runs(
+                    sid, id, sourcelabel, target['targetlabel'], address, port, runcount, latency, bandwidth, cancel_event, backend)
+            return 0
+        except Exception as e:
+            error_response = {
+                'id': id,
+                'stream': 'stderr',
+                'data': "error running test on target: %s - %s - %s.. \n\n" % (address, e.__class__.__name__, e)
+            }
+            print("commandResponse to %s: %s" %
+                  (error_response['stream'], error_response['data']))
+            websocket.emit('commandResponse', error_response, to=sid)
+            return -1
+
+    if not targets_by_address:
         return -1
+    max_workers = min(
+        int(current_config().get('performance_max_workers', 4)), len(targets_by_address))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = [
+            executor.submit(run_target, address, port, labels)
+            for (address, port), labels in targets_by_address.items()
+        ]
+        for result in results:
+            if result.result() != 0:
+                exit_code = -1
+    return exit_code
+
+
+class ConnectionCache(object):
+    """LRU of live database engines and clients keyed by connection settings
+
+    clients are evicted to make room, after sitting idle for idle_seconds
+    or when a check with them fails. A client is only closed once the
+    requests using it are done with it.
+    """
+
+    def __init__(self, max_entries=32, idle_seconds=300):
+        self.max_entries = max_entries
+        self.idle_seconds = idle_seconds
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextmanager
+    def connection(self, key, factory, closer):
+        """yields the client cached for key, created with factory on a miss"""
+        entry = self.acquire(key, factory, closer)
+        try:
+            yield entry['client']
+        finally:
+            self.release(entry)
+
+    def acquire(self, key, factory, closer):
+        self.close_all(self.evict_idle())
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                entry['last_used'] = monotonic()
+                entry['users'] += 1
+                self.hits += 1
+                return entry
+            self.misses += 1
+        client = factory()
+        expired = []
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                # another request connected first, keep theirs
+                expired.append({'client': client, 'closer': closer})
+                entry['last_used'] = monotonic()
+                entry['users'] += 1
+            else:
+                entry = {
+                    'client': client,
+                    'closer': closer,
+                    'last_used': monotonic(),
+                    'users': 1,
+                    'evicted': False
+                }
+                self.entries[key] = entry
+                while len(self.entries) > self.max_entries:
+                    expired.extend(self._evict(self.entries.popitem(last=False)[1]))
+                    self.evictions += 1
+        self.close_all(expired)
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry['users'] -= 1
+            entry['last_used'] = monotonic()
+            closing = entry['evicted'] and not entry['users']
+        if closing:
+            self.close_all([entry])
+
+    def _evict(self, entry):
+        """marks entry evicted, returns it when nobody is using it"""
+        entry['evicted'] = True
+        return [] if entry['users'] else [entry]
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            expired = self._evict(entry) if entry else []
+        self.close_all(expired)
+
+    def evict_idle(self):
+        expired = []
+        with self.lock:
+            idle_since = monotonic() - self.idle_seconds
+            for key in list(self.entries.keys()):
+                entry = self.entries[key]
+                if not entry['users'] and entry['last_used'] < idle_since:
+                    expired.extend(self._evict(self.entries.pop(key)))
+                    self.evictions += 1
+        return expired
+
+    def close_all(self, entries):
+        for entry in entries:
+            try:
+                entry['closer'](entry['client'])
+            except Exception as ex:
+                print('error closing cached DB client: %s' % ex)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'in_use': len([e for e in self.entries.values() if e['users']]),
+                'max_entries': self.max_entries,
+                'idle_seconds': self.idle_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+db_connection_cache = ConnectionCache(
+    int(config.get('db_pool_max_entries', 32)),
+    int(config.get('db_pool_idle_seconds', 300)))
+
 
+def sweep_db_connection_cache():
+    db_connection_cache.close_all(db_connection_cache.evict_idle())
+    command_engine.run_later(60, sweep_db_connection_cache)
 
-def db_connect_postgress(
-        host='localhost', user='admin', password='admin', dbname='demo',
-        use_tls=False, tls_client_cert=None,
-        tls_client_key=None, tls_ca_cert='./postgres.ca',
-        tls_verify=False):
+
+def postgres_engine_for(host='localhost', user='admin', password='admin', dbname='demo',
+                        use_tls=False, tls_client_cert=None,
+                        tls_client_key=None, tls_ca_cert='./postgres.ca',
+                        tls_verify=False, port=5432):
     args = {
         "host": host,
+        "port": port,
         "user": user,
         "password": password,
         "dbname": dbname
@@ -331,12 +2932,19 @@ def db_connect_postgress(
             args["sslmode"] = "verify-full"
         else:
             args["sslmode"] = "allow"
+    key = ('postgres',) + tuple(sorted(args.items()))
+    return key, lambda: db_connection_cache.connection(
+        key,
+        lambda: create_engine(
+            'postgresql+psycopg2://', connect_args=args, pool_pre_ping=True),
+        lambda engine: engine.dispose())
+
+
+def db_connect_postgress(host='localhost', **kwargs):
+    key, engine = postgres_engine_for(host, **kwargs)
     try:
-        db = create_engine('postgresql+psycopg2://', connect_args=args)
-        connection = db.connect()
-        cursor = connection.cursor()
-        cursor.execute("SELECT version()")
-        version = cursor.fetchone()
+        with engine() as cached_engine, cached_engine.connect() as connection:
+            version = connection.execute(text("SELECT version()")).scalar()
         return {
             "host": host,
             "version": version,
@@ -344,6 +2952,7 @@ def db_connect_postgress(
             "error_message": None
         }
     except Exception as ex:
+        db_connection_cache.discard(key)
         return {
             "host": host,
             "version": None,
@@ -352,28 +2961,71 @@ def db_connect_postgress(
         }
 
 
-def db_connect_mongodb(
-        host='localhost', user='admin', password='admin', dbname='demo',
-        use_tls=False, tls_client_cert=None,
-        tls_client_key=None, tls_ca_cert=None,
-        tls_verify=False):
-    tls_client_combined = './mongo.combined'
+def mongodb_client_for(host, port, user, password, use_tls, tls_client_cert,
+                       tls_client_key, tls_ca_cert, tls_verify):
+    """returns the client and the combined cert and key file it reads, if any"""
+    args = {
+        "username": user,
+        "password": password,
+        "tls": use_tls
+    }
+    combined_cert_key = None
     if use_tls:
+        args["tlsCAFile"] = tls_ca_cert
+        args["tlsInsecure"] = not tls_verify
         # combine client cert and key into one combined file
-        if os.path.exists(tls_client_cert) and os.path.exists(tls_client_key):
-            with open(tls_client_combined, 'w') as combined_cert_key:
-                combined_content = ''
-                with open(tls_client_cert, 'r') as cert:
-                    combined_content = cert.read()
-                with open(tls_client_key, 'r') as key:
-                    combined_content = "%s\n\n%s" % (
-                        combined_content, key.read())
-                combined_cert_key.write(combined_content)
+        if tls_client_cert and tls_client_key and \
+                os.path.exists(tls_client_cert) and os.path.exists(tls_client_key):
+            with open(tls_client_cert, 'r') as cert:
+                combined_content = cert.read()
+            with open(tls_client_key, 'r') as key:
+                combined_content = "%s\n\n%s" % (
+                    combined_content, key.read())
+            # mkstemp creates the file readable by this user only
+            fd, combined_cert_key = tempfile.mkstemp(
+                prefix='mongo-', suffix='.combined')
+            with os.fdopen(fd, 'w') as combined:
+                combined.write(combined_content)
+            args["tlsCertificateKeyFile"] = combined_cert_key
+    try:
+        return MongoClient(host, port, **args), combined_cert_key
+    except Exception:
+        if combined_cert_key:
+            os.unlink(combined_cert_key)
+        raise
+
+
+def mongodb_client_key(host='localhost', user='admin', password='admin', dbname='demo',
+                       use_tls=False, tls_client_cert=None,
+                       tls_client_key=None, tls_ca_cert=None,
+                       tls_verify=False, port=27017):
+    key = ('mongodb', host, port, user, password, use_tls,
+           tls_client_cert, tls_client_key, tls_ca_cert, tls_verify)
+
+    def connection():
+        combined_files = []
+
+        def connect():
+            client, combined_cert_key = mongodb_client_for(
+                host, port, user, password, use_tls, tls_client_cert,
+                tls_client_key, tls_ca_cert, tls_verify)
+            if combined_cert_key:
+                combined_files.append(combined_cert_key)
+            return client
+
+        def close(client):
+            client.close()
+            for combined_cert_key in combined_files:
+                os.unlink(combined_cert_key)
+        return db_connection_cache.connection(key, connect, close)
+    return key, connection
+
+
+def db_connect_mongodb(host='localhost', **kwargs):
+    key, client = mongodb_client_key(host, **kwargs)
     try:
-        client = MongoClient(host, username=user, password=password,
-                             tls=use_tls, tlsCertificateKeyFile=tls_client_combined,
-                             tlsCAFile=tls_ca_cert, tlsInsecure=not tls_verify)
-        version = client.server_info()["version"]
+        with client() as mongo:
+            version = mongo.server_info()["version"]
         return {
             "host": host,
             "version": version,
@@ -381,6 +3033,7 @@ def db_connect_mongodb(
             "error_message": None
         }
     except Exception as ex:
+        db_connection_cache.discard(key)
         return {
             "host": host,
             "version": None,
@@ -389,28 +3042,123 @@ def db_connect_mongodb(
         }
 
 
+def cosmos_client_key(endpoint=None, clientkey=None):
+    key = ('cosmos', endpoint, clientkey)
+    return key, lambda: db_connection_cache.connection(
+        key,
+        lambda: cosmos_client(endpoint, credential=clientkey),
+        lambda client: client.__exit__(None, None, None))
+
+
 def db_connect_cosmos(endpoint=None, clientkey=None, database='test'):
-    with cosmos_client(endpoint, credential=clientkey) as client:
-        response = {
-            "url": endpoint,
-            "error": None,
-            "message": None
-        }
+    key, client = cosmos_client_key(endpoint, clientkey)
+    response = {
+        "url": endpoint,
+        "error": None,
+        "message": None
+    }
+    try:
+        with client() as cosmos:
+            try:
+                database = cosmos.create_database(database)
+                response["message"] = f"Successfully created to DB id: {database.id}"
+            except cosmos_exceptions.CosmosResourceExistsError:
+                database = cosmos.get_database_client(database)
+                response["message"] = f"Successfully connected to DB id: {database.id}"
+    except cosmos_exceptions.CosmosHttpResponseError as chre:
+        db_connection_cache.discard(key)
+        response["error"] = 400
+        response["message"] = str(chre)
+    return response
+
+
+@traced
+def db_probe(key, client, connect, roundtrip, count, disconnect=None):
+    """times the checkout, then count round trips over the same connection
+
+    clients come from the connection cache, so the checkout only includes
+    a real connect when the cache had no client for key yet.
+    """
+    response = {
+        "checkout_ms": None,
+        "roundtrips": count,
+        "latency_usec": None,
+        "error": False,
+        "error_message": None
+    }
+    # cache keys start with the database kind
+    database = key[0]
+    try:
+        with client() as cached:
+            started = perf_counter()
+            connection = connect(cached)
+            try:
+                elapsed = perf_counter() - started
+                response["checkout_ms"] = round(elapsed * 1000.0, 3)
+                dbconnect_checkout_seconds.observe(elapsed, database)
+                histogram = LatencyHistogram()
+                for i in range(count):
+                    started = perf_counter()
+                    roundtrip(connection)
+                    elapsed = perf_counter() - started
+                    histogram.record(elapsed * 1000000.0)
+                    dbconnect_roundtrip_seconds.observe(elapsed, database)
+                response["latency_usec"] = histogram.summary()
+            finally:
+                if disconnect:
+                    disconnect(connection)
+    except Exception as ex:
+        # closed once the other requests using it are done
+        db_connection_cache.discard(key)
+        response["error"] = True
+        response["error_message"] = str(ex)
+    return response
+
+
+def db_probe_postgres(count, **kwargs):
+    key, engine = postgres_engine_for(**kwargs)
+
+    def connect(cached_engine):
+        connection = cached_engine.connect()
         try:
-            database = client.create_database(database)
-            response["message"] = f"Successfully created to DB id: {database.id}"
-        except cosmos_exceptions.CosmosResourceExistsError:
-            database = client.get_database_client(database)
-            response["message"] = f"Successfully connected to DB id: {database.id}"
-        except cosmos_exceptions.CosmosHttpResponseError as chre:
-            response["error"] = 400
-            response["message"] = str(chre)
-        return response
+            connection.execute(text("SELECT 1")).scalar()
+        except Exception:
+            connection.close()
+            raise
+        return connection
+    return db_probe(key, engine, connect,
+                    lambda connection: connection.execute(
+                        text("SELECT 1")).scalar(),
+                    count, lambda connection: connection.close())
+
+
+def db_probe_mongodb(count, **kwargs):
+    key, client = mongodb_client_key(**kwargs)
+
+    def connect(mongo):
+        admin = mongo.admin
+        admin.command('ping')
+        return admin
+    return db_probe(key, client, connect,
+                    lambda admin: admin.command('ping'),
+                    count)
+
+
+def db_probe_cosmos(count, endpoint=None, clientkey=None, database='test'):
+    key, client = cosmos_client_key(endpoint, clientkey)
+
+    def connect(cosmos):
+        database_client = cosmos.get_database_client(database)
+        database_client.read()
+        return database_client
+    return db_probe(key, client, connect,
+                    lambda database_client: database_client.read(),
+                    count)
 
 
 @app.route('/')
 def run_iscapp():
-    return render_template(
+    return asset_cache.render(
         'demoapp_index.html', location=os.getenv('DEMO_LOCATION', ''))
 
 
@@ -422,12 +3170,15 @@ def runner_ui():
     banner_text = os.getenv('BANNER', '')
     banner_background_color = "#%s" % os.getenv('BANNER_COLOR', '000000')
     banner_text_color = '#%s' % os.getenv('BANNER_TEXT_COLOR', 'ffffff')
-    return render_template(
+    return asset_cache.render(
         'diag_index.html',
         hostname='connecting...',
         banner_text=(banner_text),
         banner_background_color=banner_background_color,
-        banner_text_color=banner_text_color)
+        banner_text_color=banner_text_color,
+        # connections must stay on one worker, long polling would not
+        socketio_transports=json.dumps(
+            ['websocket'] if int(current_config().get('workers', 1)) > 1 else ['polling', 'websocket']))
 
 
 @app.route('/dump')
@@ -459,22 +3210,266 @@ def dump_ui():
 
 @app.route('/webscreenshots/<path:name>')
 def send_screenshot(name):
-    return send_from_directory(PUPPETEER_HOME, name, mimetype='image/jepg')
+    screenshot_cache.touch(name)
+    return send_from_directory(PUPPETEER_HOME, name, mimetype='image/jpeg')
+
+
+class UploadIndex(object):
+    """sorted index of UPLOAD_FOLDER with size, mtime and sha256 per file
+
+    the directory is rescanned only when its own mtime changes, which
+    happens whenever a file is created, renamed into place or removed.
+    Checksums of files found by a rescan are computed in the background.
+    """
+
+    def __init__(self, directory, chunk_size=1048576):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.entries = {}
+        self.names = []
+        self.dir_mtime = None
+        self.lock = Lock()
+        self.checksum_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='upload-checksum')
+
+    def refresh(self):
+        try:
+            dir_mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return
+        with self.lock:
+            if dir_mtime == self.dir_mtime:
+                return
+            self.dir_mtime = dir_mtime
+            found = {}
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.startswith('.') or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    current = self.entries.get(entry.name)
+                    if current and current['size'] == st.st_size and \
+                            current['mtime_ns'] == st.st_mtime_ns:
+                        found[entry.name] = current
+                        continue
+                    found[entry.name] = self.entry(
+                        entry.name, st.st_size, st.st_mtime_ns, None)
+                    self.checksum_executor.submit(
+                        self.checksum, entry.name, st.st_mtime_ns)
+            self.entries = found
+            self.names = sorted(found)
+
+    def entry(self, name, size, mtime_ns, sha256):
+        return {
+            'name': name,
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'mtime': time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ', time.gmtime(mtime_ns / 1e9)),
+            'sha256': sha256
+        }
+
+    def checksum(self, name, mtime_ns):
+        digest = hashlib.sha256()
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    digest.update(chunk)
+        except OSError:
+            return
+        with self.lock:
+            current = self.entries.get(name)
+            if current and current['mtime_ns'] == mtime_ns:
+                current['sha256'] = digest.hexdigest()
+
+    def record(self, name, sha256):
+        """add a file written by save_upload, with its checksum already known"""
+        st = os.stat(os.path.join(self.directory, name))
+        with self.lock:
+            if name not in self.entries:
+                bisect.insort(self.names, name)
+            self.entries[name] = self.entry(
+                name, st.st_size, st.st_mtime_ns, sha256)
+
+    @traced
+    def page(self, offset=0, limit=100, after=None):
+        self.refresh()
+        with self.lock:
+            if after is not None:
+                offset = bisect.bisect_right(self.names, after)
+            names = self.names[offset:offset + limit]
+            files = [dict(self.entries[n]) for n in names]
+            total = len(self.names)
+        for f in files:
+            del f['mtime_ns']
+        return {
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'next': names[-1] if names and offset + len(names) < total else None,
+            'files': files
+        }
+
+
+upload_index = UploadIndex(UPLOAD_FOLDER, int(config.get('upload_chunk_bytes', 1048576)))
+
+
+def upload_page_args(args):
+    default_limit = int(current_config().get('upload_list_page_size', 100))
+    max_limit = int(current_config().get('upload_list_max_page_size', 1000))
+    offset = max(int(args.get('offset', 0)), 0)
+    limit = min(max(int(args.get('limit', default_limit)), 1), max_limit)
+    return offset, limit, args.get('after')
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadFile(object):
+    """temporary file in UPLOAD_FOLDER that an upload is written into
+
+    bytes are counted and hashed as they are written, UploadTooLarge is
+    raised past max_bytes. commit renames the file into place, so a
+    failed or oversized upload never replaces an existing file.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.digest = hashlib.sha256()
+        fd, self.path = tempfile.mkstemp(dir=UPLOAD_FOLDER, prefix='.upload-')
+        self.file = os.fdopen(fd, 'wb')
+        self.committed = False
+
+    def write(self, chunk):
+        self.written += len(chunk)
+        if self.written > self.max_bytes:
+            raise UploadTooLarge(
+                'upload exceeds upload_max_bytes (%d)' % self.max_bytes)
+        self.digest.update(chunk)
+        return self.file.write(chunk)
+
+    def seek(self, *args):
+        # the multipart parser rewinds each file part it finished
+        return self.file.seek(*args)
+
+    def commit(self, filename):
+        self.file.close()
+        os.replace(self.path, os.path.join(UPLOAD_FOLDER, filename))
+        self.committed = True
+        upload_index.record(filename, self.digest.hexdigest())
+        return self.written
+
+    def discard(self):
+        if self.committed:
+            return
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+@traced
+def save_upload(stream, filename, max_bytes, chunk_size):
+    """copy an upload stream to UPLOAD_FOLDER in fixed size chunks"""
+    upload_file = UploadFile(max_bytes)
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            upload_file.write(chunk)
+        return upload_file.commit(filename)
+    finally:
+        upload_file.discard()
+
+
+def save_multipart_upload(max_bytes):
+    """streams the 'file' part of a multipart form POST into UPLOAD_FOLDER
+
+    each file part is written straight to an UploadFile while the body
+    is parsed, nothing is spooled to memory or another temporary file.
+    returns the saved file name, or None when no file was sent.
+    """
+    parts = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        upload_file = UploadFile(max_bytes)
+        parts.append(upload_file)
+        return upload_file
+    try:
+        _, _, files = parse_form_data(
+            request.environ, stream_factory=stream_factory, max_content_length=max_bytes)
+        file = files.get('file')
+        fn = secure_filename(file.filename) if file and file.filename else None
+        if fn:
+            file.stream.commit(fn)
+        return fn
+    finally:
+        for upload_file in parts:
+            upload_file.discard()
+
+
+def upload_too_large(fn, message):
+    return Response(
+        json.dumps({
+            "file": fn,
+            "error": 413,
+            "message": message
+        }),
+        status=413, mimetype='application/json')
+
+
+def parse_size(value):
+    """parse a byte count with an optional K, M or G (1024 based) suffix"""
+    value = value.strip().upper()
+    if value.endswith('B'):
+        value = value[:-1]
+    multiplier = 1
+    if value and value[-1] in 'KMG':
+        multiplier = 1024 ** ('KMG'.index(value[-1]) + 1)
+        value = value[:-1]
+    return int(value) * multiplier
+
+
+PAYLOAD_BLOCK = os.urandom(int(config.get('payload_chunk_bytes', 65536)))
+
+
+def generate_payload(size):
+    block = memoryview(PAYLOAD_BLOCK)
+    remaining = size
+    while remaining > 0:
+        chunk = block[:remaining]
+        remaining -= len(chunk)
+        yield bytes(chunk)
 
 
 @app.route('/upload', methods=['POST', 'GET'])
 def upload():
     if request.method == 'POST':
-        if 'file' in request.files:
-            file = request.files['file']
-            if file.filename:
-                fn = secure_filename(file.filename)
-                file.save(os.path.join(UPLOAD_FOLDER, fn))
-    file_listing = "<ul>"
-    for f in os.listdir(UPLOAD_FOLDER):
-        file_listing = "%s<li><a href='/upload/%s'>%s</a>" % (
-            file_listing, f, f)
-    file_listing = "%s</ul>" % file_listing
+        # request.files would spool the whole body before it could be checked
+        max_bytes = int(current_config().get('upload_max_bytes', 10737418240))
+        if (request.content_length or 0) > max_bytes:
+            return upload_too_large(
+                None, 'upload exceeds upload_max_bytes (%d)' % max_bytes)
+        try:
+            save_multipart_upload(max_bytes)
+        except UploadTooLarge as utl:
+            return upload_too_large(None, str(utl))
+    try:
+        offset, limit, after = upload_page_args(request.args)
+    except ValueError:
+        offset, limit, after = 0, int(current_config().get('upload_list_page_size', 100)), None
+    listing = upload_index.page(offset, limit, after)
+    rows = ["<li><a href='/upload/%s'>%s</a> %d bytes %s</li>" % (
+        escape(f['name']), escape(f['name']), f['size'], f['mtime'])
+        for f in listing['files']]
+    if listing['next']:
+        rows.append("<li><a href='/upload?after=%s&limit=%d'>next page</a></li>" % (
+            escape(quote(listing['next'])), limit))
+    file_listing = "<ul>%s</ul>" % "".join(rows)
     return """
     <!doctype html>
     <title>Upload new File</title>
@@ -492,6 +3487,22 @@ def upload():
     """ % (file_listing)
 
 
+@app.route('/uploads', methods=['GET'])
+def upload_listing():
+    try:
+        offset, limit, after = upload_page_args(request.args)
+    except ValueError:
+        return Response(
+            json.dumps({
+                "error": 400,
+                "message": "offset and limit must be integers"
+            }),
+            status=400, mimetype='application/json')
+    listing = upload_index.page(offset, limit, after)
+    listing['error'] = None
+    return Response(json.dumps(listing), status=200, mimetype='application/json')
+
+
 @app.route('/upload/<path:path>')
 def get_uploaded_file(path):  # pragma: no cover
     mimetypes = {
@@ -502,11 +3513,81 @@ def get_uploaded_file(path):  # pragma: no cover
         ".jpeg": "image/jpeg",
         ".ico": "image/x-icon"
     }
-    complete_path = os.path.join(UPLOAD_FOLDER, path)
     ext = os.path.splitext(path)[1]
     mimetype = mimetypes.get(ext, "application/binary")
-    content = get_file(complete_path)
-    return Response(content, mimetype=mimetype)
+    # conditional responses answer Range requests with 206 partial content
+    return send_from_directory(
+        UPLOAD_FOLDER, path, mimetype=mimetype, conditional=True)
+
+
+@app.route('/upload/<path:path>', methods=['PUT'])
+def put_uploaded_file(path):
+    fn = secure_filename(path)
+    if not fn:
+        return Response(
+            json.dumps({
+                "file": path,
+                "error": 400,
+                "message": "invalid file name"
+            }),
+            status=400, mimetype='application/json')
+    max_bytes = int(current_config().get('upload_max_bytes', 10737418240))
+    if (request.content_length or 0) > max_bytes:
+        return upload_too_large(
+            fn, 'upload exceeds upload_max_bytes (%d)' % max_bytes)
+    start = perf_counter()
+    try:
+        written = save_upload(request.stream, fn, max_bytes,
+                              int(current_config().get('upload_chunk_bytes', 1048576)))
+    except UploadTooLarge as utl:
+        return upload_too_large(fn, str(utl))
+    return Response(
+        json.dumps({
+            "file": fn,
+            "error": None,
+            "bytes": written,
+            "time_ms": round((perf_counter() - start) * 1000, 3)
+        }),
+        status=201, mimetype='application/json')
+
+
+@app.route('/payload', methods=['GET', 'POST'])
+def payload():
+    max_bytes = int(current_config().get('payload_max_bytes', 10737418240))
+    if request.method == 'POST':
+        # discard the request body, reporting how fast it arrived
+        start = perf_counter()
+        received = 0
+        chunk_size = int(current_config().get('upload_chunk_bytes', 1048576))
+        while True:
+            chunk = request.stream.read(chunk_size)
+            if not chunk:
+                break
+            received += len(chunk)
+        elapsed = perf_counter() - start
+        return Response(
+            json.dumps({
+                "error": None,
+                "bytes": received,
+                "time_ms": round(elapsed * 1000, 3),
+                "mbps": round(received * 8 / elapsed / 1000000, 3) if elapsed else None
+            }),
+            status=200, mimetype='application/json')
+    try:
+        size = parse_size(request.args.get('bytes', '0'))
+    except ValueError:
+        size = -1
+    if size < 0 or size > max_bytes:
+        return Response(
+            json.dumps({
+                "bytes": request.args.get('bytes'),
+                "error": 400,
+                "message": "bytes must be between 0 and payload_max_bytes (%d)" % max_bytes
+            }),
+            status=400, mimetype='application/json')
+    return Response(
+        generate_payload(size), mimetype='application/octet-stream',
+        headers={'Content-Length': str(size), 'Cache-Control': 'no-store'})
 
 
 @app.route('/resolv', methods=['GET'])
@@ -514,7 +3595,9 @@ def proxy_resolv():
     rargs = request.args
     if rargs.get("fqdn"):
         try:
-            dig_answer = dig_fqdn(rargs.get("fqdn"))
+            use_cache = rargs.get("nocache", "false").lower() not in [
+                "1", "true", "yes"]
+            dig_answer = dig_fqdn(rargs.get("fqdn"), use_cache=use_cache)
             if dig_answer:
                 resp = {
                     "fqdn": rargs.get("fqdn"),
@@ -552,6 +3635,154 @@ def proxy_resolv():
             status=404, mimetype='application/json')
 
 
+@app.route('/resolv/batch', methods=['GET', 'POST'])
+def proxy_resolv_batch():
+    queries = []
+    use_cache = True
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        for query in body.get("queries", []):
+            if isinstance(query, dict):
+                queries.append((query.get("fqdn"), query.get("type", "A")))
+            else:
+                queries.append((query, "A"))
+        for fqdn in body.get("fqdns", []):
+            for record_type in body.get("types", ["A"]):
+                queries.append((fqdn, record_type))
+        use_cache = not body.get("nocache", False)
+    else:
+        rargs = request.args
+        for fqdn in rargs.getlist("fqdn"):
+            for record_type in (rargs.getlist("type") or ["A"]):
+                queries.append((fqdn, record_type))
+        use_cache = rargs.get("nocache", "false").lower() not in [
+            "1", "true", "yes"]
+    queries = [(fqdn, str(record_type).upper())
+               for fqdn, record_type in queries if fqdn]
+    if not queries:
+        return Response(
+            json.dumps({
+                "error": 404,
+                "message": "NotFound"
+            }),
+            status=404, mimetype='application/json')
+    max_queries = int(current_config().get('dns_batch_max_queries', 256))
+    invalid_types = [record_type for fqdn, record_type in queries
+                     if record_type not in DNS_BATCH_RECORD_TYPES]
+    if len(queries) > max_queries or invalid_types:
+        message = "too many queries, the limit is %d" % max_queries
+        if invalid_types:
+            message = "unsupported record types: %s" % ", ".join(
+                sorted(set(invalid_types)))
+        return Response(
+            json.dumps({
+                "error": 400,
+                "message": message
+            }),
+            status=400, mimetype='application/json')
+    started = perf_counter()
+    results = list(dns_executor.map(
+        lambda query: resolve_query(query[0], query[1], use_cache), queries))
+    return Response(
+        json.dumps({
+            "error": None,
+            "time_ms": round((perf_counter() - started) * 1000.0, 3),
+            "results": results
+        }),
+        status=200,
+        mimetype='application/json'
+    )
+
+
+@app.route('/resolv/stats', methods=['GET'])
+def proxy_resolv_stats():
+    return Response(
+        json.dumps(dns_cache.stats()),
+        status=200,
+        mimetype='application/json'
+    )
+
+
+class WaitingPoolAdapter(requests.adapters.HTTPAdapter):
+    """blocking connection pools that wait at most pool_timeout seconds
+
+    once pool_timeout passes without a free connection the request fails
+    with urllib3's EmptyPoolError instead of blocking its thread.
+    """
+
+    def __init__(self, pool_timeout, **kwargs):
+        self.pool_timeout = pool_timeout
+        super().__init__(pool_block=True, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        pool_timeout = self.pool_timeout
+
+        def waiting(pool_class):
+            class WaitingPool(pool_class):
+                def urlopen(self, *args, **kwargs):
+                    kwargs.setdefault('pool_timeout', pool_timeout)
+                    return super().urlopen(*args, **kwargs)
+            return WaitingPool
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: waiting(pool_class)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+
+def webproxy_session_for(pool_hosts, pool_per_host, pool_timeout):
+    session = requests.Session()
+    adapter = WaitingPoolAdapter(
+        pool_timeout, pool_connections=pool_hosts, pool_maxsize=pool_per_host)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+webproxy_session = webproxy_session_for(
+    int(config.get('webproxy_pool_hosts', 32)),
+    int(config.get('webproxy_pool_per_host', 8)),
+    float(config.get('webproxy_pool_timeout', 5)))
+
+
+@traced
+def webproxy_request(method, url):
+    started = perf_counter()
+    resp = webproxy_session.request(
+        method=method, url=url, verify=False, stream=True,
+        timeout=(float(current_config().get('webproxy_connect_timeout', 5)),
+                 float(current_config().get('webproxy_read_timeout', 30))))
+    webproxy_request_seconds.observe(perf_counter() - started, 'webproxy')
+    return resp
+
+
+def read_capped(resp, max_bytes, chunk_size):
+    body = bytearray()
+    truncated = False
+    for chunk in resp.iter_content(chunk_size=chunk_size):
+        body.extend(chunk)
+        if len(body) > max_bytes:
+            del body[max_bytes:]
+            truncated = True
+            break
+    if truncated:
+        resp.close()
+    return bytes(body), truncated
+
+
+def stream_capped(resp, max_bytes, chunk_size):
+    sent = 0
+    try:
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            if sent + len(chunk) > max_bytes:
+                yield chunk[:max_bytes - sent]
+                break
+            sent += len(chunk)
+            yield chunk
+    finally:
+        resp.close()
+
+
 @app.route('/webproxy')
 def webproxy():
     rargs = request.args
@@ -559,22 +3790,51 @@ def webproxy():
         method = rargs.get("method")
         if not method:
             method = 'GET'
+        max_bytes = int(current_config().get('webproxy_max_body_bytes', 10485760))
+        chunk_size = int(current_config().get('webproxy_chunk_bytes', 65536))
         try:
-            resp = requests.request(
-                method=method, url=rargs["url"], verify=False)
+            resp = webproxy_request(method, rargs["url"])
+            if rargs.get("stream", "false").lower() in ["1", "true", "yes"]:
+                headers = {}
+                content_length = resp.headers.get('Content-Length')
+                if resp.headers.get('Content-Encoding'):
+                    # the body is relayed decoded, the length is the encoded size
+                    content_length = None
+                if content_length and content_length.isdigit():
+                    if int(content_length) > max_bytes:
+                        headers['X-Webproxy-Truncated'] = 'true'
+                    else:
+                        headers['Content-Length'] = content_length
+                return Response(
+                    stream_capped(resp, max_bytes, chunk_size),
+                    status=resp.status_code,
+                    headers=headers,
+                    content_type=resp.headers.get(
+                        'Content-Type', 'application/octet-stream'),
+                    direct_passthrough=True)
+            body, truncated = read_capped(resp, max_bytes, chunk_size)
             return Response(
                 json.dumps({
                     "url": rargs.get("url"),
                     "error": resp.status_code,
-                    "message": resp.text
+                    "message": body.decode(resp.encoding or 'utf-8', errors='replace'),
+                    "truncated": truncated
                 }),
                 status=resp.status_code, mimetype='application/json')
+        except urllib3.exceptions.EmptyPoolError as wex:
+            return Response(
+                json.dumps({
+                    "url": rargs.get("url"),
+                    "error": 503,
+                    "message": "no free upstream connection: %s" % wex
+                }),
+                status=503, mimetype='application/json')
         except Exception as wex:
             return Response(
                 json.dumps({
                     "url": rargs.get("url"),
                     "error": 500,
-                    "message": wex
+                    "message": str(wex)
                 }),
                 status=500, mimetype='application/json')
     else:
@@ -587,6 +3847,301 @@ def webproxy():
             status=404, mimetype='application/json')
 
 
+@traced
+def timed_http_request(method, url, max_bytes, chunk_size):
+    """fetches url on a fresh connection, timing every phase of the request
+
+    dns, tcp_connect and tls_handshake are the duration of each phase,
+    ttfb and total are measured from the start of the request.
+    """
+    result = {
+        "url": url,
+        "error": None,
+        "status": None,
+        "bytes": 0,
+        "timing_ms": {}
+    }
+    timing = result["timing_ms"]
+    started = perf_counter()
+
+    def elapsed(since):
+        return round((perf_counter() - since) * 1000.0, 3)
+
+    sock = None
+    try:
+        parsed = urlparse(url)
+        if parsed.scheme not in ['http', 'https'] or not parsed.hostname:
+            raise ValueError("invalid URL: %s" % url)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        phase = perf_counter()
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            parsed.hostname, port, type=socket.SOCK_STREAM)[0]
+        timing["dns"] = elapsed(phase)
+        phase = perf_counter()
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(float(current_config().get('webproxy_connect_timeout', 5)))
+        sock.connect(address)
+        timing["tcp_connect"] = elapsed(phase)
+        if parsed.scheme == 'https':
+            phase = perf_counter()
+            sock = ssl._create_unverified_context().wrap_socket(
+                sock, server_hostname=parsed.hostname)
+            timing["tls_handshake"] = elapsed(phase)
+        sock.settimeout(float(current_config().get('webproxy_read_timeout', 30)))
+        if parsed.scheme == 'https':
+            connection = http.client.HTTPSConnection(parsed.hostname, port)
+        else:
+            connection = http.client.HTTPConnection(parsed.hostname, port)
+        # the socket is already connected, http.client only sends on it
+        connection.sock = sock
+        path = parsed.path or '/'
+        if parsed.query:
+            path = "%s?%s" % (path, parsed.query)
+        connection.request(method, path, headers={'Connection': 'close'})
+        response = connection.getresponse()
+        timing["ttfb"] = elapsed(started)
+        result["status"] = response.status
+        while result["bytes"] < max_bytes:
+            chunk = response.read(min(chunk_size, max_bytes - result["bytes"]))
+            if not chunk:
+                break
+            result["bytes"] += len(chunk)
+    except Exception as ex:
+        result["error"] = 500
+        result["message"] = str(ex)
+    finally:
+        if sock:
+            sock.close()
+    timing["total"] = elapsed(started)
+    if "ttfb" in timing:
+        webproxy_request_seconds.observe(timing["ttfb"] / 1000.0, 'webproxy_multi')
+    return result
+
+
+webproxy_executor = ThreadPoolExecutor(
+    max_workers=int(config.get('webproxy_multi_workers', 16)), thread_name_prefix='webproxy')
+
+
+@app.route('/webproxy/multi', methods=['GET', 'POST'])
+def webproxy_multi():
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        urls = body.get("urls", [])
+        method = body.get("method") or 'GET'
+    else:
+        urls = request.args.getlist("url")
+        method = request.args.get("method") or 'GET'
+    urls = [url for url in urls if url]
+    if not urls:
+        return Response(
+            json.dumps({
+                "urls": None,
+                "error": 404,
+                "message": "NotFound"
+            }),
+            status=404, mimetype='application/json')
+    max_urls = int(current_config().get('webproxy_multi_max_urls', 64))
+    if len(urls) > max_urls:
+        return Response(
+            json.dumps({
+                "urls": urls,
+                "error": 400,
+                "message": "too many urls, the limit is %d" % max_urls
+            }),
+            status=400, mimetype='application/json')
+    max_bytes = int(current_config().get('webproxy_max_body_bytes', 10485760))
+    chunk_size = int(current_config().get('webproxy_chunk_bytes', 65536))
+    started = perf_counter()
+    results = list(webproxy_executor.map(
+        lambda url: timed_http_request(method, url, max_bytes, chunk_size), urls))
+    return Response(
+        json.dumps({
+            "error": None,
+            "time_ms": round((perf_counter() - started) * 1000.0, 3),
+            "results": results
+        }),
+        status=200, mimetype='application/json')
+
+
+def db_connect_args(db_url):
+    qs = parse_qs(db_url.query)
+
+    def flag(name):
+        return qs.get(name, ['false'])[0].lower() in ['1', 'true', 'yes']
+
+    args = {
+        "host": db_url.hostname or 'localhost',
+        "use_tls": flag('tls'),
+        "tls_verify": flag('tls_verify')
+    }
+    if db_url.port:
+        args["port"] = db_url.port
+    if db_url.username:
+        args["user"] = unquote(db_url.username)
+    if db_url.password:
+        args["password"] = unquote(db_url.password)
+    if db_url.path.strip('/'):
+        args["dbname"] = db_url.path.strip('/')
+    if 'dbname' in qs:
+        args["dbname"] = qs['dbname'][0]
+    for tls_file in ['tls_client_cert', 'tls_client_key', 'tls_ca_cert']:
+        if tls_file in qs:
+            args[tls_file] = qs[tls_file][0]
+    return args
+
+
+def db_probe_response(url, db_url, probe):
+    count = min(probe, int(current_config().get('db_probe_max_roundtrips', 1000)))
+    if db_url.scheme == 'cosmos':
+        qs = parse_qs(db_url.query)
+        response = db_probe_cosmos(
+            count,
+            f"http://{db_url.hostname}:{db_url.port}",
+            qs.get('dbkey', [None])[0],
+            qs.get('dbname', ['test'])[0])
+    elif db_url.scheme == 'postgres':
+        response = db_probe_postgres(count, **db_connect_args(db_url))
+    else:
+        response = db_probe_mongodb(count, **db_connect_args(db_url))
+    response_status = 200
+    response["url"] = url
+    if response["error"]:
+        response_status = 500
+        response["error"] = 500
+        response["message"] = f"DB probe error: {response.pop('error_message')}"
+    else:
+        response["error"] = None
+        response["message"] = "completed %d round trips, p50 %s usec, p99 %s usec" % (
+            count, response["latency_usec"]["p50"], response["latency_usec"]["p99"])
+        response.pop('error_message')
+    return Response(
+        json.dumps(response),
+        status=response_status, mimetype='application/json')
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(
+        metrics.render(),
+        status=200, mimetype='text/plain; version=0.0.4')
+
+
+def profile_engine_loop(seconds):
+    """profiles the command engine loop, where command output is read,
+    batched and sent, runs on the loop"""
+    global engine_loop_capture
+    if engine_loop_capture:
+        return
+    engine_loop_capture = profile_ring.start('command engine loop', 'cprofile')
+    if engine_loop_capture:
+        command_engine.loop.call_later(seconds, finish_engine_loop_profile)
+
+
+def finish_engine_loop_profile():
+    global engine_loop_capture
+    profile_ring.finish(engine_loop_capture)
+    engine_loop_capture = None
+
+
+def set_profile_sampling(data):
+    """applies a profile message, returns the sampling settings now in use"""
+    global profile_sampling
+    if not current_config().get('profile_token'):
+        raise ValueError('profiling is off, profile_token is not set')
+    if not profile_token_valid(data.get('token')):
+        raise ValueError('invalid profile token')
+    if not profile_ring.size:
+        raise ValueError('profiling is off, profile_ring_size is 0')
+    mode = data.get('mode', 'cprofile')
+    if mode == 'off':
+        profile_sampling = dict(profile_sampling, mode=None, until=0)
+    elif mode not in PROFILE_MODES:
+        raise ValueError('unknown profile mode: %s' % mode)
+    else:
+        seconds = min(float(data.get('seconds', 60)),
+                      float(current_config().get('profile_max_seconds', 600)))
+        profile_sampling = {
+            'mode': mode,
+            'handlers': list(data.get('handlers', [])),
+            'routes': list(data.get('routes', [])),
+            'sample_rate': float(data.get('sample_rate', 1.0)),
+            'until': monotonic() + seconds
+        }
+        if 'output' in profile_sampling['handlers']:
+            command_engine.loop.call_soon_threadsafe(profile_engine_loop, seconds)
+    return {
+        'mode': profile_sampling['mode'],
+        'handlers': profile_sampling['handlers'],
+        'routes': profile_sampling['routes'],
+        'sample_rate': profile_sampling['sample_rate'],
+        'seconds': round(max(profile_sampling['until'] - monotonic(), 0), 3)
+    }
+
+
+@app.route('/profiles')
+def profiles():
+    denied = profile_access_denied()
+    if denied:
+        return denied
+    return Response(
+        json.dumps(profile_ring.list()),
+        status=200, mimetype='application/json')
+
+
+@app.route('/profiles/<int:id>')
+def get_profile(id):
+    denied = profile_access_denied()
+    if denied:
+        return denied
+    capture = profile_ring.get(id)
+    if not capture:
+        return Response(
+            json.dumps({"error": 404, "message": "profile %d is no longer kept" % id}),
+            status=404, mimetype='application/json')
+    profile_format = request.args.get('format', 'speedscope')
+    if profile_format not in capture.summary()['formats']:
+        return Response(
+            json.dumps({"error": 400, "message": "profile %d can not be sent as %s" % (id, profile_format)}),
+            status=400, mimetype='application/json')
+    if profile_format == 'pstats':
+        return Response(
+            capture.pstats(), status=200, mimetype='application/octet-stream',
+            headers={'Content-Disposition': 'attachment; filename=profile-%d.pstats' % id})
+    return Response(
+        capture.speedscope(), status=200, mimetype='application/json',
+        headers={'Content-Disposition': 'attachment; filename=profile-%d.speedscope.json' % id})
+
+
+@app.route('/processes/stats')
+def processes_stats():
+    return Response(
+        json.dumps(process_supervisor.stats()),
+        status=200, mimetype='application/json')
+
+
+@app.route('/commands/cache/stats')
+def command_cache_stats():
+    return Response(
+        json.dumps(command_cache.stats()),
+        status=200, mimetype='application/json')
+
+
+@app.route('/output/stats')
+def output_stats():
+    stats = dict(output_buffer_metrics)
+    stats['scrollback'] = scrollback.stats()
+    return Response(
+        json.dumps(stats),
+        status=200, mimetype='application/json')
+
+
+@app.route('/dbconnect/stats')
+def dbconnect_stats():
+    return Response(
+        json.dumps(db_connection_cache.stats()),
+        status=200, mimetype='application/json')
+
+
 @app.route('/dbconnect')
 def dbconnect():
     rargs = request.args
@@ -601,6 +4156,20 @@ def dbconnect():
                         "message": f"invalid DB URL scheme: {db_url.scheme}"
                     }),
                     status=400, mimetype='application/json')
+            if rargs.get("probe"):
+                try:
+                    probe = int(rargs.get("probe"))
+                    if probe < 1:
+                        raise ValueError(probe)
+                except ValueError:
+                    return Response(
+                        json.dumps({
+                            "url": rargs.get("url"),
+                            "error": 400,
+                            "message": f"invalid probe round trip count: {rargs.get('probe')}"
+                        }),
+                        status=400, mimetype='application/json')
+                return db_probe_response(rargs.get("url"), db_url, probe)
             # define type of DB and attempt the correct type of connect
             # and return the version of the db we are connected to
             if db_url.scheme == 'cosmos':
@@ -628,6 +4197,27 @@ def dbconnect():
                             "message": f"DB connection error: {ex}"
                         }),
                         status=500, mimetype='application/json')
+            db_args = db_connect_args(db_url)
+            if db_url.scheme == 'postgres':
+                response = db_connect_postgress(**db_args)
+            else:
+                response = db_connect_mongodb(**db_args)
+            if response['error']:
+                return Response(
+                    json.dumps({
+                        "url": rargs.get("url"),
+                        "error": 500,
+                        "message": f"DB connection error: {response['error_message']}"
+                    }),
+                    status=500, mimetype='application/json')
+            return Response(
+                json.dumps({
+                    "url": rargs.get("url"),
+                    "error": None,
+                    "message": f"Successfully connected to {db_url.scheme} version: {response['version']}",
+                    "version": response['version']
+                }),
+                status=200, mimetype='application/json')
         except URLError as ue:
             return Response(
                 json.dumps({
@@ -649,6 +4239,9 @@ def dbconnect():
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def get_resource(path):  # pragma: no cover
+    asset = asset_cache.get(path)
+    if asset:
+        return asset_cache.response(asset)
     mimetypes = {
         ".css": "text/css",
         ".html": "text/html",
@@ -669,9 +4262,9 @@ def client_connect():
 
 
 @websocket.on('disconnect')
-def client_disconnect():
+def client_disconnect(reason=None):
     print('client disconnected with sid: %s' % request.sid)
-    destroy_all_processes_for_sid(request.sid)
+    detach_or_destroy_sid(request.sid)
 
 
 @websocket.on_error_default
@@ -681,6 +4274,25 @@ def error_handler(e):
 
 @websocket.on('message')
 def message_handler(message, data):
+    g.config = config
+    capture = None
+    if isinstance(data, dict):
+        message_type = socketio_message_type(data)
+        socketio_messages.inc(message_type)
+        mode = requested_profile_mode(data.get('profile'), data.get('profile_token'))
+        if not mode:
+            mode = sampled_profile_mode('handlers', message_type)
+        if mode:
+            capture = profile_ring.start('%s %s' % (message, message_type), mode)
+    try:
+        handle_message(message, data)
+    finally:
+        if capture:
+            profile_ring.finish(capture)
+
+
+@traced
+def handle_message(message, data):
     print('received message: %s:%s sid: %s' % (message, data, request.sid))
     if message == 'commandRequest':
         if data['type'] == 'variable':
@@ -696,12 +4308,22 @@ def message_handler(message, data):
                 response['variableValue'] = get_nameserver()
             emit('variableResponse', response)
         elif data['type'] == 'performance':
-            print('running performance test with target: %s:%d' %
-                  (data['target'], int(data['port'])))
+            backend = data.get(
+                'backend', current_config().get('performance_backend', 'sockperf'))
             try:
-                data['target'] = socket.gethostbyname(data['target'])
-                exit_code = performance_test(
-                    request.sid, data['id'], data['sourcelabel'], data['targetlabel'], data['target'], int(data['port']), int(data['runcount']), data['latency'], data['bandwidth'])
+                if data.get('targets'):
+                    targets = performance_matrix_targets(
+                        data['targets'], int(data.get('port', 11111)))
+                    print('running performance matrix with targets: %s' %
+                          ', '.join(['%s:%d' % (t['target'], t['port']) for t in targets]))
+                    exit_code = performance_matrix(
+                        request.sid, data['id'], data['sourcelabel'], targets, int(data['runcount']), data['latency'], data['bandwidth'], backend)
+                else:
+                    print('running performance test with target: %s:%d' %
+                          (data['target'], int(data['port'])))
+                    data['target'] = socket.gethostbyname(data['target'])
+                    exit_code = performance_test(
+                        request.sid, data['id'], data['sourcelabel'], data['targetlabel'], data['target'], int(data['port']), int(data['runcount']), data['latency'], data['bandwidth'], backend)
                 complete_response = {
                     'id': data['id'],
                     'stream': 'completed',
@@ -714,7 +4336,7 @@ def message_handler(message, data):
                 error_response = {
                     'id': data['id'],
                     'stream': 'stderr',
-                    'data': "target: %s is not valid. %s - %s\n\n" % (data['target'], e.__class__.__name__, e)
+                    'data': "target: %s is not valid. %s - %s\n\n" % (data.get('target', data.get('targets')), e.__class__.__name__, e)
                 }
                 print("commandResponse to %s: %s" %
                       (error_response['stream'], error_response['data']))
@@ -727,6 +4349,33 @@ def message_handler(message, data):
                 print("commandResponse to %s: %s" %
                       (complete_response['stream'], complete_response['data']))
                 emit('commandResponse', complete_response)
+        elif data['type'] == 'resume':
+            print('resuming command %s after seq %s for sid: %s' %
+                  (data['id'], data.get('seq', 0), request.sid))
+            resume_command(request.sid, data['id'], int(data.get('seq', 0)))
+        elif data['type'] == 'profile':
+            try:
+                settings = set_profile_sampling(data)
+                print('profile sampling for sid: %s set to: %s' % (request.sid, settings))
+                response = {
+                    'id': data['id'],
+                    'stream': 'stdout',
+                    'data': "%s\n" % json.dumps(settings)
+                }
+                exit_code = 0
+            except (ValueError, TypeError) as e:
+                response = {
+                    'id': data['id'],
+                    'stream': 'stderr',
+                    'data': "profile request failed. %s\n" % e
+                }
+                exit_code = -1
+            emit('commandResponse', response)
+            emit('commandResponse', {
+                'id': data['id'],
+                'stream': 'completed',
+                'data': exit_code
+            })
         elif data['type'] == 'halt':
             destroy_all_processes_for_sid(request.sid)
             print('halting all commands for sid: %s' % request.sid)
@@ -736,38 +4385,73 @@ def message_handler(message, data):
                 'data': 0
             }
             emit('commandResponse', complete_response)
+        elif data['type'] == 'webscreenshot' and not browser_pool:
+            error_response = {
+                'id': data['id'],
+                'stream': 'stderr',
+                'data': "screenshots unavailable, pyppeteer is not installed on server.\n\n"
+            }
+            print("commandResponse to %s: %s" %
+                  (error_response['stream'], error_response['data']))
+            emit('commandResponse', error_response)
+            emit('commandResponse', {
+                'id': data['id'],
+                'stream': 'completed',
+                'data': -1
+            })
         elif data['type'] == 'webscreenshot':
             print('getting web screen shot for: %s' % data['target'])
+            sid = request.sid
+            id = data['id']
             try:
-                if not os.path.exists:
-                    os.makedirs(PUPPETEER_HOME)
                 urlparse(data['target'])
-                scripting_path = os.path.dirname(os.path.realpath(__file__))
-                snapshot_file_name = "%s.jpg" % base64.b64encode(
-                    data['target'].encode()).decode()
-                snapshot_file_path = "%s/%s" % (
-                    PUPPETEER_HOME, snapshot_file_name)
-                cmd = "%s/web_screenshot.py --url '%s' --screenshot '%s'" % (
-                    scripting_path, data['target'], snapshot_file_path)
-                print('running command: %s' % cmd)
-                env = {'PYPPETEER_HOME': PUPPETEER_HOME}
-                exit_code = run_cmd(request.sid, cmd, data['id'], env)
-                display_response = {
-                    'id': data['id'],
-                    'stream': 'image',
-                    'data': "/webscreenshots/%s" % snapshot_file_name
-                }
-                print("commandResponse to %s: %s" %
-                      (display_response['stream'], display_response['data']))
-                emit('commandResponse', display_response)
-                complete_response = {
-                    'id': data['id'],
-                    'stream': 'completed',
-                    'data': exit_code
-                }
-                print("commandResponse to %s: %s" %
-                      (complete_response['stream'], complete_response['data']))
-                emit('commandResponse', complete_response)
+
+                def screenshot_completed(future):
+                    exit_code = 0
+                    if future.cancelled():
+                        exit_code = -1
+                        error_response = {
+                            'id': id,
+                            'stream': 'stderr',
+                            'data': "screenshot of %s cancelled.\n\n" % data['target']
+                        }
+                        websocket.emit('commandResponse', error_response,
+                                       to=sid, namespace='/')
+                    elif future.exception():
+                        exit_code = -1
+                        error = future.exception()
+                        error_response = {
+                            'id': id,
+                            'stream': 'stderr',
+                            'data': "screenshot of %s failed. %s - %s\n\n" % (data['target'], error.__class__.__name__, error)
+                        }
+                        print("commandResponse to %s: %s" %
+                              (error_response['stream'], error_response['data']))
+                        websocket.emit('commandResponse', error_response,
+                                       to=sid, namespace='/')
+                    else:
+                        display_response = {
+                            'id': id,
+                            'stream': 'image',
+                            'data': "/webscreenshots/%s" % future.result()
+                        }
+                        print("commandResponse to %s: %s" %
+                              (display_response['stream'], display_response['data']))
+                        websocket.emit('commandResponse', display_response,
+                                       to=sid, namespace='/')
+                    complete_response = {
+                        'id': id,
+                        'stream': 'completed',
+                        'data': exit_code
+                    }
+                    print("commandResponse to %s: %s" %
+                          (complete_response['stream'], complete_response['data']))
+                    websocket.emit('commandResponse', complete_response,
+                                   to=sid, namespace='/')
+
+                screenshot_cache.screenshot(
+                    sid, data['target'], browser_pool.capture).add_done_callback(
+                        screenshot_completed)
             except Exception as e:
                 error_response = {
                     'id': data['id'],
@@ -786,17 +4470,24 @@ def message_handler(message, data):
                       (complete_response['stream'], complete_response['data']))
                 emit('commandResponse', complete_response)
         else:
-            if command_allowed(data['cmd']):
-                print('running %s for sid: %s' % (data['cmd'], request.sid))
-                exit_code = run_cmd(request.sid, data['cmd'], data['id'])
-                complete_response = {
-                    'id': data['id'],
-                    'stream': 'completed',
-                    'data': exit_code
-                }
-                print("commandResponse to %s: %s" %
-                      (complete_response['stream'], complete_response['data']))
-                emit('commandResponse', complete_response)
+            rule = command_allowed(data['cmd'])
+            if rule:
+                print('running %s for sid: %s allowed by rule: %s' %
+                      (data['cmd'], request.sid, rule))
+                sid = request.sid
+                id = data['id']
+
+                def command_completed(exit_code):
+                    complete_response = {
+                        'id': id,
+                        'stream': 'completed',
+                        'data': exit_code
+                    }
+                    print("commandResponse to %s: %s" %
+                          (complete_response['stream'], complete_response['data']))
+                    scrollback.emit(sid, id, complete_response)
+                # returns right away, the engine loop reports completion
+                run_cmd(sid, data['cmd'], id, on_complete=command_completed)
             else:
                 error_response = {
                     'id': data['id'],
@@ -818,7 +4509,56 @@ def message_handler(message, data):
         print("recieved unknown message: %s:%s" % (message, data))
 
 
+def start_services(probe_server=True):
+    """starts the background work of a process serving requests"""
+    process_supervisor.become_subreaper()
+    reap_orphaned_children()
+    command_engine.loop.call_soon_threadsafe(scrollback.sweep)
+    if probe_server:
+        start_probe_server()
+    sweep_db_connection_cache()
+    watch_config_map()
+    command_engine.loop.call_soon_threadsafe(screenshot_cache.sweep)
+    control_bus.start()
+
+
+def run_workers(count):
+    """runs count gunicorn gthread workers accepting on one listener
+
+    each worker imports this module fresh, so no thread state is
+    inherited, and gunicorn restarts workers that exit. gunicorn.conf.py
+    starts the background services in every worker. The launcher serves
+    the native probe port for the whole pod.
+    """
+    start_probe_server()
+    server = subprocess.Popen([
+        sys.executable, '-m', 'gunicorn',
+        '--config', os.path.join(root_dir(), 'gunicorn.conf.py'),
+        '--chdir', root_dir(),
+        '--bind', '%s:%d' % (config['http_listen_address'], int(config['http_listen_port'])),
+        '--workers', str(count),
+        '--worker-class', 'gthread',
+        # every websocket connection holds one thread of its worker
+        '--threads', str(int(config.get('worker_threads', 100))),
+        'app:app'])
+
+    def stop(signum, frame):
+        server.send_signal(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    sys.exit(server.wait())
+
+
 if __name__ == "__main__":
+    worker_count = int(config.get('workers', 1))
+    if worker_count > 1:
+        if not message_queue:
+            # rooms, resume and halt can not reach the other workers
+            print('workers is set to %d but message_queue is not set, '
+                  'several workers need a message_queue' % worker_count)
+            sys.exit(1)
+        run_workers(worker_count)
+    start_services()
     websocket.run(
         app,
         host=config['http_listen_address'],
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import os
 import sys
+import json
 import argparse
 import socketio
 import uuid
@@ -9,6 +10,20 @@ import signal
 from urllib.parse import urlparse
 
 sio = socketio.Client()
+json_results = False
+# the command in flight and the last output seq received, for resuming
+running_command = {'id': None, 'seq': 0}
+
+
+@sio.event
+def connect():
+    if running_command['id']:
+        sys.stderr.write('reconnected, resuming command output\n')
+        sio.emit('message', data=('commandRequest', {
+            'id': running_command['id'],
+            'type': 'resume',
+            'seq': running_command['seq']
+        }))
 
 
 @sio.event
@@ -18,13 +33,21 @@ def connect_error(data):
 
 @sio.on('commandResponse')
 def command_response(data):
+    if 'seq' in data:
+        if data['seq'] <= running_command['seq']:
+            return
+        running_command['seq'] = data['seq']
     if data['stream'] == 'completed':
         sio.disconnect()
         sys.exit(data)
-    if data['stream'] == 'stdout':
+    if data['stream'] == 'stdout' and not json_results:
         sys.stdout.write(data['data'])
+    if data['stream'] == 'result' and json_results:
+        sys.stdout.write("%s\n" % json.dumps(data['data']))
     if data['stream'] == 'stderr':
         sys.stderr.write(data['data'])
+    if data['stream'] == 'queued':
+        sys.stderr.write("queued on server at position %d\n" % data['data'])
 
 
 def sig_hanler(sig, fame):
@@ -40,13 +63,17 @@ def main():
     sample_usage = '''
 If cmd is set to "performance", please include the following:
 
---performance-target, -t = target name or IP for the performance report
+--performance-target, -t = target name or IP for the performance report,
+                           a comma separated list runs a concurrent matrix
+                           report, entries can include a :port
 --performance-target-port, -p = target port (default is 11111)
 --performance-run-count, -c = number of runs in the report
 --performance-latency, -l =  include latency measurement in report
 --performance-bandwidth, -b = include bandwidth measurement in report
 --performance-source-label, -sl = your report source label
 --performance-target-label, -tl = your report target label
+--performance-backend, -be = native or sockperf (default is sockperf)
+--performance-json, -j = write JSON result rows instead of CSV
  
  
 '''
@@ -105,6 +132,22 @@ If cmd is set to "performance", please include the following:
         help='performance target label in report',
         default=os.getenv('PERFORMANCE_SOURCE_LABEL', 'target')
     )
+    ap.add_argument(
+        '-be', '--performance_backend',
+        help='performance probe backend, native or sockperf',
+        choices=['native', 'sockperf'],
+        default=os.getenv('PERFORMANCE_BACKEND', 'sockperf')
+    )
+    ap.add_argument(
+        '-j', '--performance_json',
+        help='write JSON result rows with latency percentiles instead of CSV',
+        action='store_true'
+    )
+    ap.add_argument(
+        '-ws', '--websocket',
+        help='connect with the websocket transport only, needed when the server runs several workers',
+        action='store_true'
+    )
 
     args = ap.parse_args()
 
@@ -114,6 +157,8 @@ If cmd is set to "performance", please include the following:
     bandwidth = False
     if args.performance_bandwidth:
         bandwidth = True
+    global json_results
+    json_results = args.performance_json
 
     url = args.url
     if not args.url:
@@ -139,8 +184,12 @@ If cmd is set to "performance", please include the following:
 
     try:
         signal.signal(signal.SIGINT, sig_hanler)
-        sio.connect(url)
+        if args.websocket:
+            sio.connect(url, transports=['websocket'])
+        else:
+            sio.connect(url)
         request_uuid = str(uuid.uuid4())
+        running_command['id'] = request_uuid
         if cmd == 'performance':
             commandRequest = {
                 'id': request_uuid,
@@ -152,8 +201,12 @@ If cmd is set to "performance", please include the following:
                 'runcount': int(args.performance_run_count),
                 'latency': latency,
                 'bandwidth': bandwidth,
+                'backend': args.performance_backend,
                 'cmd': ''
             }
+            if ',' in args.performance_target:
+                commandRequest['targets'] = [
+                    t.strip() for t in args.performance_target.split(',') if t.strip()]
             sio.emit('message', data=('commandRequest', commandRequest))
         else:
             commandRequest = {
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import re
+import argparse
+import random
+import timeit
+
+REGEX_METACHARACTERS = '.^$*+?{}[]\\|()'
+QUANTIFIERS = '*+?{'
+# numbered back references and leading global flags change meaning
+# when a rule is wrapped in a group, so those rules are matched alone
+NOT_COMBINABLE = re.compile(r'\\[1-9]|^\(\?[aiLmsux]+\)')
+
+
+def literal_prefix(rule):
+    """the literal text every command matching rule must start with"""
+    if '|' in rule.replace('\\|', ''):
+        return ''
+    prefix = []
+    i = 1 if rule.startswith('^') else 0
+    while i < len(rule):
+        c = rule[i]
+        if c == '\\' and i + 1 < len(rule) and not rule[i + 1].isalnum():
+            c = rule[i + 1]
+            step = 2
+        elif c in REGEX_METACHARACTERS:
+            break
+        else:
+            step = 1
+        if i + step < len(rule) and rule[i + step] in QUANTIFIERS:
+            break
+        prefix.append(c)
+        i += step
+    return ''.join(prefix)
+
+
+class AllowlistMatcher(object):
+    """allowed_commands compiled once into first character buckets
+
+    each bucket holds the rules whose literal prefix starts with that
+    character plus every rule without a literal prefix, joined into a
+    single alternation in config order, so a command is tested against
+    one regex and the first matching rule is reported. Rules that cannot
+    share a regex, such as rules using the same group name, are split
+    into separate regexes, still tested in config order.
+    """
+
+    def __init__(self, rules):
+        self.source = rules
+        self.rules = []
+        self.prefixes = []
+        for rule in rules or []:
+            rule = r"%s" % rule
+            try:
+                re.compile(rule)
+            except re.error as ree:
+                print('skipping invalid allowed_commands rule: %s - %s' % (rule, ree))
+                continue
+            self.rules.append(rule)
+            self.prefixes.append(literal_prefix(rule))
+        self.buckets = {}
+        for first in set(p[0] for p in self.prefixes if p):
+            self.buckets[first] = self.segments(
+                [i for i, p in enumerate(self.prefixes) if not p or p[0] == first])
+        self.default = self.segments(
+            [i for i, p in enumerate(self.prefixes) if not p])
+
+    def segments(self, indexes):
+        """consecutive combinable rules as one regex, others on their own"""
+        segments = []
+        group = []
+        for i in indexes:
+            if NOT_COMBINABLE.search(self.rules[i]):
+                if group:
+                    segments.extend(self.combine(group))
+                    group = []
+                segments.append((re.compile(self.rules[i]), i))
+            else:
+                group.append(i)
+        if group:
+            segments.extend(self.combine(group))
+        return segments
+
+    def combine(self, indexes):
+        """indexes as few regexes as compile, each rule is valid alone"""
+        if len(indexes) == 1:
+            return [(re.compile(self.rules[indexes[0]]), indexes[0])]
+        pattern = '|'.join('(?P<r%d>%s)' % (i, self.rules[i]) for i in indexes)
+        try:
+            return [(re.compile(pattern), None)]
+        except re.error:
+            # named groups repeated across rules or flags that only work
+            # at the start of a pattern, split until the halves compile
+            half = len(indexes) // 2
+            return self.combine(indexes[:half]) + self.combine(indexes[half:])
+
+    def match(self, cmd):
+        """returns the first allowed_commands rule matching cmd, or None"""
+        for regex, i in self.buckets.get(cmd[:1], self.default):
+            m = regex.match(cmd)
+            if not m:
+                continue
+            if i is None:
+                return self.rules[int(m.lastgroup[1:])]
+            return self.rules[i]
+        return None
+
+
+def benchmark_rules(count):
+    tools = ['ping', 'curl', 'dig', 'nc', 'kubectl', 'tcping', 'traceroute',
+             'iperf3', 'sockperf', 'whois', 'siege', 'ab', 'netstat', 'ip']
+    rules = []
+    for i in range(count):
+        tool = tools[i % len(tools)]
+        if i % 10 == 9:
+            rules.append(r"(sudo )?%s -c \d+ host%d\.svc$" % (tool, i))
+        else:
+            rules.append(r"^%s -n ns%d .*" % (tool, i))
+    return rules
+
+
+def benchmark_commands(rules, count):
+    commands = []
+    for i in range(count):
+        n = random.randrange(len(rules))
+        tool = rules[n].lstrip('^').split(' ')[0]
+        if i % 2:
+            commands.append('%s -n ns%d --all' % (tool, n))
+        else:
+            commands.append('rm -rf /tmp/%d' % n)
+    return commands
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        prog='command_allowlist',
+        usage='%(prog)s.py [options]',
+        description='compares the compiled allowlist matcher with per rule re.match'
+    )
+    ap.add_argument(
+        '--rules',
+        help='number of allowed_commands rules to generate',
+        type=int,
+        default=500
+    )
+    ap.add_argument(
+        '--commands',
+        help='number of distinct commands to check, half allowed and half denied',
+        type=int,
+        default=200
+    )
+    ap.add_argument(
+        '--iterations',
+        help='passes over the command list for each matcher',
+        type=int,
+        default=20
+    )
+    args = ap.parse_args()
+    random.seed(0)
+    rules = benchmark_rules(args.rules)
+    commands = benchmark_commands(rules, args.commands)
+
+    def legacy(cmd):
+        for regex in rules:
+            if re.match(r"%s" % regex, cmd):
+                return regex
+        return None
+
+    build_seconds = timeit.timeit(lambda: AllowlistMatcher(rules), number=1)
+    matcher = AllowlistMatcher(rules)
+    for cmd in commands:
+        if bool(legacy(cmd)) != bool(matcher.match(cmd)):
+            print('mismatch for command: %s' % cmd)
+    checks = args.commands * args.iterations
+    legacy_seconds = timeit.timeit(
+        lambda: [legacy(cmd) for cmd in commands], number=args.iterations)
+    matcher_seconds = timeit.timeit(
+        lambda: [matcher.match(cmd) for cmd in commands], number=args.iterations)
+    print('rules: %d, checks: %d, build: %.3f ms' %
+          (len(rules), checks, build_seconds * 1000))
+    print('per rule re.match:  %.3f usec/check' % (legacy_seconds / checks * 1000000))
+    print('compiled matcher:   %.3f usec/check' % (matcher_seconds / checks * 1000000))
+    print('speedup:            %.1fx' % (legacy_seconds / matcher_seconds))
+
+
+if __name__ == '__main__':
+    main()
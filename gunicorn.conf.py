@@ -0,0 +1,7 @@
+# gunicorn settings for the workers started by app.py when workers > 1
+
+
+def post_worker_init(worker):
+    # the worker has imported app.py, start its sweeps, watchers and control bus
+    import app
+    app.start_services(probe_server=False)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import argparse
+import threading
+import timeit
+from bisect import bisect_left
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value in (float('inf'), float('-inf')):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(pairs)
+
+
+def merge_cell(target, cell):
+    """adds the counts of cell into target, copying histogram lists"""
+    for key, value in cell.items():
+        if isinstance(value, list):
+            counts = target.get(key)
+            if counts is None:
+                target[key] = list(value)
+            else:
+                for i, count in enumerate(value):
+                    counts[i] += count
+        else:
+            target[key] = target.get(key, 0) + value
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def label_text(self, labelvalues, names=(), values=()):
+        """the labels of a sample, after the labels every sample of the registry has"""
+        registry = self.registry
+        return format_labels(registry.const_names + self.labels + names,
+                             registry.const_values + tuple(labelvalues) + values)
+
+    def inc(self, *labelvalues, amount=1):
+        cell = self.registry.cell()
+        key = (self, labelvalues)
+        cell[key] = cell.get(key, 0) + amount
+
+    def render(self, lines, samples):
+        if not samples and not self.labels:
+            samples = [((), 0)]
+        for labelvalues, value in samples:
+            lines.append('%s%s %s' % (self.name, self.label_text(labelvalues),
+                                      format_value(value)))
+
+
+class Histogram(Counter):
+    """counts per bucket, the last two slots are +Inf and the sum"""
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        cell = self.registry.cell()
+        key = (self, labelvalues)
+        counts = cell.get(key)
+        if counts is None:
+            counts = cell[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self, lines, samples):
+        for labelvalues, counts in samples:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name, self.label_text(labelvalues, ('le',), (format_value(float(bound)),)),
+                    cumulative))
+            labels = self.label_text(labelvalues)
+            lines.append('%s_sum%s %s' % (self.name, labels, format_value(counts[-1])))
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+
+
+class Callback(Counter):
+    """values read when scraped, collect returns a number or a dict of
+    label value tuples to numbers"""
+
+    def __init__(self, registry, name, help, collect, labels=(), kind='gauge'):
+        super().__init__(registry, name, help, labels)
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        values = self.collect()
+        if isinstance(values, dict):
+            return list(values.items())
+        return [((), values)]
+
+
+class MetricsRegistry(object):
+    """counters and histograms recorded into per thread cells
+
+    every thread records into its own dict, so recording takes no lock
+    and never contends with other threads. the cells are only read and
+    merged when metrics are scraped. the cells of threads that have
+    exited are folded into one retired cell, when metrics are scraped and
+    whenever the number of cells doubles, so the threads started per
+    request do not pile up between scrapes.
+
+    labels are added to every sample, such as the worker process that
+    recorded it.
+    """
+
+    PRUNE_MIN_CELLS = 64
+
+    def __init__(self, labels=None):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.cells = []
+        self.prune_at = self.PRUNE_MIN_CELLS
+        self.retired = {}
+        self.metrics = []
+        labels = labels or {}
+        self.const_names = tuple(labels.keys())
+        self.const_values = tuple(labels.values())
+
+    def cell(self):
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = self.local.cell = {}
+            with self.lock:
+                self.cells.append((threading.current_thread(), cell))
+                if len(self.cells) > self.prune_at:
+                    self.prune()
+                    self.prune_at = max(self.PRUNE_MIN_CELLS, 2 * len(self.cells))
+            return cell
+
+    def prune(self):
+        """folds the cells of exited threads into the retired cell, holding the lock"""
+        live = []
+        for thread, cell in self.cells:
+            if thread.is_alive():
+                live.append((thread, cell))
+            else:
+                merge_cell(self.retired, cell)
+        self.cells = live
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(self, name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        metric = Histogram(self, name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def callback(self, name, help, collect, labels=(), kind='gauge'):
+        metric = Callback(self, name, help, collect, labels, kind)
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        """the cells of every thread merged, keyed by metric and label values"""
+        merged = {}
+        with self.lock:
+            self.prune()
+            for thread, cell in self.cells:
+                # dict.copy holds the GIL, the owning thread may keep recording
+                merge_cell(merged, cell.copy())
+            merge_cell(merged, self.retired)
+        return merged
+
+    def render(self):
+        """every metric in the Prometheus text exposition format"""
+        samples = {}
+        for (metric, labelvalues), value in self.collect().items():
+            samples.setdefault(metric, []).append((labelvalues, value))
+        lines = []
+        for metric in self.metrics:
+            if isinstance(metric, Callback):
+                try:
+                    metric_samples = metric.samples()
+                except Exception as ex:
+                    print('failed to collect metric %s: %s' % (metric.name, ex))
+                    continue
+            else:
+                metric_samples = samples.get(metric, [])
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            metric.render(lines, sorted(
+                metric_samples, key=lambda sample: tuple(str(v) for v in sample[0])))
+        return '\n'.join(lines) + '\n'
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        prog='metrics',
+        usage='%(prog)s.py [options]',
+        description='compares per thread metric cells with a counter behind a shared lock'
+    )
+    ap.add_argument(
+        '--threads',
+        help='number of threads recording at the same time',
+        type=int,
+        default=8
+    )
+    ap.add_argument(
+        '--increments',
+        help='increments recorded by each thread',
+        type=int,
+        default=200000
+    )
+    args = ap.parse_args()
+
+    registry = MetricsRegistry()
+    frames = registry.counter('frames_total', 'frames', ('stream',))
+    latency = registry.histogram('latency_seconds', 'latency')
+    shared = {}
+    shared_lock = threading.Lock()
+
+    def locked(stream):
+        with shared_lock:
+            shared[stream] = shared.get(stream, 0) + 1
+
+    def run(record):
+        threads = [threading.Thread(target=lambda: [record() for i in range(args.increments)])
+                   for i in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    total = args.threads * args.increments
+    locked_seconds = timeit.timeit(lambda: run(lambda: locked('stdout')), number=1)
+    cell_seconds = timeit.timeit(lambda: run(lambda: frames.inc('stdout')), number=1)
+    histogram_seconds = timeit.timeit(lambda: run(lambda: latency.observe(0.004)), number=1)
+    merged = registry.collect()
+    if merged[(frames, ('stdout',))] != total or shared['stdout'] != total:
+        print('counts do not match: %d, %d, %d' %
+              (merged[(frames, ('stdout',))], shared['stdout'], total))
+    print('threads: %d, increments: %d' % (args.threads, total))
+    print('shared lock counter:  %.3f usec/inc' % (locked_seconds / total * 1000000))
+    print('per thread counter:   %.3f usec/inc' % (cell_seconds / total * 1000000))
+    print('per thread histogram: %.3f usec/observe' % (histogram_seconds / total * 1000000))
+
+
+if __name__ == '__main__':
+    main()
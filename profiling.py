@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import cProfile
+import functools
+import json
+import marshal
+import threading
+import time
+from collections import deque
+from time import perf_counter
+
+SPEEDSCOPE_SCHEMA = 'https://www.speedscope.app/file-format-schema.json'
+MAX_STACK_DEPTH = 64
+
+# spans of the trace running on each thread, None when not tracing
+tracing = threading.local()
+
+
+def traced(fn):
+    """records a span for fn while a trace is active on the calling thread"""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        events = getattr(tracing, 'events', None)
+        if events is None:
+            return fn(*args, **kwargs)
+        events.append(('O', name, perf_counter()))
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            events.append(('C', name, perf_counter()))
+    return wrapper
+
+
+def function_label(key):
+    filename, line, function = key
+    if filename == '~':
+        # built in functions have no source file
+        return function, None, None
+    return function, filename, line
+
+
+class Capture(object):
+    """a cProfile profile or span trace of the thread that started it"""
+
+    def __init__(self, id, name, mode):
+        self.id = id
+        self.name = name
+        self.mode = mode
+        self.started = time.time()
+        self.duration = None
+        self.profile = None
+        self.stats = None
+        self.events = None
+
+    def start(self):
+        """False when another profiler is already active"""
+        self.begin = perf_counter()
+        if self.mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError:
+                # python 3.12 and later allow one profiler at a time
+                self.profile = None
+                return False
+        else:
+            self.events = [('O', self.name, self.begin)]
+            tracing.events = self.events
+        return True
+
+    def stop(self):
+        end = perf_counter()
+        if self.mode == 'cprofile':
+            self.profile.disable()
+            self.profile.create_stats()
+            self.stats = self.profile.stats
+            self.profile = None
+        else:
+            tracing.events = None
+            self.events.append(('C', self.name, end))
+        self.duration = end - self.begin
+
+    def summary(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'mode': self.mode,
+            'started': self.started,
+            'duration_ms': round(self.duration * 1000.0, 3),
+            'formats': ['pstats', 'speedscope'] if self.mode == 'cprofile' else ['speedscope']
+        }
+
+    def pstats(self):
+        """the stats in the file format written by pstats.Stats.dump_stats"""
+        return marshal.dumps(self.stats)
+
+    def speedscope(self):
+        frames = []
+        indexes = {}
+
+        def frame(key):
+            if key not in indexes:
+                name, filename, line = function_label(key) if isinstance(key, tuple) else (key, None, None)
+                entry = {'name': name}
+                if filename:
+                    entry['file'] = filename
+                    entry['line'] = line
+                indexes[key] = len(frames)
+                frames.append(entry)
+            return indexes[key]
+
+        if self.mode == 'cprofile':
+            profile = self.sampled_profile(frame)
+        else:
+            profile = {
+                'type': 'evented',
+                'name': self.name,
+                'unit': 'milliseconds',
+                'startValue': 0,
+                'endValue': round(self.duration * 1000.0, 6),
+                'events': [{'type': kind, 'frame': frame(name),
+                            'at': round((at - self.begin) * 1000.0, 6)}
+                           for kind, name, at in self.events]
+            }
+        return json.dumps({
+            '$schema': SPEEDSCOPE_SCHEMA,
+            'name': self.name,
+            'exporter': 'container-demo-runner',
+            'shared': {'frames': frames},
+            'profiles': [profile]
+        })
+
+    def sampled_profile(self, frame):
+        """cProfile keeps callers, not stacks, so each function's own time
+        is shown under the chain of its heaviest callers"""
+        samples = []
+        weights = []
+        for key, (cc, nc, tt, ct, callers) in self.stats.items():
+            if tt <= 0:
+                continue
+            stack = [key]
+            while len(stack) < MAX_STACK_DEPTH:
+                callers = self.stats.get(stack[-1], (0, 0, 0, 0, {}))[4]
+                if not callers:
+                    break
+                caller = max(callers, key=lambda k: callers[k][3])
+                if caller in stack:
+                    break
+                stack.append(caller)
+            samples.append([frame(k) for k in reversed(stack)])
+            weights.append(tt)
+        return {
+            'type': 'sampled',
+            'name': self.name,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': samples,
+            'weights': weights
+        }
+
+
+class ProfileRing(object):
+    """the last size captures, oldest dropped first"""
+
+    def __init__(self, size):
+        self.size = size
+        self.captures = deque(maxlen=max(size, 1))
+        self.lock = threading.Lock()
+        self.last_id = 0
+
+    def start(self, name, mode):
+        """a running capture, or None when profiling is off or busy"""
+        if not self.size:
+            return None
+        with self.lock:
+            self.last_id += 1
+            capture = Capture(self.last_id, name, mode)
+        if not capture.start():
+            return None
+        return capture
+
+    def finish(self, capture):
+        capture.stop()
+        with self.lock:
+            self.captures.append(capture)
+
+    def get(self, id):
+        with self.lock:
+            for capture in self.captures:
+                if capture.id == id:
+                    return capture
+        return None
+
+    def list(self):
+        with self.lock:
+            return [capture.summary() for capture in self.captures]
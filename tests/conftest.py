@@ -0,0 +1,23 @@
+import pytest
+
+
+class FakeWebsocket(object):
+    """records what the service emits to Socket.IO clients"""
+
+    def __init__(self):
+        self.sent = []
+
+    def emit(self, event, data, to=None, namespace=None):
+        self.sent.append((to, data))
+
+    def frames(self, id, stream=None):
+        return [data for to, data in self.sent
+                if data.get('id') == id and (stream is None or data['stream'] == stream)]
+
+
+@pytest.fixture
+def websocket(monkeypatch):
+    import app
+    websocket = FakeWebsocket()
+    monkeypatch.setattr(app, 'websocket', websocket)
+    return websocket
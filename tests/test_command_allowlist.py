@@ -0,0 +1,69 @@
+import os
+import random
+import re
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from command_allowlist import AllowlistMatcher, benchmark_commands, benchmark_rules  # noqa: E402
+
+
+def first_match(rules, cmd):
+    for rule in rules:
+        if re.match(r"%s" % rule, cmd):
+            return rule
+    return None
+
+
+def assert_agrees(rules, commands):
+    matcher = AllowlistMatcher(rules)
+    for cmd in commands:
+        assert matcher.match(cmd) == first_match(rules, cmd), cmd
+
+
+def test_agrees_with_per_rule_match_on_generated_rules():
+    random.seed(1)
+    rules = benchmark_rules(300)
+    assert_agrees(rules, benchmark_commands(rules, 400) + ['', 'p', 'ping'])
+
+
+def test_first_matching_rule_in_config_order_is_reported():
+    rules = [r'^ping -c \d+ .*', r'^ping .*', r'.*']
+    matcher = AllowlistMatcher(rules)
+    assert matcher.match('ping -c 3 web') == rules[0]
+    assert matcher.match('ping web') == rules[1]
+    assert matcher.match('dig web') == rules[2]
+
+
+def test_rules_with_the_same_group_name_are_matched_separately():
+    rules = [r'^(?P<tool>ping) (?P<host>\w+)$', r'^(?P<tool>dig) (?P<host>\w+)$',
+             r'^(?P<tool>curl) .*', r'^nc -z \w+ \d+$']
+    assert_agrees(rules, ['ping web', 'dig web', 'curl -v http://web', 'nc -z web 80',
+                          'ping two words', 'dig', 'rm -rf /'])
+
+
+def test_anchors_and_alternation_stay_inside_their_rule():
+    rules = [r'ping|dig .*', r'^curl (-v )?http://\w+$', r'(nc|ncat) -z .*', r'^ip a$']
+    assert_agrees(rules, ['ping', 'ping web', 'dig web', 'dig', 'curl http://web',
+                          'curl -v http://web', 'curl http://web/path', 'nc -z web 80',
+                          'ncat -z web 80', 'ip a', 'ip addr', 'rm; ping'])
+
+
+def test_rules_that_cannot_be_combined():
+    rules = [r'^echo (\w+) \1$', r'(?i)^uptime$', r'^date$', r'^who(?i:ami)$']
+    assert_agrees(rules, ['echo a a', 'echo a b', 'UPTIME', 'uptime', 'date', 'DATE',
+                          'whoAMI', 'WHOami'])
+
+
+@pytest.mark.parametrize('rules', [None, [], ['[unclosed']])
+def test_no_valid_rules_allow_nothing(rules):
+    assert AllowlistMatcher(rules).match('ping web') is None
+
+
+def test_invalid_rules_are_skipped():
+    matcher = AllowlistMatcher(['[unclosed', r'^ping .*'])
+    assert matcher.rules == [r'^ping .*']
+    assert matcher.match('ping web') == r'^ping .*'
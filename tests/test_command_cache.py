@@ -0,0 +1,124 @@
+import os
+import sys
+from threading import Event
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.environ.setdefault('CONFIG_FILE', os.path.join(ROOT, 'config.yaml'))
+
+import app  # noqa: E402
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def cache(monkeypatch, websocket):
+    cache = app.CommandResultCache()
+    supervisor = app.ProcessSupervisor()
+    supervisor.limits = lambda: (8, 8, 8)
+    monkeypatch.setattr(app, 'command_cache', cache)
+    monkeypatch.setattr(app, 'process_supervisor', supervisor)
+    monkeypatch.setitem(app.config, 'cacheable_commands', {
+        r'^echo cached$': 5,
+        r'^sh -c .*': 5
+    })
+    return cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app, 'monotonic', clock)
+    return clock
+
+
+def run(sid, cmd, id):
+    return app.run_cmd(sid, cmd, id).result(5)
+
+
+def stdout(websocket, id):
+    return ''.join(frame['data'] for frame in websocket.frames(id, 'stdout'))
+
+
+@pytest.mark.parametrize('cmd, key', [
+    ('echo cached', 'echo cached'),
+    ('  echo   cached ', 'echo cached'),
+    ("echo 'cached'", 'echo cached'),
+    ('echo "a b"', 'echo "a b"'),
+    ('cat /etc/hosts | wc -l', 'cat /etc/hosts | wc -l'),
+    ("echo 'unterminated", "echo 'unterminated"),
+])
+def test_key_normalizes_only_plain_words(cmd, key):
+    assert app.CommandResultCache().key_for(cmd) == key
+
+
+def test_ttl_comes_from_the_first_matching_rule(cache):
+    assert cache.ttl_for('echo cached') == 5.0
+    assert cache.ttl_for("echo  'cached'") == 5.0
+    assert cache.ttl_for('echo cached; rm -rf /') is None
+    assert cache.ttl_for('echo other') is None
+
+
+def test_output_is_replayed_within_the_ttl(cache, clock, websocket):
+    assert run('a', 'echo cached', 1) == 0
+    assert run('b', "echo  'cached'", 2) == 0
+    assert stdout(websocket, 1) == stdout(websocket, 2) == 'cached\n'
+    assert websocket.frames(2, 'stdout')[0]['seq'] == 1
+    stats = cache.stats()
+    assert (stats['misses'], stats['hits']) == (1, 1)
+
+
+def test_expired_output_is_run_again_and_evicted(cache, clock, websocket):
+    run('a', 'echo cached', 1)
+    clock.now += 6
+    run('a', 'echo cached', 2)
+    assert cache.stats()['misses'] == 2
+    assert cache.stats()['entries'] == 1
+    run('a', 'sh -c "exit 0"', 3)
+    clock.now += 6
+    # the next miss drops both expired entries before adding its own
+    run('a', 'sh -c "echo other"', 4)
+    assert list(cache.entries) == ['sh -c "echo other"']
+
+
+def test_failed_runs_are_not_cached(cache, websocket):
+    assert run('a', 'sh -c "exit 3"', 1) == 3
+    assert run('a', 'sh -c "exit 3"', 2) == 3
+    assert cache.stats()['misses'] == 2
+    assert not cache.entries
+
+
+def test_concurrent_requests_share_one_run(cache, websocket, monkeypatch):
+    release = Event()
+    launched = []
+    launch = app.process_supervisor.launch
+
+    def slow_launch(sid, cmd, *args, **kwargs):
+        launched.append(cmd)
+        release.wait(5)
+        return launch(sid, cmd, *args, **kwargs)
+    monkeypatch.setattr(app.process_supervisor, 'launch', slow_launch)
+    futures = [app.run_cmd(sid, 'echo cached', i) for i, sid in enumerate('abc')]
+    release.set()
+    assert [future.result(5) for future in futures] == [0, 0, 0]
+    assert launched == ['echo cached']
+    assert cache.stats()['shared'] == 2
+    assert all(stdout(websocket, i) == 'cached\n' for i in range(3))
+
+
+def test_other_commands_bypass_the_cache(cache, websocket):
+    assert run('a', 'echo other', 1) == 0
+    # an env is only passed by internal callers, their commands are never cached
+    assert app.run_cmd('a', 'echo cached', 2, env=dict(os.environ)).result(5) == 0
+    assert stdout(websocket, 1) == 'other\n'
+    assert stdout(websocket, 2) == 'cached\n'
+    assert cache.stats() == {'entries': 0, 'in_flight': 0, 'hits': 0, 'shared': 0, 'misses': 0}
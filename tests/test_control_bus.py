@@ -0,0 +1,138 @@
+import json
+import os
+import queue
+import sys
+import time
+from threading import Lock
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.environ.setdefault('CONFIG_FILE', os.path.join(ROOT, 'config.yaml'))
+
+import app  # noqa: E402
+
+
+class FakePubSub(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.messages = queue.Queue()
+
+    def subscribe(self, channel):
+        self.server.subscribe(channel, self)
+
+    def listen(self):
+        while True:
+            item = self.messages.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self.server.unsubscribe(self)
+
+
+class FakeRedis(object):
+    """in-process stand-in for the Redis publish and subscribe calls"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.subscribers = {}
+        self.subscriptions = 0
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+    def subscribe(self, channel, pubsub):
+        with self.lock:
+            self.subscribers.setdefault(channel, []).append(pubsub)
+            self.subscriptions += 1
+
+    def unsubscribe(self, pubsub):
+        with self.lock:
+            for subscribers in self.subscribers.values():
+                if pubsub in subscribers:
+                    subscribers.remove(pubsub)
+
+    def publish(self, channel, data):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, []))
+        for pubsub in subscribers:
+            pubsub.messages.put({'type': 'message', 'channel': channel, 'data': data})
+        return len(subscribers)
+
+    def drop_connections(self):
+        with self.lock:
+            subscribers = [p for ps in self.subscribers.values() for p in ps]
+        for pubsub in subscribers:
+            pubsub.messages.put(ConnectionError('Connection closed by server.'))
+
+
+@pytest.fixture
+def server():
+    return FakeRedis()
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def started_bus(server):
+    bus = app.RedisControlBus('redis://fake', client=server)
+    bus.RETRY_MIN_SECONDS = 0.01
+    received = queue.Queue()
+    for kind in ['halt', 'resume']:
+        bus.on(kind, received.put)
+    bus.start()
+    assert bus.subscribed.wait(5)
+    return bus, received
+
+
+def test_messages_reach_every_worker(server):
+    first, first_received = started_bus(server)
+    second, second_received = started_bus(server)
+    first.publish('halt', sid='a')
+    second.publish('resume', sid='b', id='1', seq=7)
+    for received in [first_received, second_received]:
+        halt = received.get(timeout=5)
+        assert (halt['kind'], halt['sid'], halt['worker']) == ('halt', 'a', app.WORKER_ID)
+        resume = received.get(timeout=5)
+        assert (resume['kind'], resume['sid'], resume['id'], resume['seq']) == \
+            ('resume', 'b', '1', 7)
+
+
+def test_listener_resubscribes_after_losing_the_connection(server):
+    bus, received = started_bus(server)
+    server.drop_connections()
+    # the listener closes the broken subscription and subscribes again
+    wait_until(lambda: server.subscriptions == 2)
+    assert len(server.subscribers[bus.channel]) == 1
+    bus.publish('halt', sid='a')
+    assert received.get(timeout=5)['sid'] == 'a'
+
+
+def test_invalid_messages_are_skipped(server):
+    bus, received = started_bus(server)
+    server.publish(bus.channel, b'not json')
+    bus.publish('halt', sid='a')
+    assert received.get(timeout=5)['sid'] == 'a'
+
+
+def test_halt_from_another_worker_kills_the_session(server, monkeypatch):
+    bus = app.RedisControlBus('redis://fake', client=server)
+    bus.on('halt', app.control_halt)
+    bus.start()
+    assert bus.subscribed.wait(5)
+    halted = queue.Queue()
+    monkeypatch.setattr(app, 'destroy_all_processes_for_sid',
+                        lambda sid, broadcast=True: halted.put((sid, broadcast)))
+    server.publish(bus.channel, json.dumps({'kind': 'halt', 'sid': 'a', 'worker': app.WORKER_ID}))
+    server.publish(bus.channel, json.dumps({'kind': 'halt', 'sid': 'b', 'worker': 'other-1'}))
+    # a worker ignores its own halt, it already acted on it
+    assert halted.get(timeout=5) == ('b', False)
+    assert halted.empty()
@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+from threading import Event, Thread
+
+import dns.resolver
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.environ.setdefault('CONFIG_FILE', os.path.join(ROOT, 'config.yaml'))
+
+import app  # noqa: E402
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeAnswer(object):
+
+    def __init__(self, answers, ttl):
+        self.answers = answers
+        self.rrset = type('RRset', (), {'ttl': ttl})()
+
+    def __iter__(self):
+        return iter(self.answers)
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = app.DNSCache(max_entries=2, negative_ttl=30)
+    monkeypatch.setattr(app, 'dns_cache', cache)
+    return cache
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """answers keyed by fqdn, an exception class answers by raising it"""
+    answers = {}
+    queried = []
+
+    def query(fqdn, record_type):
+        queried.append((fqdn, record_type))
+        answer = answers[fqdn]
+        if isinstance(answer, type):
+            raise answer()
+        return answer
+    monkeypatch.setattr(dns.resolver, 'query', query)
+    return answers, queried
+
+
+def test_answers_expire_with_their_ttl(clock, cache, queries):
+    answers, queried = queries
+    answers['web.default'] = FakeAnswer(['10.0.0.1'], 5)
+    assert app.resolve_fqdn('web.default') == (['10.0.0.1'], False)
+    clock.now += 4
+    assert app.resolve_fqdn('WEB.default.') == (['10.0.0.1'], True)
+    clock.now += 2
+    answers['web.default'] = FakeAnswer(['10.0.0.2'], 5)
+    assert app.resolve_fqdn('web.default') == (['10.0.0.2'], False)
+    assert len(queried) == 2
+
+
+def test_missing_names_are_cached_negatively(clock, cache, queries):
+    answers, queried = queries
+    answers['gone.default'] = dns.resolver.NXDOMAIN
+    assert app.resolve_fqdn('gone.default') == ([], False)
+    clock.now += 29
+    assert app.resolve_fqdn('gone.default') == ([], True)
+    assert cache.stats()['negative_hits'] == 1
+    clock.now += 2
+    assert app.resolve_fqdn('gone.default') == ([], False)
+    assert len(queried) == 2
+
+
+def test_bypass_queries_and_refreshes_the_cache(clock, cache, queries):
+    answers, queried = queries
+    answers['web.default'] = FakeAnswer(['10.0.0.1'], 60)
+    app.resolve_fqdn('web.default')
+    answers['web.default'] = FakeAnswer(['10.0.0.2'], 60)
+    assert app.resolve_fqdn('web.default', use_cache=False) == (['10.0.0.2'], False)
+    assert app.resolve_fqdn('web.default') == (['10.0.0.2'], True)
+
+
+def test_least_recently_used_answer_is_evicted(clock, cache):
+    cache.put(('a', 'A'), ['1'], 60)
+    cache.put(('b', 'A'), ['2'], 60)
+    assert cache.get(('a', 'A'))
+    cache.put(('c', 'A'), ['3'], 60)
+    assert cache.get(('b', 'A')) is None
+    assert cache.get(('a', 'A')) and cache.get(('c', 'A'))
+    assert cache.stats()['evictions'] == 1
+
+
+def test_concurrent_misses_share_one_query(cache):
+    started = Event()
+    release = Event()
+    calls = []
+
+    def query():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return ['10.0.0.1'], 60
+
+    results = []
+    leader = Thread(target=lambda: results.append(cache.resolve(('web', 'A'), query)))
+    leader.start()
+    assert started.wait(5)
+    waiters = [Thread(target=lambda: results.append(cache.resolve(('web', 'A'), query)))
+               for i in range(4)]
+    for waiter in waiters:
+        waiter.start()
+    wait_until(lambda: cache.stats()['shared'] == 4)
+    release.set()
+    for thread in [leader] + waiters:
+        thread.join(5)
+    assert calls == [1]
+    assert results == [['10.0.0.1']] * 5
+    assert cache.get(('web', 'A'))['answers'] == ['10.0.0.1']
+    assert not cache.in_flight
+
+
+def test_shared_query_failure_reaches_every_waiter(cache):
+    started = Event()
+    release = Event()
+
+    def query():
+        started.set()
+        release.wait(5)
+        raise dns.resolver.NoNameservers()
+
+    errors = []
+
+    def resolve():
+        try:
+            cache.resolve(('web', 'A'), query)
+        except dns.resolver.NoNameservers as ex:
+            errors.append(ex)
+    threads = [Thread(target=resolve)]
+    threads[0].start()
+    assert started.wait(5)
+    threads.append(Thread(target=resolve))
+    threads[1].start()
+    wait_until(lambda: cache.stats()['shared'] == 1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 2
+    assert cache.get(('web', 'A')) is None
+    assert not cache.in_flight
@@ -0,0 +1,143 @@
+import os
+import socket
+import sys
+from threading import Thread
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.environ.setdefault('CONFIG_FILE', os.path.join(ROOT, 'config.yaml'))
+
+import app  # noqa: E402
+
+
+SOCKPERF_PING_PONG_OUTPUT = """sockperf: Summary: Latency is 15.234 usec
+sockperf: Total 65536 observations; each percentile contains 655.36 observations
+sockperf: ====> avg-latency=15.234 (std-dev=1.204)
+sockperf: ---> <MAX> observation =   45.123
+sockperf: ---> percentile 99.999 =   40.100
+sockperf: ---> percentile 99.900 =   22.500
+sockperf: ---> percentile 50.000 =   14.900
+sockperf: ---> <MIN> observation =   10.200
+"""
+
+
+@pytest.fixture
+def probe_server():
+    server = app.ProbeServer(('127.0.0.1', 0), app.ProbeRequestHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address
+    server.shutdown()
+    server.server_close()
+
+
+def test_ping_frames_are_echoed(probe_server):
+    with socket.create_connection(probe_server, timeout=5) as sock:
+        sock.sendall(app.PROBE_MAGIC)
+        assert app.recv_exactly(sock, len(app.PROBE_MAGIC)) == app.PROBE_MAGIC
+        frame = app.PROBE_FRAME.pack(b'P', 5) + b'hello'
+        sock.sendall(frame)
+        assert app.recv_exactly(sock, len(frame)) == frame
+
+
+def test_report_counts_throughput_payload(probe_server):
+    with socket.create_connection(probe_server, timeout=5) as sock:
+        sock.sendall(app.PROBE_MAGIC)
+        app.recv_exactly(sock, len(app.PROBE_MAGIC))
+        for size in [1000, 70000]:
+            sock.sendall(app.PROBE_FRAME.pack(b'T', size) + bytes(size))
+        sock.sendall(app.PROBE_FRAME.pack(b'R', 0))
+        report = app.recv_exactly(sock, app.PROBE_FRAME.size + app.PROBE_COUNT.size)
+        assert app.PROBE_FRAME.unpack_from(report) == (b'R', app.PROBE_COUNT.size)
+        assert app.PROBE_COUNT.unpack_from(report, app.PROBE_FRAME.size)[0] == 71000
+        # the count restarts after every report
+        sock.sendall(app.PROBE_FRAME.pack(b'R', 0))
+        report = app.recv_exactly(sock, app.PROBE_FRAME.size + app.PROBE_COUNT.size)
+        assert app.PROBE_COUNT.unpack_from(report, app.PROBE_FRAME.size)[0] == 0
+
+
+def test_native_prober_loopback(probe_server):
+    with app.NativeProber(*probe_server) as prober:
+        samples = prober.ping_pong(duration=0.1, msg_size=14)
+        assert samples and all(sample > 0 for sample in samples)
+        assert prober.throughput(duration=0.1, msg_size=65536) > 0
+
+
+def test_native_prober_rejects_other_servers():
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def answer():
+        conn, _ = listener.accept()
+        conn.recv(4)
+        conn.sendall(b'NOPE')
+        conn.close()
+    Thread(target=answer, daemon=True).start()
+    try:
+        with pytest.raises(ConnectionError):
+            app.NativeProber(*listener.getsockname(), timeout=2)
+    finally:
+        listener.close()
+
+
+def test_negotiate_falls_back_to_sockperf(probe_server):
+    assert app.negotiate_performance_backend(*probe_server, 'native') == 'native'
+    assert app.negotiate_performance_backend(*probe_server, 'sockperf') == 'sockperf'
+    closed = socket.create_server(('127.0.0.1', 0))
+    address = closed.getsockname()
+    closed.close()
+    assert app.negotiate_performance_backend(*address, 'native') == 'sockperf'
+
+
+def test_sockperf_latency_parsing():
+    assert app.get_latency_from_ping_pong_output(SOCKPERF_PING_PONG_OUTPUT) == '15.234'
+    assert app.get_percentiles_from_ping_pong_output(SOCKPERF_PING_PONG_OUTPUT) == {
+        'max': 45.123,
+        'p99.999': 40.1,
+        'p99.9': 22.5,
+        'p50': 14.9,
+        'min': 10.2
+    }
+    assert app.get_latency_from_ping_pong_output('sockperf: no reply') == ''
+
+
+def test_latency_histogram_summary():
+    histogram = app.LatencyHistogram()
+    for usec in range(1, 1001):
+        histogram.record(usec)
+    summary = histogram.summary()
+    assert summary['samples'] == 1000
+    assert summary['min'] == 1.0 and summary['max'] == 1000.0
+    assert abs(summary['p50'] - 500) <= 0.5
+    assert abs(summary['p99'] - 990) <= 1
+    merged = app.LatencyHistogram.from_dict(histogram.to_dict()).merge(histogram)
+    assert merged.total == 2000
+    assert merged.percentile(50) == histogram.percentile(50)
+
+
+def test_oversized_frame_closes_the_connection(probe_server):
+    with socket.create_connection(probe_server, timeout=5) as sock:
+        sock.sendall(app.PROBE_MAGIC)
+        app.recv_exactly(sock, len(app.PROBE_MAGIC))
+        sock.sendall(app.PROBE_FRAME.pack(b'P', 0xffffffff))
+        assert sock.recv(1) == b''
+
+
+def test_native_prober_times_out_on_a_stalled_server():
+    listener = socket.create_server(('127.0.0.1', 0))
+    accepted = []
+
+    def answer_handshake_only():
+        conn, _ = listener.accept()
+        accepted.append(conn)
+        conn.recv(4)
+        conn.sendall(app.PROBE_MAGIC)
+    Thread(target=answer_handshake_only, daemon=True).start()
+    try:
+        with app.NativeProber(*listener.getsockname(), timeout=2, read_timeout=0.2) as prober:
+            with pytest.raises(ConnectionError, match='did not answer'):
+                prober.ping_pong(duration=5, msg_size=14)
+    finally:
+        for conn in accepted:
+            conn.close()
+        listener.close()
@@ -0,0 +1,235 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.environ.setdefault('CONFIG_FILE', os.path.join(ROOT, 'config.yaml'))
+
+import app  # noqa: E402
+
+
+class FakeTimer(object):
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop(object):
+    """records timers instead of running them, fire() runs the pending ones"""
+
+    def __init__(self):
+        self.timers = []
+
+    def call_later(self, delay, callback, *args):
+        timer = FakeTimer(callback, args)
+        self.timers.append(timer)
+        return timer
+
+    def fire(self):
+        timers, self.timers = self.timers, []
+        for timer in timers:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+
+class FakePipe(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class RecordingBuffer(object):
+
+    def __init__(self):
+        self.frames = []
+
+    def put(self, stream_type, data):
+        self.frames.append((stream_type, data))
+
+
+def output_stream(max_bytes=16, window_ms=5):
+    runner = {'killed': False, 'buffer': RecordingBuffer()}
+    loop = FakeLoop()
+    stream = app.OutputStream(loop, runner, 'stdout', FakePipe(), max_bytes, window_ms)
+    return stream, loop, runner['buffer'].frames
+
+
+def test_lines_split_across_chunks():
+    stream, loop, frames = output_stream(max_bytes=1024, window_ms=0)
+    for chunk in [b'one\ntw', b'o', b'\nthree\nfo', b'ur']:
+        stream.feed(chunk)
+    assert frames == [('stdout', 'one\n'), ('stdout', 'two\n'), ('stdout', 'three\n')]
+    stream.close()
+    assert frames[-1] == ('stdout', 'four')
+
+
+def test_lines_are_batched_until_the_window_ends():
+    stream, loop, frames = output_stream(max_bytes=1024, window_ms=5)
+    stream.feed(b'a\nb\n')
+    stream.feed(b'c\n')
+    assert frames == []
+    loop.fire()
+    assert frames == [('stdout', 'a\nb\nc\n')]
+
+
+def test_carriage_returns_end_lines():
+    stream, loop, frames = output_stream(max_bytes=1024, window_ms=0)
+    stream.feed(b'10%\r20%\r30%')
+    assert frames == [('stdout', '10%\n'), ('stdout', '20%\n')]
+
+
+def test_split_utf8_sequence_is_kept_whole():
+    stream, loop, frames = output_stream(max_bytes=1024, window_ms=0)
+    data = 'café\n'.encode('utf-8')
+    stream.feed(data[:4])
+    stream.feed(data[4:])
+    assert frames == [('stdout', 'café\n')]
+
+
+def test_line_without_newline_is_sent_at_max_bytes():
+    stream, loop, frames = output_stream(max_bytes=16, window_ms=5)
+    for i in range(10):
+        stream.feed(b'x' * 5)
+        assert stream.partial_bytes < 16
+    assert frames == [('stdout', 'x' * 20), ('stdout', 'x' * 20)]
+    stream.close()
+    assert frames[-1] == ('stdout', 'x' * 10)
+    assert ''.join(data for _, data in frames) == 'x' * 50
+
+
+def test_partial_line_is_joined_with_the_rest_of_the_line():
+    stream, loop, frames = output_stream(max_bytes=1024, window_ms=0)
+    for i in range(100):
+        stream.feed(b'ab')
+    stream.feed(b'c\nd')
+    assert frames == [('stdout', 'ab' * 100 + 'c\n')]
+    assert stream.partial == ['d']
+
+
+class FakeEngine(object):
+
+    def __init__(self):
+        self.loop = FakeLoop()
+        self.paused = 0
+        self.resumed = 0
+
+    def pause_reading(self, runner):
+        self.paused += 1
+
+    def resume_reading(self, runner):
+        self.resumed += 1
+
+
+class FakeScrollback(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def current_sid(self, origin, id):
+        return origin
+
+    def emit(self, origin, id, response):
+        self.sent.append(response)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """a client whose engine.io queue holds backlog packets"""
+    client = FakeScrollback()
+    client.backlog = 0
+    monkeypatch.setattr(app, 'scrollback', client)
+    monkeypatch.setattr(app, 'client_backlog', lambda sid: client.backlog)
+    return client
+
+
+def output_buffer(policy, max_bytes=10):
+    engine = FakeEngine()
+    runner = {'sid': 'sid', 'id': 1, 'killed': False}
+    buffer = app.OutputBuffer(engine, runner, max_bytes=max_bytes, max_pending=1, policy=policy)
+    return buffer, engine, runner
+
+
+def sent_text(client):
+    return ''.join(frame['data'] for frame in client.sent)
+
+
+def test_frames_are_sent_while_the_client_keeps_up(client):
+    buffer, engine, runner = output_buffer('pause')
+    for line in ['a\n', 'b\n']:
+        buffer.put('stdout', line)
+    assert sent_text(client) == 'a\nb\n'
+    assert buffer.bytes == 0
+
+
+def test_pause_stops_reading_until_the_client_catches_up(client):
+    buffer, engine, runner = output_buffer('pause', max_bytes=10)
+    client.backlog = 1
+    for i in range(4):
+        buffer.put('stdout', 'line %d\n' % i)
+    assert engine.paused == 1 and buffer.paused
+    assert client.sent == []
+    client.backlog = 0
+    engine.loop.fire()
+    assert engine.resumed == 1 and not buffer.paused
+    assert sent_text(client) == 'line 0\nline 1\nline 2\nline 3\n'
+
+
+def test_drop_middle_keeps_the_newest_output(client):
+    buffer, engine, runner = output_buffer('drop_middle', max_bytes=10)
+    client.backlog = 1
+    for i in range(6):
+        buffer.put('stdout', 'line %d\n' % i)
+    assert buffer.bytes <= 10
+    client.backlog = 0
+    engine.loop.fire()
+    assert sent_text(client) == '\n[... 5 lines elided ...]\nline 5\n'
+    assert engine.paused == 0
+
+
+def test_truncate_drops_new_output_and_reports_it(client):
+    buffer, engine, runner = output_buffer('truncate', max_bytes=10)
+    client.backlog = 1
+    for i in range(6):
+        buffer.put('stdout', 'line %d\n' % i)
+    assert buffer.bytes <= 10
+    completed = []
+    buffer.finish(lambda: completed.append(True))
+    client.backlog = 0
+    engine.loop.fire()
+    assert sent_text(client) == 'line 0\n\n[output truncated, 5 lines dropped]\n'
+    assert client.sent[-1]['stream'] == 'stderr'
+    assert completed == [True]
+
+
+def test_killed_command_drops_waiting_output(client):
+    buffer, engine, runner = output_buffer('pause')
+    client.backlog = 1
+    buffer.put('stdout', 'a\n')
+    runner['killed'] = True
+    completed = []
+    buffer.finish(lambda: completed.append(True))
+    engine.loop.fire()
+    assert client.sent == [] and buffer.bytes == 0
+    assert completed == [True]
+
+
+@pytest.mark.parametrize('policy', ['drop_middle', 'truncate'])
+def test_output_without_newlines_stays_bounded(client, policy):
+    """a curl of a large file, while the client reads nothing"""
+    buffer, engine, runner = output_buffer(policy, max_bytes=65536)
+    runner['buffer'] = buffer
+    stream = app.OutputStream(engine.loop, runner, 'stdout', FakePipe(), 16384, 5)
+    client.backlog = 1
+    for i in range(256):
+        stream.feed(b'x' * 65536)
+        assert stream.partial_bytes < 16384
+        assert buffer.bytes <= 65536 + 65536
+    assert buffer.frames
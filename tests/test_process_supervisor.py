@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+from concurrent.futures import wait
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.environ.setdefault('CONFIG_FILE', os.path.join(ROOT, 'config.yaml'))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def supervisor(monkeypatch, websocket):
+    supervisor = app.ProcessSupervisor()
+    # 2 running in total, 1 per session and 2 queued
+    supervisor.limits = lambda: (2, 1, 2)
+    monkeypatch.setattr(app, 'process_supervisor', supervisor)
+    return supervisor
+
+
+def admit(supervisor, sid, id, started, cancelled=None):
+    return supervisor.admit(
+        sid, id, lambda: started.append(id),
+        None if cancelled is None else lambda: cancelled.append(id))
+
+
+def test_requests_over_a_limit_wait_in_order(supervisor, websocket):
+    started = []
+    assert admit(supervisor, 'a', 1, started)
+    assert admit(supervisor, 'a', 2, started)
+    assert admit(supervisor, 'b', 3, started)
+    assert admit(supervisor, 'c', 4, started)
+    assert started == [1, 3]
+    assert [t['id'] for t in supervisor.queue] == [2, 4]
+    assert websocket.frames(2, 'queued')[-1]['data'] == 1
+    assert websocket.frames(4, 'queued')[-1]['data'] == 2
+    # the queue is full
+    assert not admit(supervisor, 'd', 5, started)
+    assert supervisor.stats()['rejected'] == 1
+
+    # c takes the free slot, a is still at its session limit
+    supervisor.release('b')
+    assert started == [1, 3, 4]
+    assert websocket.frames(2, 'queued')[-1]['data'] == 1
+    supervisor.release('a')
+    assert started == [1, 3, 4, 2]
+    assert not supervisor.queue
+    assert supervisor.stats()['running'] == 2
+
+
+def test_cancelled_requests_leave_the_queue(supervisor):
+    started = []
+    cancelled = []
+    admit(supervisor, 'a', 1, started)
+    admit(supervisor, 'a', 2, started, cancelled)
+    admit(supervisor, 'a', 3, started, cancelled)
+    supervisor.cancel('a', 2)
+    assert cancelled == [2]
+    supervisor.kill_session('a')
+    assert cancelled == [2, 3]
+    supervisor.release('a')
+    assert started == [1]
+    assert supervisor.stats()['running'] == 0
+
+
+def test_failed_start_frees_the_slot(supervisor):
+    cancelled = []
+
+    def fail():
+        raise OSError('no such file')
+    supervisor.admit('a', 1, fail, lambda: cancelled.append(1))
+    assert cancelled == [1]
+    assert supervisor.stats()['running'] == 0
+
+
+def test_killed_child_is_released(supervisor):
+    supervisor.admit('a', 1, lambda: None)
+    process = supervisor.launch('a', 'sleep 30')
+    assert supervisor.by_sid['a'] == {process.pid}
+    supervisor.kill_session('a')
+    assert process.wait(5) == -9
+    supervisor.release('a', process.pid)
+    assert not supervisor.children and not supervisor.by_sid
+    assert supervisor.stats()['running'] == 0
+
+
+def run(sid, cmd, id):
+    # commands run with an env never come from the command cache
+    return app.run_cmd(sid, cmd, id, env=dict(os.environ))
+
+
+def test_commands_of_one_session_run_side_by_side(supervisor, websocket):
+    supervisor.limits = lambda: (4, 2, 4)
+    first = run('a', 'sleep 0.3; echo first', 1)
+    second = run('a', 'echo second', 2)
+    assert wait([first, second], 5).not_done == set()
+    assert first.result() == 0 and second.result() == 0
+    assert websocket.frames(1, 'stdout')[0]['data'] == 'first\n'
+    assert websocket.frames(2, 'stdout')[0]['data'] == 'second\n'
+    assert supervisor.stats()['running'] == 0
+
+
+def test_queued_command_starts_when_the_running_one_exits(supervisor, websocket):
+    first = run('a', 'sleep 0.2', 1)
+    second = run('a', 'echo second', 2)
+    assert websocket.frames(2, 'queued')
+    assert first.result(5) == 0
+    assert second.result(5) == 0
+    assert websocket.frames(2, 'stdout')[0]['data'] == 'second\n'
+    assert supervisor.stats()['running'] == 0
+
+
+def test_halt_releases_killed_commands(supervisor, websocket):
+    first = run('a', 'sleep 30', 1)
+    second = run('a', 'echo second', 2)
+    deadline = time.monotonic() + 5
+    while not supervisor.by_sid.get('a'):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    app.destroy_all_processes_for_sid('a')
+    assert first.result(5) == -9
+    assert second.result(5) == -1
+    assert supervisor.stats()['running'] == 0
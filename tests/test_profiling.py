@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.environ.setdefault('CONFIG_FILE', os.path.join(ROOT, 'config.yaml'))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.fixture
+def token(monkeypatch):
+    monkeypatch.setitem(app.config, 'profile_token', 's3cret')
+    return 's3cret'
+
+
+def test_profiling_is_off_without_a_token(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'profile_token', '')
+    resp = client.get('/metrics', headers={'X-Profile': '1'})
+    assert resp.status_code == 200
+    assert 'X-Profile-Id' not in resp.headers
+    for path in ['/profiles', '/profiles/1']:
+        resp = client.get(path, headers={'X-Profile-Token': ''})
+        assert resp.status_code == 404
+        assert 'profile_token is not set' in resp.get_json()['message']
+    with pytest.raises(ValueError, match='profile_token is not set'):
+        app.set_profile_sampling({'mode': 'cprofile', 'token': '', 'seconds': 1})
+
+
+def test_wrong_token_is_refused(client, token):
+    resp = client.get('/metrics', query_string={'profile': '1', 'profile_token': 'guess'})
+    assert 'X-Profile-Id' not in resp.headers
+    assert client.get('/profiles', headers={'X-Profile-Token': 'guess'}).status_code == 403
+    assert client.get('/profiles').status_code == 403
+    with pytest.raises(ValueError, match='invalid profile token'):
+        app.set_profile_sampling({'mode': 'cprofile', 'token': 'guess', 'seconds': 1})
+
+
+def test_profiled_request_can_be_downloaded_with_the_token(client, token):
+    resp = client.get('/metrics', headers={'X-Profile': '1', 'X-Profile-Token': token})
+    id = int(resp.headers['X-Profile-Id'])
+    resp = client.get('/profiles', headers={'X-Profile-Token': token})
+    assert resp.status_code == 200
+    assert id in [capture['id'] for capture in resp.get_json()]
+    resp = client.get('/profiles/%d' % id, query_string={'profile_token': token})
+    assert resp.status_code == 200
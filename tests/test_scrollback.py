@@ -0,0 +1,87 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.environ.setdefault('CONFIG_FILE', os.path.join(ROOT, 'config.yaml'))
+
+import app  # noqa: E402
+
+
+def emit_lines(scrollback, sid, id, count, size=10):
+    for i in range(count):
+        scrollback.emit(sid, id, {'id': id, 'stream': 'stdout',
+                                  'data': ('%d' % i).ljust(size - 1, '.') + '\n'})
+
+
+def test_attached_command_keeps_only_a_short_tail(websocket):
+    scrollback = app.Scrollback(max_bytes=1000, attached_bytes=100)
+    log = scrollback.open('a', 1)
+    emit_lines(scrollback, 'a', 1, 50)
+    assert len(websocket.sent) == 50
+    assert [frame['seq'] for to, frame in websocket.sent] == list(range(1, 51))
+    assert log['bytes'] == 100
+    assert [frame['seq'] for frame, size in log['frames']] == list(range(41, 51))
+
+
+def test_detached_command_keeps_up_to_max_bytes(websocket):
+    scrollback = app.Scrollback(max_bytes=200, attached_bytes=100)
+    log = scrollback.open('a', 1)
+    emit_lines(scrollback, 'a', 1, 10)
+    assert scrollback.detach('a')
+    emit_lines(scrollback, 'a', 1, 30)
+    # nothing is sent while nobody is attached
+    assert len(websocket.sent) == 10
+    assert log['bytes'] == 200
+    assert log['frames'][0][0]['seq'] == 21
+
+
+def test_resume_replays_the_missed_frames(websocket):
+    scrollback = app.Scrollback(max_bytes=1000, attached_bytes=100)
+    scrollback.open('a', 1)
+    emit_lines(scrollback, 'a', 1, 5)
+    scrollback.detach('a')
+    emit_lines(scrollback, 'a', 1, 5)
+    websocket.sent.clear()
+    assert scrollback.resume('b', 1, 3)
+    assert [frame['seq'] for to, frame in websocket.sent] == list(range(4, 11))
+    assert all(to == 'b' for to, frame in websocket.sent)
+    # output after the resume goes to the new session
+    emit_lines(scrollback, 'a', 1, 1)
+    to, frame = websocket.sent[-1]
+    assert to == 'b' and frame['seq'] == 11
+    assert scrollback.origins('b') == {'a', 'b'}
+
+
+def test_resume_after_trimming_says_where_the_replay_starts(websocket):
+    scrollback = app.Scrollback(max_bytes=100, attached_bytes=50)
+    scrollback.open('a', 1)
+    emit_lines(scrollback, 'a', 1, 10)
+    scrollback.detach('a')
+    emit_lines(scrollback, 'a', 1, 20)
+    websocket.sent.clear()
+    assert scrollback.resume('b', 1, 2)
+    notice = websocket.sent[0][1]
+    assert notice['stream'] == 'stderr'
+    assert 'before seq 21' in notice['data']
+    assert [frame['seq'] for to, frame in websocket.sent[1:]] == list(range(21, 31))
+
+
+def test_resume_within_the_attached_tail_needs_no_notice(websocket):
+    scrollback = app.Scrollback(max_bytes=1000, attached_bytes=50)
+    scrollback.open('a', 1)
+    emit_lines(scrollback, 'a', 1, 20)
+    scrollback.detach('a')
+    websocket.sent.clear()
+    assert scrollback.resume('b', 1, 17)
+    assert [frame['seq'] for to, frame in websocket.sent] == [18, 19, 20]
+
+
+def test_only_detached_commands_can_be_resumed(websocket):
+    scrollback = app.Scrollback()
+    scrollback.open('a', 1)
+    assert scrollback.resume('b', 1, 0) is None
+    scrollback.emit('a', 1, {'id': 1, 'stream': 'completed', 'data': 0})
+    assert not scrollback.detach('a')
+    assert scrollback.resume('b', 1, 0) is None
+    assert scrollback.resume('b', 2, 0) is None
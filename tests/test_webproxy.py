@@ -0,0 +1,79 @@
+import gzip
+import http.server
+import os
+import sys
+from threading import Thread
+
+import pytest
+import urllib3.exceptions
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.environ.setdefault('CONFIG_FILE', os.path.join(ROOT, 'config.yaml'))
+
+import app  # noqa: E402
+
+BODY = b'0123456789abcdef' * 1500
+
+
+class UpstreamHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = BODY
+        self.send_response(200)
+        if self.path == '/gzip':
+            body = gzip.compress(BODY)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), UpstreamHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def test_stream_relays_length_of_identity_bodies(upstream, client):
+    resp = client.get('/webproxy', query_string={'url': upstream + '/plain', 'stream': 'true'})
+    assert resp.status_code == 200
+    assert resp.headers['Content-Length'] == str(len(BODY))
+    assert resp.get_data() == BODY
+
+
+def test_stream_drops_the_length_of_encoded_bodies(upstream, client):
+    resp = client.get('/webproxy', query_string={'url': upstream + '/gzip', 'stream': 'true'})
+    assert resp.status_code == 200
+    assert 'Content-Length' not in resp.headers
+    assert resp.get_data() == BODY
+
+
+def test_full_pool_fails_after_the_pool_timeout(upstream, client, monkeypatch):
+    session = app.webproxy_session_for(1, 1, 0.2)
+    monkeypatch.setattr(app, 'webproxy_session', session)
+    # webproxy requests skip certificate checks, which selects the pool
+    held = session.get(upstream + '/plain', stream=True, verify=False)
+    try:
+        with pytest.raises(urllib3.exceptions.EmptyPoolError):
+            session.get(upstream + '/plain', verify=False)
+        resp = client.get('/webproxy', query_string={'url': upstream + '/plain'})
+        assert resp.status_code == 503
+        assert resp.get_json()['error'] == 503
+    finally:
+        held.close()
+    assert session.get(upstream + '/plain', verify=False).content == BODY
@@ -5,12 +5,22 @@ import argparse
 
 from pyppeteer import launch
 
+BROWSER_LAUNCH_OPTIONS = {
+    'args': ['--no-sandbox', '--window-size=1920,1080'],
+    'headless': True,
+    'defaultViewport': {'width': 1920, 'height': 1080}
+}
 
-async def get_page(url, screen_shot_file_path):
-    browser = await launch(args=['--no-sandbox', '--window-size=1920,1080'], headless=True, defaultViewport={'width': 1920, 'height': 1080})
-    page = await browser.newPage()
+
+async def take_screenshot(page, url, screen_shot_file_path):
     await page.goto(url)
     await page.screenshot({'path': screen_shot_file_path, 'type': 'jpeg', 'quality': 50})
+
+
+async def get_page(url, screen_shot_file_path):
+    browser = await launch(**BROWSER_LAUNCH_OPTIONS)
+    page = await browser.newPage()
+    await take_screenshot(page, url, screen_shot_file_path)
     await browser.close()
 
 